@@ -1,41 +1,241 @@
+"""AI task breakdown through the Groq chat completions API.
+
+All calls share one pooled httpx.AsyncClient (keep-alive, HTTP/2 when h2
+is installed), so a breakdown does not pay a fresh TLS handshake.
+Completions are streamed, and breakdown_stream() yields each subtask as
+soon as its text has arrived. Calls to Groq wait for one of
+AI_MAX_CONCURRENT slots, handed out round-robin between users so one
+user's burst can't starve the rest; a 429 (or 5xx) pauses every call
+for Retry-After, or an exponential backoff, before retrying.
+
+Results are cached by model, prompt and normalized task text ("Clean the
+kitchen!" and "clean  the kitchen" are one entry): an in-memory LRU per
+worker in front of the ai_cache table, which workers and restarts share
+(AI_CACHE_DB). A breakdown already in flight is shared, subtask by
+subtask, rather than sent again. TOOLS/fake_groq.py stands in for Groq
+in benchmarks.
+"""
+
 import os
+import re
 import json
+import time
+import asyncio
+import random
+import hashlib
+from collections import OrderedDict, deque
+
 import httpx
-from SETTINGS import GROQ_MODEL
 
-GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+from SETTINGS import (
+    GROQ_MODEL, GROQ_URL, AI_CACHE_SIZE, AI_CACHE_TTL, AI_CACHE_DB,
+    AI_MAX_CONCURRENT, AI_MAX_PER_USER,
+)
+from BACKEND.core import logger, get_db
+from BACKEND.gcal_metrics import Metrics, SECONDS_BUCKETS
+
+try:
+    import h2  # noqa: F401 — httpx only speaks HTTP/2 with this installed
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
 
 BREAKDOWN_SYSTEM = """You are a task breakdown assistant. Given a task, break it down into exactly 3 concise actionable steps.
 Return a JSON object with a "subtasks" key containing an array of objects, each with "text" (task description).
 Example: {{"subtasks": [{{"text": "Buy groceries"}}, {{"text": "Cook dinner"}}, {{"text": "Set the table"}}]}}
 Always return exactly 3 sub-tasks. Keep them concise and actionable."""
 
+MAX_CONNECTIONS = 10
+MAX_SUBTASKS = 3
+MAX_RETRIES = 4
+RETRY_BASE = 1.0        # seconds; doubled per attempt, plus jitter
+RETRY_MAX = 60
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+ai_metrics = Metrics({"groq_duration_s": SECONDS_BUCKETS, "queue_wait_s": SECONDS_BUCKETS,
+                      "first_subtask_s": SECONDS_BUCKETS})
+
+
+# ============== Shared client ==============
+
+_client = None
+_transport = None
+
+
+def set_groq_transport(transport=None):
+    """Send Groq traffic through an httpx transport instead of the network.
+
+    Used by the benchmarks with TOOLS/fake_groq.py; None restores the network.
+    """
+    global _client, _transport
+    _transport = transport
+    _client = None
+
+
+def http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=HTTP2,
+            transport=_transport,
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                max_keepalive_connections=MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_ai_client():
+    """Close pooled connections (app shutdown)."""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+
+# ============== Fair queue ==============
+
+class FairLimiter:
+    """At most `slots` holders at a time; waiters are served one user at a
+    time in turn, so a user with many queued calls can't starve the rest.
+
+    Separately, reserve() caps how many breakdowns one user may have open
+    at once (AI_MAX_PER_USER), counted from the moment a request is let in.
+    """
+
+    def __init__(self, slots):
+        self.free = slots
+        self.waiting = OrderedDict()  # user_id -> deque of futures, next user first
+        self.pending = {}             # user_id -> reserved breakdowns, queued or running
+
+    def reserve(self, user_id):
+        """A Reservation counting against user_id's cap until released, or
+        None if the user is at it. Synchronous, so a burst can't slip past."""
+        if self.pending.get(user_id, 0) >= AI_MAX_PER_USER:
+            return None
+        self.pending[user_id] = self.pending.get(user_id, 0) + 1
+        return Reservation(self, user_id)
+
+    def _unreserve(self, user_id):
+        self.pending[user_id] -= 1
+        if not self.pending[user_id]:
+            del self.pending[user_id]
+
+    async def acquire(self, user_id):
+        if self.free and not self.waiting:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append(future)
+        ai_metrics.adjust("queue_waiting", 1)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # granted as we were cancelled: pass it on
+            else:
+                self._forget(user_id, future)
+            raise
+        finally:
+            ai_metrics.adjust("queue_waiting", -1)
+
+    def _forget(self, user_id, future):
+        queue = self.waiting.get(user_id)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.waiting[user_id]
+
+    def release(self):
+        while self.waiting:
+            next_user, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiting.move_to_end(next_user)  # to the back of the line
+            else:
+                del self.waiting[next_user]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+
+class Reservation:
+    """One of a user's AI_MAX_PER_USER breakdowns (FairLimiter.reserve)."""
+
+    def __init__(self, limiter, user_id):
+        self._limiter = limiter
+        self.user_id = user_id
+
+    def release(self):
+        """Give the reservation back; safe to call more than once."""
+        if self._limiter is not None:
+            limiter, self._limiter = self._limiter, None
+            limiter._unreserve(self.user_id)
+
+
+limiter = FairLimiter(AI_MAX_CONCURRENT)
+_paused_until = 0.0  # monotonic time before which nobody calls Groq (after a 429)
+
+
+def _retry_delay(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX)
+        except ValueError:
+            pass
+    return min(RETRY_BASE * 2 ** attempt, RETRY_MAX) * random.uniform(0.5, 1.0)
+
+
+# ============== Groq ==============
 
-async def _call_groq(system: str, user: str) -> str:
+async def _stream_groq(system: str, user: str):
+    """Yield the completion's content as it arrives (server-sent events)."""
+    global _paused_until
     api_key = os.environ.get("GROQ_API_KEY", "")
     if not api_key:
         raise ValueError("GROQ_API_KEY is not set")
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        resp = await client.post(
-            GROQ_URL,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": GROQ_MODEL,
-                "messages": [
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": user},
-                ],
-                "temperature": 0.7,
-                "max_tokens": 1024,
-                "response_format": {"type": "json_object"},
-            },
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
+    body = {
+        "model": GROQ_MODEL,
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ],
+        "temperature": 0.7,
+        "max_tokens": 1024,
+        "stream": True,
+    }
+    for attempt in range(MAX_RETRIES + 1):
+        pause = _paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        started = time.monotonic()
+        ai_metrics.inc("groq_calls")
+        try:
+            async with http_client().stream(
+                "POST", GROQ_URL, headers={"Authorization": f"Bearer {api_key}"}, json=body,
+            ) as resp:
+                if resp.status_code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    delay = _retry_delay(attempt, resp.headers.get("retry-after"))
+                    _paused_until = max(_paused_until, time.monotonic() + delay)
+                    ai_metrics.inc("groq_throttled" if resp.status_code == 429 else "groq_retried")
+                    logger.warning("Groq returned %d, retrying in %.1fs", resp.status_code, delay)
+                    continue
+                resp.raise_for_status()
+                # Read to the end even after [DONE], so the connection goes back to the pool
+                async for line in resp.aiter_lines():
+                    data = line[5:].strip() if line.startswith("data:") else ""
+                    if not data or data == "[DONE]":
+                        continue
+                    delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    if delta:
+                        yield delta
+                return
+        except Exception:
+            ai_metrics.inc("groq_errors")
+            raise
+        finally:
+            ai_metrics.observe("groq_duration_s", time.monotonic() - started)
 
 
 def _parse_json(text: str):
@@ -46,11 +246,181 @@ def _parse_json(text: str):
     return json.loads(text.strip())
 
 
-async def breakdown_task(task_text: str) -> list[dict]:
-    result = await _call_groq(BREAKDOWN_SYSTEM, task_text)
-    parsed = _parse_json(result)
-    if isinstance(parsed, list):
-        return parsed[:3]
+# ============== Cache ==============
+
+_memory = OrderedDict()  # key -> (stored_at, subtasks), least recently used first
+_inflight = {}           # key -> _InFlight of a breakdown being fetched
+
+
+def normalize_task_text(text: str) -> str:
+    """Case, spacing and trailing punctuation don't change the breakdown."""
+    return re.sub(r"\s+", " ", text).strip().rstrip(".!?…").strip().casefold()
+
+
+def _cache_key(text: str) -> str:
+    prompt = hashlib.sha256(BREAKDOWN_SYSTEM.encode()).hexdigest()[:8]
+    return hashlib.sha256(f"{GROQ_MODEL}\n{prompt}\n{normalize_task_text(text)}".encode()).hexdigest()
+
+
+def _cache_get(key: str):
+    now = time.time()
+    entry = _memory.get(key)
+    if entry and now - entry[0] < AI_CACHE_TTL:
+        _memory.move_to_end(key)
+        ai_metrics.inc("cache_hits_memory")
+        return entry[1]
+    if AI_CACHE_DB:
+        with get_db() as conn:
+            row = conn.execute("SELECT result, created_at FROM ai_cache WHERE key = ? AND created_at > ?",
+                               (key, now - AI_CACHE_TTL)).fetchone()
+        if row:
+            subtasks = json.loads(row["result"])
+            _memory_put(key, row["created_at"], subtasks)
+            ai_metrics.inc("cache_hits_db")
+            return subtasks
+    return None
+
+
+def _memory_put(key: str, stored_at: float, subtasks: list):
+    _memory[key] = (stored_at, subtasks)
+    _memory.move_to_end(key)
+    while len(_memory) > AI_CACHE_SIZE:
+        _memory.popitem(last=False)
+
+
+def _cache_put(key: str, subtasks: list):
+    now = time.time()
+    _memory_put(key, now, subtasks)
+    if AI_CACHE_DB:
+        with get_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO ai_cache (key, result, created_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(subtasks), now))
+            conn.execute("DELETE FROM ai_cache WHERE created_at <= ?", (now - AI_CACHE_TTL,))
+            conn.commit()
+
+
+def clear_cache():
+    _memory.clear()
+    if AI_CACHE_DB:
+        with get_db() as conn:
+            conn.execute("DELETE FROM ai_cache")
+            conn.commit()
+
+
+# ============== Breakdown ==============
+
+_TEXT_VALUE = re.compile(r'"text"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def _shape(parsed) -> list[dict]:
     if isinstance(parsed, dict) and "subtasks" in parsed:
-        return parsed["subtasks"][:3]
-    return [parsed]
+        parsed = parsed["subtasks"]
+    if not isinstance(parsed, list):
+        parsed = [parsed]
+    return [st if isinstance(st, dict) else {"text": str(st)} for st in parsed[:MAX_SUBTASKS]]
+
+
+class _InFlight:
+    """Subtasks of one breakdown as they arrive, readable by any number of callers."""
+
+    def __init__(self):
+        self.subtasks = []
+        self.error = None
+        self.done = False
+        self.task = None  # the _fetch() filling it
+        self._changed = asyncio.Event()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def add(self, subtask):
+        self.subtasks.append(subtask)
+        self._wake()
+
+    def finish(self, error=None):
+        self.error, self.done = error, True
+        self._wake()
+
+    async def follow(self):
+        seen = 0
+        while True:
+            changed = self._changed
+            while seen < len(self.subtasks):
+                seen += 1
+                yield self.subtasks[seen - 1]
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+async def _fetch(key: str, task_text: str, user_id, flight: _InFlight):
+    """Fetch a breakdown into flight; errors go to its followers."""
+    try:
+        await _stream_subtasks(task_text, user_id, flight)
+        try:
+            if flight.subtasks:  # an empty or unusable reply is worth asking again
+                _cache_put(key, flight.subtasks)
+        except Exception:
+            logger.warning("Failed to cache AI breakdown", exc_info=True)
+        flight.finish()
+    except Exception as e:
+        flight.finish(e)
+    except BaseException:
+        flight.finish(RuntimeError("AI breakdown cancelled"))
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _stream_subtasks(task_text: str, user_id, flight: _InFlight):
+    queued = time.monotonic()
+    await limiter.acquire(user_id)
+    started = time.monotonic()
+    ai_metrics.observe("queue_wait_s", started - queued)
+    try:
+        text, scanned = "", 0
+        async for delta in _stream_groq(BREAKDOWN_SYSTEM, task_text):
+            text += delta
+            # Each complete "text": "..." value is a subtask; the JSON around it can wait
+            for match in _TEXT_VALUE.finditer(text, scanned):
+                scanned = match.end()
+                if len(flight.subtasks) < MAX_SUBTASKS:
+                    if not flight.subtasks:
+                        ai_metrics.observe("first_subtask_s", time.monotonic() - started)
+                    flight.add({"text": json.loads(f'"{match.group(1)}"')})
+        if not flight.subtasks:  # no {"text": ...} objects: a list of strings, or similar
+            for subtask in _shape(_parse_json(text)):
+                flight.add(subtask)
+    finally:
+        limiter.release()
+
+
+async def breakdown_stream(task_text: str, user_id=None):
+    """Yield the task's subtasks ({"text": ...}) as they become available."""
+    key = _cache_key(task_text)
+    cached = _cache_get(key)
+    if cached is not None:
+        for subtask in cached:
+            yield subtask
+        return
+    # One request per text at a time; a caller that disconnects doesn't cancel it for the rest
+    flight = _inflight.get(key)
+    if flight is None:
+        ai_metrics.inc("cache_misses")
+        flight = _inflight[key] = _InFlight()
+        flight.task = asyncio.create_task(_fetch(key, task_text, user_id, flight))
+    else:
+        ai_metrics.inc("cache_hits_inflight")
+    async for subtask in flight.follow():
+        yield subtask
+
+
+async def breakdown_task(task_text: str, user_id=None) -> list[dict]:
+    return [subtask async for subtask in breakdown_stream(task_text, user_id)]
+
+
+def stats() -> dict:
+    return {**ai_metrics.snapshot(), "cached_in_memory": len(_memory)}
@@ -6,12 +6,12 @@ from fastapi import APIRouter, Request, Depends
 from fastapi.responses import JSONResponse
 
 from BACKEND.core import (
-    logger, get_db, parse_json, get_token_authenticated_user,
+    get_db, parse_json, get_token_authenticated_user,
     validate_task_text, new_task_id,
     get_or_create_progress, apply_xp, complete_task_logic,
     GOOGLE_CALENDAR_ENABLED,
 )
-from BACKEND.gcal_helpers import gcal_service
+from BACKEND.gcal_outbox import enqueue_gcal_op, notify_gcal_outbox
 
 router = APIRouter(prefix='/api/bot')
 
@@ -57,21 +57,9 @@ async def bot_add_task(request: Request, user_id: int = Depends(get_token_authen
         conn.execute('UPDATE user_progress SET xp=?, level=?, xp_max=? WHERE user_id=?',
                      (new_xp, new_level, new_xp_max, user_id))
 
-        if GOOGLE_CALENDAR_ENABLED:
-            try:
-                service, cal_id = gcal_service(conn, user_id)
-                if service:
-                    from BACKEND.google_calendar import create_calendar_event
-                    google_event_id = create_calendar_event(
-                        service, cal_id, text, scheduled_start, scheduled_end, None,
-                    )
-                    if google_event_id:
-                        conn.execute('UPDATE tasks SET google_event_id = ? WHERE id = ?',
-                                     (google_event_id, task_id))
-            except Exception:
-                logger.error('Failed to sync bot task to Google Calendar', exc_info=True)
-
+        enqueue_gcal_op(conn, user_id, task_id, 'create')
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({
         'success': True,
@@ -93,13 +81,7 @@ async def bot_complete_task(task_id: str, request: Request, user_id: int = Depen
         r = complete_task_logic(conn, user_id, task)
 
         if GOOGLE_CALENDAR_ENABLED and task['google_event_id']:
-            try:
-                service, cal_id = gcal_service(conn, user_id)
-                if service:
-                    from BACKEND.google_calendar import delete_calendar_event
-                    delete_calendar_event(service, cal_id, task['google_event_id'])
-            except Exception:
-                logger.error('Failed to delete calendar event on bot task completion', exc_info=True)
+            enqueue_gcal_op(conn, user_id, task_id, 'delete', task['google_event_id'])
             conn.execute(
                 'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
                 (user_id, task['google_event_id']),
@@ -108,6 +90,7 @@ async def bot_complete_task(task_id: str, request: Request, user_id: int = Depen
         completed_at = datetime.utcnow().isoformat()
         conn.execute('UPDATE tasks SET completed_at = ? WHERE id = ?', (completed_at, task_id))
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({
         'success': True, 'xpEarned': r['xp_earned'], 'level': r['level'],
@@ -124,13 +107,7 @@ async def bot_delete_task(task_id: str, user_id: int = Depends(get_token_authent
                 (task_id, user_id),
             ).fetchone()
             if task and task['google_event_id']:
-                try:
-                    service, cal_id = gcal_service(conn, user_id)
-                    if service:
-                        from BACKEND.google_calendar import delete_calendar_event
-                        delete_calendar_event(service, cal_id, task['google_event_id'])
-                except Exception:
-                    logger.error('Failed to sync bot task deletion to Google Calendar', exc_info=True)
+                enqueue_gcal_op(conn, user_id, task_id, 'delete', task['google_event_id'])
                 conn.execute(
                     'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
                     (user_id, task['google_event_id']),
@@ -153,6 +130,7 @@ async def bot_delete_task(task_id: str, user_id: int = Depends(get_token_authent
         conn.execute('DELETE FROM tasks WHERE id = ? AND user_id = ?',
                      (task_id, user_id))
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({'success': True})
 
@@ -164,27 +142,11 @@ async def bot_rename_task(task_id: str, request: Request, user_id: int = Depends
     if err: return err
 
     with get_db() as conn:
-        conn.execute('UPDATE tasks SET text = ? WHERE id = ? AND user_id = ?',
-                     (text, task_id, user_id))
-
-        if GOOGLE_CALENDAR_ENABLED:
-            task = conn.execute(
-                'SELECT google_event_id, scheduled_start, scheduled_end, recurrence_rule '
-                'FROM tasks WHERE id = ? AND user_id = ?', (task_id, user_id),
-            ).fetchone()
-            if task and task['google_event_id']:
-                try:
-                    service, cal_id = gcal_service(conn, user_id)
-                    if service:
-                        from BACKEND.google_calendar import update_calendar_event
-                        update_calendar_event(
-                            service, cal_id, task['google_event_id'], text,
-                            task['scheduled_start'], task['scheduled_end'],
-                            task['recurrence_rule'],
-                        )
-                except Exception:
-                    logger.error('Failed to sync bot task rename to Google Calendar', exc_info=True)
-
+        cur = conn.execute('UPDATE tasks SET text = ? WHERE id = ? AND user_id = ?',
+                           (text, task_id, user_id))
+        if cur.rowcount:
+            enqueue_gcal_op(conn, user_id, task_id, 'update')
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({'success': True})
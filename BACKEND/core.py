@@ -6,6 +6,7 @@ can import from here freely without risking circular imports.
 """
 
 import os
+import hmac
 import sqlite3
 import json
 import math
@@ -16,7 +17,7 @@ import logging
 from contextlib import contextmanager
 from datetime import datetime, date, timedelta
 
-from fastapi import Request, HTTPException
+from fastapi import Request, Response, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.templating import Jinja2Templates
 from itsdangerous import URLSafeTimedSerializer
@@ -37,6 +38,7 @@ SECRET_KEY = os.environ.get('SECRET_KEY') or (_ for _ in ()).throw(
 )
 
 WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # bearer token for /api/admin/*; unset = disabled
 
 INSTANCE_ROLE = os.environ.get("INSTANCE_ROLE", DEFAULT_INSTANCE_ROLE)
 
@@ -53,6 +55,8 @@ APP_URL = os.environ.get("APP_URL", "")
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'DATA', 'UPLOADS')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+STATIC_FOLDER = os.path.join(BASE_DIR, 'DATA', 'STATIC')  # fingerprinted assets (static_assets.py)
+IMAGE_FOLDER = os.path.join(BASE_DIR, 'DATA', 'IMAGES')  # resized image variants (image_router.py)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'mp4', 'webm', 'mov'}
 MAX_TASK_TEXT_LENGTH = 2000
@@ -178,7 +182,7 @@ def init_db():
         existing_cols = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
         for col in ['scheduled_start', 'scheduled_end', 'google_event_id', 'completed_at',
                     'parent_id', 'recurrence_rule', 'recurrence_source_id',
-                    'is_gcal_sourced', 'description']:
+                    'is_gcal_sourced', 'description', 'gcal_etag', 'materialized_until']:
             if col not in existing_cols:
                 default = ' DEFAULT 0' if col == 'is_gcal_sourced' else ''
                 conn.execute(f'ALTER TABLE tasks ADD COLUMN {col} TEXT{default}')
@@ -201,19 +205,87 @@ def init_db():
                 last_sync_at TEXT,
                 FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE);
             CREATE INDEX IF NOT EXISTS idx_tasks_google_event ON tasks(google_event_id);
+            CREATE INDEX IF NOT EXISTS idx_tasks_recurrence_source ON tasks(recurrence_source_id);
             CREATE TABLE IF NOT EXISTS gcal_deleted_events (
                 user_id INTEGER NOT NULL,
                 google_event_id TEXT NOT NULL,
                 deleted_at TEXT DEFAULT CURRENT_TIMESTAMP,
                 UNIQUE(user_id, google_event_id)
             );
+            CREATE TABLE IF NOT EXISTS gcal_outbox (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                task_id TEXT NOT NULL,
+                op TEXT NOT NULL,
+                google_event_id TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+            CREATE INDEX IF NOT EXISTS idx_gcal_outbox_user ON gcal_outbox(user_id, next_attempt_at);
+            CREATE TABLE IF NOT EXISTS gcal_series (
+                user_id INTEGER NOT NULL,
+                google_event_id TEXT NOT NULL,
+                rule TEXT,
+                exdates TEXT,
+                dtstart TEXT NOT NULL,
+                dtend TEXT NOT NULL,
+                time_zone TEXT,
+                summary TEXT,
+                description TEXT,
+                etag TEXT,
+                materialized_until TEXT,
+                UNIQUE(user_id, google_event_id));
+            CREATE TABLE IF NOT EXISTS leader_lease (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                acquired_at REAL);
+            CREATE TABLE IF NOT EXISTS ics_feeds (
+                user_id INTEGER PRIMARY KEY,
+                token TEXT UNIQUE NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE);
+            CREATE INDEX IF NOT EXISTS idx_tasks_user_start ON tasks(user_id, scheduled_start, id);
+            CREATE INDEX IF NOT EXISTS idx_task_media_filename ON task_media(filename);
         ''')
 
+        # Per-user change stamp, bumped by every write that can change the
+        # calendar feed (ics_router) — whichever code path makes it
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS task_stamps (
+                user_id INTEGER PRIMARY KEY,
+                stamp INTEGER NOT NULL DEFAULT 0,
+                changed_at TEXT)
+        ''')
+        bump = '''
+            INSERT OR IGNORE INTO task_stamps (user_id) VALUES ({row}.user_id);
+            UPDATE task_stamps SET stamp = stamp + 1,
+                changed_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
+            WHERE user_id = {row}.user_id;
+        '''
+        for name, event, row in [
+            ('tasks_stamp_insert', 'INSERT', 'NEW'),
+            ('tasks_stamp_update', 'UPDATE OF text, description, scheduled_start, scheduled_end, '
+                                   'completed_at, parent_id, recurrence_rule, recurrence_source_id',
+             'NEW'),
+            ('tasks_stamp_delete', 'DELETE', 'OLD'),
+        ]:
+            conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON tasks '
+                         f'BEGIN {bump.format(row=row)} END')
+
         # google_tokens: add watch columns
         gt_cols = {row[1] for row in conn.execute("PRAGMA table_info(google_tokens)")}
         for col in ['watch_channel_id', 'watch_resource_id', 'watch_expiration']:
             if col not in gt_cols:
                 conn.execute(f'ALTER TABLE google_tokens ADD COLUMN {col} TEXT')
+        if 'replica_sync_token' not in gt_cols:
+            conn.execute('ALTER TABLE google_tokens ADD COLUMN replica_sync_token TEXT')
+        for col in ['last_active_at', 'last_edit_at', 'push_pending_at']:
+            if col not in gt_cols:
+                conn.execute(f'ALTER TABLE google_tokens ADD COLUMN {col} REAL')
+        # gcal_helpers: webhooks (any worker) flag users for the leader's scheduler
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_google_tokens_push ON google_tokens(push_pending_at) '
+                     'WHERE push_pending_at IS NOT NULL')
 
         # user_progress: drum_view, task_bg
         up_cols = {row[1] for row in conn.execute("PRAGMA table_info(user_progress)")}
@@ -222,6 +294,58 @@ def init_db():
         if 'task_bg' not in up_cols:
             conn.execute('ALTER TABLE user_progress ADD COLUMN task_bg INTEGER DEFAULT 0')
 
+        # task_media: thumbnails (media_pipeline.py)
+        tm_cols = {row[1] for row in conn.execute("PRAGMA table_info(task_media)")}
+        if 'thumb_filename' not in tm_cols:
+            conn.execute('ALTER TABLE task_media ADD COLUMN thumb_filename TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_task_media_thumb ON task_media(thumb_filename)')
+
+        # media_blobs: content-addressed files (media_store.py); refcount =
+        # task_media rows using the file, kept by triggers on every path
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS media_blobs (
+                sha256 TEXT PRIMARY KEY,
+                filename TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP);
+            CREATE TRIGGER IF NOT EXISTS task_media_ref_insert AFTER INSERT ON task_media BEGIN
+                UPDATE media_blobs SET refcount = refcount + 1 WHERE filename = NEW.filename;
+            END;
+            CREATE TRIGGER IF NOT EXISTS task_media_ref_delete AFTER DELETE ON task_media BEGIN
+                UPDATE media_blobs SET refcount = refcount - 1 WHERE filename = OLD.filename;
+            END;
+            CREATE TRIGGER IF NOT EXISTS task_media_ref_update AFTER UPDATE OF filename ON task_media BEGIN
+                UPDATE media_blobs SET refcount = refcount - 1 WHERE filename = OLD.filename;
+                UPDATE media_blobs SET refcount = refcount + 1 WHERE filename = NEW.filename;
+            END;
+        ''')
+
+        # media_trash: files for the reaper to unlink (media_store.reap), queued
+        # when a blob loses its last reference. Foreign keys are not enforced,
+        # so task_media's ON DELETE CASCADE is done by a trigger instead.
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS media_trash (
+                filename TEXT PRIMARY KEY,
+                queued_at TEXT DEFAULT CURRENT_TIMESTAMP);
+            CREATE TRIGGER IF NOT EXISTS media_blobs_unreferenced AFTER UPDATE OF refcount ON media_blobs
+            WHEN NEW.refcount <= 0 BEGIN
+                INSERT OR IGNORE INTO media_trash (filename) VALUES (NEW.filename);
+            END;
+            CREATE TRIGGER IF NOT EXISTS tasks_media_delete AFTER DELETE ON tasks BEGIN
+                DELETE FROM task_media WHERE task_id = OLD.id;
+            END;
+        ''')
+
+        # ai_cache: second tier of the task breakdown cache (ai_service.py)
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS ai_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS idx_ai_cache_created ON ai_cache(created_at);
+        ''')
+
         # activity_log: task_id
         al_cols = {row[1] for row in conn.execute("PRAGMA table_info(activity_log)")}
         if 'task_id' not in al_cols:
@@ -231,16 +355,19 @@ def init_db():
         conn.execute("UPDATE tasks SET scheduled_start = created_at WHERE scheduled_start IS NULL")
         conn.execute("UPDATE tasks SET scheduled_end = created_at WHERE scheduled_end IS NULL")
 
-        # One-time cleanup of orphaned local recurrence instances
+        # Uncompleted recurrence instances whose series task is gone
         cleanup = conn.execute(
-            "DELETE FROM tasks WHERE recurrence_source_id IS NOT NULL "
-            "AND google_event_id IS NULL AND completed_at IS NULL"
+            "DELETE FROM tasks WHERE recurrence_source_id IS NOT NULL AND completed_at IS NULL "
+            "AND recurrence_source_id NOT IN (SELECT id FROM tasks)"
         )
         if cleanup.rowcount:
             logger.info('Removed %d orphaned local recurrence instances', cleanup.rowcount)
 
         conn.commit()
 
+    from BACKEND.media_store import migrate_flat_uploads
+    migrate_flat_uploads()
+
 
 # ============== Authentication dependencies ==============
 
@@ -276,6 +403,17 @@ async def get_token_authenticated_user(request: Request) -> int:
         return token_row['user_id']
 
 
+def admin_auth_error(request: Request):
+    """None if the request carries ADMIN_TOKEN as its bearer token, else the
+    response to return (404 while no ADMIN_TOKEN is configured, 403 otherwise)."""
+    if not ADMIN_TOKEN:
+        return Response(status_code=404)
+    auth = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(auth.encode(), f'Bearer {ADMIN_TOKEN}'.encode()):
+        return error_response('Forbidden', 403)
+    return None
+
+
 # ============== Validators ==============
 
 def validate_task_text(data):
@@ -212,6 +212,22 @@ async def api_friends_feed(request: Request, user_id: int = Depends(get_authenti
         has_more = len(feed) > limit
         feed = feed[:limit]
 
+        # Thumbnails are made after upload, so look them up now rather than
+        # when the activity was logged
+        media_urls = {
+            json.loads(f['extra_data']).get('media_url') for f in feed if f['extra_data']
+        } - {None}
+        thumbs = {}
+        if media_urls:
+            names = [url.removeprefix('/UPLOADS/') for url in media_urls]  # ab/cd/<sha>.ext
+            thumbs = {
+                f"/UPLOADS/{m['filename']}": f"/UPLOADS/{m['thumb_filename']}"
+                for m in conn.execute(
+                    f"SELECT filename, thumb_filename FROM task_media WHERE filename IN ({','.join('?' * len(names))}) "
+                    'AND thumb_filename IS NOT NULL', names,
+                )
+            }
+
         result = []
         for f in feed:
             item = {
@@ -225,6 +241,7 @@ async def api_friends_feed(request: Request, user_id: int = Depends(get_authenti
                 extra = json.loads(f['extra_data'])
                 item['media_type'] = extra.get('media_type')
                 item['media_url'] = extra.get('media_url')
+                item['thumb_url'] = thumbs.get(item['media_url'])
             result.append(item)
 
         return JSONResponse({'feed': result, 'has_more': has_more})
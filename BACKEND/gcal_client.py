@@ -0,0 +1,321 @@
+"""Async HTTP client for the Google Calendar v3 API.
+
+Every Calendar call in the process goes through one pooled httpx.AsyncClient
+(HTTP/2 when the h2 package is installed), so calls reuse keep-alive
+connections instead of paying a thread and a fresh socket each. A
+CalendarSession holds one user's tokens and refreshes the access token
+without blocking the event loop. request() and batch() retry 429, rate-limit
+403 and 5xx responses with jittered exponential backoff (honouring
+Retry-After). The Calendar operations themselves live in google_calendar.py.
+"""
+
+import re
+import json
+import uuid
+import random
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from BACKEND.core import logger, get_db, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET
+from BACKEND.gcal_metrics import metrics
+
+try:
+    import h2  # noqa: F401 — httpx only speaks HTTP/2 with this installed
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+API_URL = 'https://www.googleapis.com/calendar/v3'
+BATCH_URL = 'https://www.googleapis.com/batch/calendar/v3'
+TOKEN_URL = 'https://oauth2.googleapis.com/token'
+
+MAX_RETRIES = 4
+RETRY_BASE = 0.5        # seconds; doubled per attempt, plus jitter
+RETRY_MAX = 30
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+RATE_LIMIT_REASONS = frozenset(('rateLimitExceeded', 'userRateLimitExceeded'))
+EXPIRY_MARGIN = 60      # refresh access tokens this many seconds before they lapse
+MAX_CONNECTIONS = 20
+
+
+class CalendarError(Exception):
+    """A Calendar/OAuth call failed. status is the HTTP status (0 = transport error)."""
+
+    def __init__(self, status, message=''):
+        super().__init__(f'{status} {message}'.strip())
+        self.status = status
+
+    @property
+    def gone(self):
+        """The event no longer exists on Google's side."""
+        return self.status in (404, 410)
+
+
+class TokenRevoked(CalendarError):
+    """The refresh token was revoked or has expired (invalid_grant)."""
+
+
+# ============== Shared client ==============
+
+_client = None
+_transport = None
+
+
+def set_gcal_transport(transport=None):
+    """Send Calendar traffic through an httpx transport instead of the network.
+
+    Used by the benchmarks with TOOLS/fake_gcal.py; None restores the network.
+    """
+    global _client, _transport
+    _transport = transport
+    _client = None
+
+
+def http_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=HTTP2,
+            transport=_transport,
+            timeout=httpx.Timeout(20.0, connect=5.0),
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                max_keepalive_connections=MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_http_client():
+    """Close pooled connections (app shutdown)."""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.aclose()
+
+
+def _utcnow():
+    # Stored expiries are naive UTC, as google-auth writes them
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _retry_delay(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX)
+        except ValueError:
+            pass
+    return min(RETRY_BASE * 2 ** attempt, RETRY_MAX) * random.uniform(0.5, 1.0)
+
+
+def _error_info(resp):
+    """(reason, message) from a Google error body, best effort."""
+    try:
+        error = resp.json().get('error')
+    except ValueError:
+        return '', resp.text[:200]
+    if isinstance(error, str):  # OAuth endpoint: {"error": "invalid_grant", ...}
+        return error, error
+    error = error or {}
+    reasons = [e.get('reason', '') for e in error.get('errors', [])]
+    return (reasons[0] if reasons else ''), error.get('message', '')
+
+
+def _retryable(status, reason=''):
+    return status in RETRY_STATUSES or (status == 403 and reason in RATE_LIMIT_REASONS)
+
+
+# ============== Sessions ==============
+
+class CalendarSession:
+    """One user's Calendar credentials, shared by every coroutine working for them."""
+
+    def __init__(self, user_id, calendar_id, access_token, refresh_token, expiry):
+        self.user_id = user_id
+        self.calendar_id = calendar_id or 'primary'
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expiry = expiry
+        self._refresh_lock = asyncio.Lock()
+
+    @classmethod
+    def from_row(cls, user_id, row):
+        expiry = None
+        if row['token_expiry']:
+            try:
+                expiry = datetime.fromisoformat(row['token_expiry']).replace(tzinfo=None)
+            except ValueError:
+                pass
+        return cls(user_id, row['calendar_id'], row['access_token'], row['refresh_token'], expiry)
+
+    def expires_within(self, seconds):
+        return self.expiry is not None and self.expiry - _utcnow() < timedelta(seconds=seconds)
+
+    async def refresh(self, stale_token=None):
+        """Exchange the refresh token for a new access token and store it.
+
+        Concurrent callers that saw the same stale token share one refresh.
+        Raises TokenRevoked when Google rejects the grant.
+        """
+        async with self._refresh_lock:
+            if stale_token is not None and self.access_token != stale_token:
+                return
+            if not self.refresh_token:
+                metrics.inc('token_refresh_failures', self.user_id)
+                raise TokenRevoked(401, 'no refresh token')
+            metrics.inc('token_refreshes', self.user_id)
+            data = {
+                'grant_type': 'refresh_token', 'refresh_token': self.refresh_token,
+                'client_id': GOOGLE_CLIENT_ID, 'client_secret': GOOGLE_CLIENT_SECRET,
+            }
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    resp = await http_client().post(TOKEN_URL, data=data)
+                except httpx.TransportError as e:
+                    if attempt == MAX_RETRIES:
+                        metrics.inc('token_refresh_failures', self.user_id)
+                        raise CalendarError(0, str(e)) from e
+                    await asyncio.sleep(_retry_delay(attempt))
+                    continue
+                if _retryable(resp.status_code) and attempt < MAX_RETRIES:
+                    await asyncio.sleep(_retry_delay(attempt, resp.headers.get('retry-after')))
+                    continue
+                break
+            reason, message = _error_info(resp) if resp.status_code >= 400 else ('', '')
+            if resp.status_code >= 400:
+                metrics.inc('token_refresh_failures', self.user_id)
+            if reason == 'invalid_grant':
+                raise TokenRevoked(resp.status_code, 'invalid_grant')
+            if resp.status_code >= 400:
+                raise CalendarError(resp.status_code, message)
+
+            payload = resp.json()
+            self.access_token = payload['access_token']
+            self.expiry = _utcnow() + timedelta(seconds=int(payload.get('expires_in', 3600)))
+            await asyncio.to_thread(self._store)
+
+    def _store(self):
+        with get_db() as conn:
+            conn.execute(
+                'UPDATE google_tokens SET access_token = ?, token_expiry = ? WHERE user_id = ?',
+                (self.access_token, self.expiry.isoformat(), self.user_id),
+            )
+            conn.commit()
+
+
+# ============== Requests ==============
+
+async def request(session, method, url, *, params=None, json_body=None,
+                  content=None, headers=None, raw=False, refresh=True):
+    """Authorized call with retries. Returns the decoded JSON body (None if empty),
+    or the httpx.Response when raw=True. Raises CalendarError on failure.
+
+    Tokens are normally kept fresh by gcal_tokens.py; refresh=True lets a
+    background caller refresh itself if it got there first. Request paths
+    pass refresh=False and never wait on the token endpoint.
+    """
+    if refresh and session.expires_within(EXPIRY_MARGIN):
+        await session.refresh(session.access_token)
+    refreshed = not refresh
+    attempt = 0
+    while True:
+        token = session.access_token
+        metrics.inc('api_calls', session.user_id)
+        try:
+            resp = await http_client().request(
+                method, url, params=params, json=json_body, content=content,
+                headers={**(headers or {}), 'Authorization': f'Bearer {token}'},
+            )
+        except httpx.TransportError as e:
+            metrics.inc('api_errors', session.user_id)
+            if attempt >= MAX_RETRIES:
+                raise CalendarError(0, str(e)) from e
+            metrics.inc('api_retries', session.user_id)
+            await asyncio.sleep(_retry_delay(attempt))
+            attempt += 1
+            continue
+
+        status = resp.status_code
+        if status == 401 and not refreshed:
+            # Expired early or revoked; one refresh decides which
+            refreshed = True
+            await session.refresh(token)
+            continue
+        if status >= 400:
+            metrics.inc('api_errors', session.user_id)
+            reason, message = _error_info(resp)
+            if _retryable(status, reason) and attempt < MAX_RETRIES:
+                metrics.inc('api_retries', session.user_id)
+                await asyncio.sleep(_retry_delay(attempt, resp.headers.get('retry-after')))
+                attempt += 1
+                continue
+            raise CalendarError(status, message)
+        if raw:
+            return resp
+        return resp.json() if resp.content else None
+
+
+async def batch(session, calls):
+    """Send [(method, path, body), ...] as one batch request (path relative to API_URL).
+
+    The caller keeps len(calls) within the API's batch limit. Sub-requests
+    answered with 429/5xx are re-sent with backoff. Returns a list of
+    (status, payload) in call order; a failed batch call raises CalendarError.
+    """
+    results = [None] * len(calls)
+    pending = list(range(len(calls)))
+    for attempt in range(MAX_RETRIES + 1):
+        boundary = f'batch_{uuid.uuid4().hex}'
+        metrics.inc('batch_subrequests', session.user_id, len(pending))
+        resp = await request(
+            session, 'POST', BATCH_URL, raw=True,
+            content=_encode_batch(boundary, [(i, calls[i]) for i in pending]),
+            headers={'Content-Type': f'multipart/mixed; boundary={boundary}'},
+        )
+        parts = _decode_batch(resp)
+        retry = []
+        for i in pending:
+            status, payload = parts.get(str(i), (0, None))
+            results[i] = (status, payload)
+            if (_retryable(status) or status == 0) and attempt < MAX_RETRIES:
+                retry.append(i)
+        if not retry:
+            break
+        pending = retry
+        logger.info('Calendar batch: retrying %d sub-request(s)', len(retry))
+        await asyncio.sleep(_retry_delay(attempt))
+    return results
+
+
+def _encode_batch(boundary, items):
+    chunks = []
+    for key, (method, path, body) in items:
+        chunks.append(
+            f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <{key}>\r\n\r\n'
+            f'{method} /calendar/v3{path} HTTP/1.1\r\n'
+            + (f'Content-Type: application/json\r\n\r\n{json.dumps(body)}\r\n'
+               if body is not None else '\r\n')
+        )
+    return ''.join(chunks) + f'--{boundary}--\r\n'
+
+
+_CONTENT_ID = re.compile(r'^content-id:\s*<response-([^>]*)>', re.I | re.M)
+
+
+def _decode_batch(resp):
+    """{content_id: (status, payload)} from a multipart/mixed batch response."""
+    boundary = resp.headers.get('content-type', '').split('boundary=', 1)[-1].strip('"')
+    out = {}
+    for part in resp.text.replace('\r\n', '\n').split(f'--{boundary}'):
+        head, _, http_msg = part.strip('\n').partition('\n\n')
+        match = _CONTENT_ID.search(head)
+        if not match or not http_msg:
+            continue
+        status_line, _, rest = http_msg.partition('\n')
+        _headers, _, payload = rest.partition('\n\n')
+        try:
+            status = int(status_line.split(' ')[1])
+            out[match.group(1)] = (status, json.loads(payload) if payload.strip() else None)
+        except (IndexError, ValueError):
+            out[match.group(1)] = (0, None)
+    return out
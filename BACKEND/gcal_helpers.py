@@ -1,256 +1,860 @@
 """Google Calendar sync helpers.
 
-Pure functions used by both task routes (push local changes to gcal)
-and the background sync loop (pull remote changes). No routes here —
-those live in gcal_router.py.
+Pure functions used by both task routes (queue local changes for gcal,
+see gcal_outbox.py) and the background sync loop (pull remote changes).
+No routes here — those live in gcal_router.py.
 """
 
+import time
+import json
+import heapq
+import random
 import asyncio
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime, date, timedelta, timezone
 
-from SETTINGS import MAX_DESCRIPTION_LENGTH
+from SETTINGS import (
+    MAX_DESCRIPTION_LENGTH, GOOGLE_SESSION_CACHE_TTL, GOOGLE_TOKEN_REFRESH_AHEAD,
+    GOOGLE_CALENDAR_IDLE_SYNC_INTERVAL, GOOGLE_CALENDAR_SYNC_CONCURRENCY,
+    GOOGLE_CALENDAR_MAX_POLL_INTERVAL, GOOGLE_CALENDAR_EXPAND_RECURRING,
+)
 from BACKEND.core import (
-    logger, get_db, new_task_id,
-    GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_CALENDAR_ENABLED,
+    logger, get_db, new_task_id, GOOGLE_CALENDAR_ENABLED,
 )
+from BACKEND.gcal_metrics import metrics
+
+
+# ============== Session cache ==============
+
+# user_id -> (CalendarSession, loaded_at). Sessions are reused until the TTL
+# lapses, so the common path skips the token read; the session refreshes its
+# own access token. The TTL bounds how long other changes to the row (new
+# calendar, reconnect) go unnoticed. A token about to expire is re-read
+# sooner: the leader's refresher (gcal_tokens.py) has most likely replaced
+# it already, and picking that up saves this worker an inline refresh.
+_session_cache: dict[int, tuple] = {}
+
+
+def evict_gcal_session(user_id):
+    """Drop the cached session for a user (disconnect, revoked grant, new tokens)."""
+    _session_cache.pop(user_id, None)
+
 
+def gcal_session(conn, user_id):
+    """Return the user's CalendarSession, or None if not connected."""
+    entry = _session_cache.get(user_id)
+    if (entry and time.monotonic() - entry[1] <= GOOGLE_SESSION_CACHE_TTL
+            and not entry[0].expires_within(GOOGLE_TOKEN_REFRESH_AHEAD)):
+        return entry[0]
 
-def gcal_service(conn, user_id):
-    """Return (service, calendar_id) or (None, None) if not connected."""
-    from BACKEND.google_calendar import get_google_credentials, get_calendar_service
-    creds = get_google_credentials(conn, user_id, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET)
-    if not creds:
-        return None, None
-    service = get_calendar_service(creds)
-    cal_row = conn.execute(
-        'SELECT calendar_id FROM google_tokens WHERE user_id = ?', (user_id,)
+    from BACKEND.gcal_client import CalendarSession
+    row = conn.execute(
+        'SELECT access_token, refresh_token, token_expiry, calendar_id '
+        'FROM google_tokens WHERE user_id = ?', (user_id,),
     ).fetchone()
-    cal_id = cal_row['calendar_id'] if cal_row else 'primary'
-    return service, cal_id
+    if not row:
+        evict_gcal_session(user_id)
+        return None
+    session = CalendarSession.from_row(user_id, row)
+    if entry:
+        # Update the cached session in place: coroutines already holding it
+        # (and its refresh lock) get the new token too
+        cached = entry[0]
+        cached.calendar_id, cached.access_token = session.calendar_id, session.access_token
+        cached.refresh_token, cached.expiry = session.refresh_token, session.expiry
+        session = cached
+    _session_cache[user_id] = (session, time.monotonic())
+    return session
+
+
+def revoke_gcal_credentials(user_id):
+    """Forget a user's Google grant after Google rejected the refresh token."""
+    logger.warning('Expired Google token for user %d, removing credentials', user_id)
+    metrics.inc('grants_revoked')
+    metrics.forget(user_id)
+    evict_gcal_session(user_id)
+    with get_db() as conn:
+        conn.execute('DELETE FROM google_tokens WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM gcal_series WHERE user_id = ?', (user_id,))
+        conn.commit()
 
 
 def gcal_delete_tasks(conn, user_id, task_ids):
-    """Delete GCal events for given local task IDs and record them as deleted."""
+    """Queue GCal deletes for given local task IDs and record them as deleted."""
     if not GOOGLE_CALENDAR_ENABLED or not task_ids:
         return
+    from BACKEND.gcal_outbox import enqueue_gcal_op
     ph = ','.join('?' * len(task_ids))
     rows = conn.execute(
-        f'SELECT id, google_event_id FROM tasks WHERE id IN ({ph}) AND google_event_id IS NOT NULL',
-        task_ids,
+        f'SELECT id, google_event_id FROM tasks WHERE id IN ({ph}) AND user_id = ? '
+        'AND google_event_id IS NOT NULL',
+        list(task_ids) + [user_id],
     ).fetchall()
-    if not rows:
-        return
-    try:
-        service, cal_id = gcal_service(conn, user_id)
-        if service:
-            from BACKEND.google_calendar import delete_calendar_event
-            for r in rows:
-                try:
-                    delete_calendar_event(service, cal_id, r['google_event_id'])
-                except Exception:
-                    pass
-                conn.execute(
-                    'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
-                    (user_id, r['google_event_id']),
-                )
-    except Exception:
-        logger.error('Failed to sync task deletion to Google Calendar', exc_info=True)
+    for r in rows:
+        enqueue_gcal_op(conn, user_id, r['id'], 'delete', r['google_event_id'])
+        conn.execute(
+            'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
+            (user_id, r['google_event_id']),
+        )
 
 
-def process_sync_events(conn, user_id, events):
-    """Apply incoming gcal events to local tasks (create/update/delete)."""
-    from BACKEND.google_calendar import parse_event_times, strip_prefix
+_IN_CHUNK = 500  # stay well under SQLite's bound-parameter limit
 
-    for event in events:
-        event_id = event.get('id')
-        summary = event.get('summary', '')
-        status = event.get('status')
 
-        existing_task = conn.execute(
-            'SELECT id, text FROM tasks WHERE google_event_id = ? AND user_id = ?',
-            (event_id, user_id),
-        ).fetchone()
+def _select_in(conn, sql, user_id, keys):
+    """Run sql (user_id first, then an IN ({ph}) slot) over keys in chunks."""
+    keys = list(keys)
+    rows = []
+    for i in range(0, len(keys), _IN_CHUNK):
+        chunk = keys[i:i + _IN_CHUNK]
+        rows.extend(conn.execute(sql.format(ph=','.join('?' * len(chunk))), [user_id] + chunk))
+    return rows
 
-        if status == 'cancelled':
-            if existing_task:
-                conn.execute('DELETE FROM tasks WHERE id = ?', (existing_task['id'],))
-                conn.commit()
+
+def process_sync_events(conn, user_id, events):
+    """Apply incoming gcal events to local tasks (create/update/delete).
+
+    Existing tasks, recurrence parents and tombstones are prefetched with a
+    few IN queries and changes are written with executemany. Nothing is
+    committed here — the caller commits, together with the new sync token.
+    Events whose etag matches the one stored on the task are skipped.
+    Recurring masters (singleEvents=false) go to gcal_series instead of
+    becoming tasks; see materialize_series().
+    Returns {'inserted': n, 'updated': n, 'deleted': n, 'unchanged': n}.
+    """
+    from BACKEND.google_calendar import parse_event_times, strip_prefix
+
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    # Later copies of the same event win, as they did when applied one by one
+    by_id = {e['id']: e for e in events if e.get('id')}
+    if not by_id:
+        return counts
+
+    parent_ids = {e['recurringEventId'] for e in by_id.values() if e.get('recurringEventId')}
+    series_ids = _sync_series(conn, user_id, by_id, parent_ids)
+    local_ids, etags = {}, {}
+    for r in _select_in(
+        conn, 'SELECT id, google_event_id, gcal_etag FROM tasks WHERE user_id = ? '
+              'AND google_event_id IN ({ph})', user_id, by_id.keys() | parent_ids,
+    ):
+        local_ids[r['google_event_id']] = r['id']
+        etags[r['google_event_id']] = r['gcal_etag']
+    new_ids = [ev_id for ev_id, e in by_id.items()
+               if ev_id not in local_ids and e.get('status') != 'cancelled']
+    tombstones = {
+        r['google_event_id'] for r in _select_in(
+            conn, 'SELECT google_event_id FROM gcal_deleted_events WHERE user_id = ? '
+                  'AND google_event_id IN ({ph})', user_id, new_ids,
+        )
+    }
+
+    horizon = (datetime.utcnow() + timedelta(days=30)).isoformat() + 'Z'
+    deletes, updates, inserts, tombstoned = [], [], [], []
+    for event_id, event in by_id.items():
+        task_id = local_ids.get(event_id)
+        if event.get('status') == 'cancelled':
+            if task_id:
+                deletes.append((event_id, user_id))
+            if event.get('recurringEventId') in series_ids:
+                # Keep materialize_series() from re-creating a cancelled occurrence
+                tombstoned.append((user_id, event_id))
             continue
+        if event_id in series_ids and not task_id:
+            continue  # a recurring master from Google: its occurrences become the tasks
 
         start_iso, end_iso = parse_event_times(event)
-        text = strip_prefix(summary)
+        text = strip_prefix(event.get('summary', ''))
         description = (event.get('description') or '')[:MAX_DESCRIPTION_LENGTH] or None
-        recurring_event_id = event.get('recurringEventId')
         if not text:
             continue
 
-        # 30-day horizon for new events
-        if start_iso and not existing_task:
-            horizon = (datetime.utcnow() + timedelta(days=30)).isoformat() + 'Z'
-            if start_iso > horizon:
+        etag = event.get('etag')
+        if task_id:
+            if etag and etags.get(event_id) == etag:
+                counts['unchanged'] += 1
                 continue
+            updates.append([text, start_iso, end_iso, description, event.get('recurringEventId'),
+                            etag, task_id])
+        elif (start_iso and end_iso and event_id not in tombstones
+              and (start_iso <= horizon or event.get('recurringEventId') in series_ids)):
+            # Modified occurrences of an expanded series are kept whatever their
+            # date, or the series would later materialize the unmodified one
+            new_task, xp = new_task_id()
+            local_ids[event_id] = new_task
+            inserts.append([new_task, user_id, text, xp, start_iso, end_iso, event_id, '1',
+                            description, event.get('recurringEventId'), etag])
+
+    # Resolve recurrence parents last, so a parent inserted in this batch counts too
+    for row in updates:
+        row[4] = local_ids.get(row[4]) if row[4] else None
+    for row in inserts:
+        row[9] = local_ids.get(row[9]) if row[9] else None
+
+    if tombstoned:
+        conn.executemany(
+            'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
+            tombstoned,
+        )
+    if deletes:
+        counts['deleted'] = conn.executemany(
+            'DELETE FROM tasks WHERE google_event_id = ? AND user_id = ?', deletes,
+        ).rowcount
+    if updates:
+        conn.executemany(
+            'UPDATE tasks SET text = ?, scheduled_start = ?, scheduled_end = ?, '
+            'description = ?, recurrence_source_id = COALESCE(?, recurrence_source_id), '
+            'gcal_etag = ? WHERE id = ?', updates,
+        )
+        counts['updated'] = len(updates)
+    if inserts:
+        conn.executemany(
+            'INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, scheduled_end, '
+            'google_event_id, is_gcal_sourced, description, recurrence_source_id, gcal_etag) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', inserts,
+        )
+        counts['inserted'] = len(inserts)
+    return counts
+
+
+# ============== Recurring series ==============
 
-        # Resolve recurrence parent via google_event_id lookup
-        local_recurrence_source = None
-        if recurring_event_id:
-            parent_row = conn.execute(
-                'SELECT id FROM tasks WHERE google_event_id = ? AND user_id = ?',
-                (recurring_event_id, user_id),
-            ).fetchone()
-            if parent_row:
-                local_recurrence_source = parent_row['id']
-
-        if existing_task:
+# Occurrences materialized from a series carry this gcal_etag prefix (plus the
+# master's etag). A modified occurrence arrives from Google under the same
+# event id with its own etag and simply overwrites the materialized row.
+SERIES_ETAG_PREFIX = 'series:'
+# Sync tokens issued for a singleEvents=false listing are stored with this prefix
+SERIES_TOKEN_PREFIX = 'm:'
+
+
+def _instance_event_id(master_id, occurrence):
+    """The id Google gives an occurrence of a recurring event."""
+    if isinstance(occurrence, datetime):
+        return f'{master_id}_{occurrence.astimezone(timezone.utc):%Y%m%dT%H%M%SZ}'
+    return f'{master_id}_{occurrence:%Y%m%d}'
+
+
+def _instances_like(master_id):
+    """LIKE pattern (ESCAPE '\\') matching the occurrence ids of a master."""
+    return master_id + r'\_%'
+
+
+def _series_time(value, tz_name=None):
+    """A stored start/end ('YYYY-MM-DD' or RFC 3339) as a date or aware datetime."""
+    if len(value) <= 10:
+        return date.fromisoformat(value)
+    dt = datetime.fromisoformat(value)
+    if tz_name and dt.tzinfo is not None:
+        from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+        try:
+            dt = dt.astimezone(ZoneInfo(tz_name))
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return dt
+
+
+def _sync_series(conn, user_id, by_id, parent_ids):
+    """Store recurring masters from a singleEvents=false sync in gcal_series.
+
+    A master whose etag changed has its uncompleted materialized occurrences
+    from today on dropped and its watermark reset, so materialize_series()
+    rebuilds them. Cancelled masters, and masters that stopped recurring,
+    take their uncompleted occurrences with them. Returns the ids among
+    by_id and parent_ids that are stored series.
+    """
+    from BACKEND.recurrence import rrule_to_recurrence_rule
+
+    known = {
+        r['google_event_id']: r['etag'] for r in _select_in(
+            conn, 'SELECT google_event_id, etag FROM gcal_series WHERE user_id = ? '
+                  'AND google_event_id IN ({ph})', user_id, by_id.keys() | parent_ids,
+        )
+    }
+    upserts, dropped = [], []
+    for event_id, event in by_id.items():
+        if event.get('recurringEventId'):
+            continue
+        if event.get('status') == 'cancelled' or not event.get('recurrence'):
+            if event_id in known:
+                dropped.append(event_id)
+            continue
+        etag = event.get('etag')
+        if etag and known.get(event_id) == etag:
+            continue
+        start, end = event.get('start', {}), event.get('end', {})
+        dtstart = start.get('dateTime') or start.get('date')
+        dtend = end.get('dateTime') or end.get('date')
+        if not dtstart or not dtend:
+            continue
+        rule, exdates = rrule_to_recurrence_rule(event['recurrence'])
+        upserts.append((
+            user_id, event_id, json.dumps(rule) if rule else None,
+            json.dumps([x.isoformat() for x in exdates or []]), dtstart, dtend,
+            start.get('timeZone'), event.get('summary', ''),
+            (event.get('description') or '')[:MAX_DESCRIPTION_LENGTH] or None, etag,
+        ))
+
+    if dropped:
+        conn.executemany('DELETE FROM gcal_series WHERE user_id = ? AND google_event_id = ?',
+                         [(user_id, ev_id) for ev_id in dropped])
+        conn.executemany(
+            "DELETE FROM tasks WHERE user_id = ? AND google_event_id LIKE ? ESCAPE '\\' "
+            'AND completed_at IS NULL', [(user_id, _instances_like(ev_id)) for ev_id in dropped],
+        )
+    if upserts:
+        # Occurrence ids end in their UTC date, so the suffix compares as a date
+        today = datetime.now(timezone.utc).strftime('%Y%m%d')
+        conn.executemany(
+            "DELETE FROM tasks WHERE user_id = ? AND google_event_id LIKE ? ESCAPE '\\' "
+            'AND gcal_etag LIKE ? AND completed_at IS NULL AND substr(google_event_id, ?) >= ?',
+            [(user_id, _instances_like(u[1]), SERIES_ETAG_PREFIX + '%', len(u[1]) + 2, today)
+             for u in upserts],
+        )
+        conn.executemany(
+            'INSERT INTO gcal_series (user_id, google_event_id, rule, exdates, dtstart, dtend, '
+            'time_zone, summary, description, etag) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(user_id, google_event_id) DO UPDATE SET rule = excluded.rule, '
+            'exdates = excluded.exdates, dtstart = excluded.dtstart, dtend = excluded.dtend, '
+            'time_zone = excluded.time_zone, summary = excluded.summary, '
+            'description = excluded.description, etag = excluded.etag, materialized_until = NULL',
+            upserts,
+        )
+    return (known.keys() - set(dropped)) | {u[1] for u in upserts}
+
+
+def materialize_series(conn, user_id, until):
+    """Create task rows for a user's expanded series up to `until` (aware UTC).
+
+    Each series keeps a materialized_until watermark, so repeated calls only
+    expand the part of the window not covered yet, and nothing before the
+    start of today is ever materialized. Occurrences that already exist (a
+    modified occurrence synced from Google) or were cancelled are skipped;
+    for a series created in this app, the local task is the first occurrence.
+    Series recurrence.py cannot expand (rule IS NULL) are left to the
+    instances fetch in sync_user_calendar(). Nothing is committed here.
+    Returns the number of rows inserted.
+    """
+    from BACKEND.recurrence import occurrences, window_start
+    from BACKEND.google_calendar import strip_prefix
+
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')  # read watermarks under the write lock
+    until_iso = until.isoformat(timespec='seconds')
+    series = conn.execute(
+        'SELECT * FROM gcal_series WHERE user_id = ? AND rule IS NOT NULL '
+        'AND (materialized_until IS NULL OR materialized_until < ?)', (user_id, until_iso),
+    ).fetchall()
+    if not series:
+        return 0
+    local_masters = {
+        r['google_event_id']: r['id'] for r in _select_in(
+            conn, 'SELECT id, google_event_id FROM tasks WHERE user_id = ? '
+                  'AND google_event_id IN ({ph})', user_id, [s['google_event_id'] for s in series],
+        )
+    }
+
+    inserts, watermarks = [], []
+    for s in series:
+        watermarks.append((until_iso, user_id, s['google_event_id']))
+        text = strip_prefix(s['summary'])
+        if not text:
+            continue
+        try:
+            start = _series_time(s['dtstart'], s['time_zone'])
+            duration = _series_time(s['dtend'], s['time_zone']) - start
+            exdates = [_series_time(x) for x in json.loads(s['exdates'] or '[]')]
+        except (TypeError, ValueError):
+            logger.warning('Unreadable recurring event %s for user %d', s['google_event_id'], user_id)
+            continue
+        master_task = local_masters.get(s['google_event_id'])
+        if master_task and not s['materialized_until']:
+            # Google takes over a series recurrence.py expanded while it was local
             conn.execute(
-                'UPDATE tasks SET text = ?, scheduled_start = ?, scheduled_end = ?, '
-                'description = ?, recurrence_source_id = COALESCE(?, recurrence_source_id) '
-                'WHERE id = ?',
-                (text, start_iso, end_iso, description, local_recurrence_source, existing_task['id']),
+                'DELETE FROM tasks WHERE recurrence_source_id = ? AND user_id = ? '
+                'AND google_event_id IS NULL AND completed_at IS NULL', (master_task, user_id),
             )
-            conn.commit()
-        elif start_iso and end_iso:
-            was_deleted = conn.execute(
-                'SELECT 1 FROM gcal_deleted_events WHERE user_id=? AND google_event_id=?',
-                (user_id, event_id),
-            ).fetchone()
-            if was_deleted:
+        candidates = {
+            _instance_event_id(s['google_event_id'], occ): occ
+            for occ in occurrences(s['rule'], start, window_start(s['materialized_until']),
+                                   until, exdates)
+            if not (master_task and occ == start)
+        }
+        if not candidates:
+            continue
+        skip = {r[0] for r in _select_in(
+            conn, 'SELECT google_event_id FROM tasks WHERE user_id = ? '
+                  'AND google_event_id IN ({ph})', user_id, candidates.keys(),
+        )}
+        skip.update(r[0] for r in _select_in(
+            conn, 'SELECT google_event_id FROM gcal_deleted_events WHERE user_id = ? '
+                  'AND google_event_id IN ({ph})', user_id, candidates.keys() - skip,
+        ))
+        etag = SERIES_ETAG_PREFIX + (s['etag'] or '')
+        for event_id, occ in candidates.items():
+            if event_id in skip:
                 continue
+            new_task, xp = new_task_id()
+            inserts.append((new_task, user_id, text, xp, occ.isoformat(),
+                            (occ + duration).isoformat(), event_id, '1', s['description'],
+                            master_task, etag))
+
+    if inserts:
+        conn.executemany(
+            'INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, scheduled_end, '
+            'google_event_id, is_gcal_sourced, description, recurrence_source_id, gcal_etag) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', inserts,
+        )
+    conn.executemany(
+        'UPDATE gcal_series SET materialized_until = ? WHERE user_id = ? AND google_event_id = ?',
+        watermarks,
+    )
+    return len(inserts)
+
 
-            task_id, xp = new_task_id()
+async def sync_user_calendar(user_id, instance_role, webhook_url=''):
+    """Sync one user (see _sync_user_calendar), recording duration, events
+    fetched, failures and the last sync time in gcal_metrics."""
+    started = time.monotonic()
+    try:
+        fetched = await _sync_user_calendar(user_id, instance_role, webhook_url)
+    except Exception as e:
+        metrics.record_sync(user_id, time.monotonic() - started, error=e)
+        raise
+    if user_id in _session_cache:  # not disconnected or revoked meanwhile
+        metrics.record_sync(user_id, time.monotonic() - started, fetched)
+    return fetched
+
+
+async def _sync_user_calendar(user_id, instance_role, webhook_url):
+    """Sync one user: renew the watch channel if due, then pull changed events.
+
+    Reads the sync token fresh from the DB. Replicas keep their own token
+    (replica_sync_token), so they sync incrementally without disturbing the
+    primary's. With GOOGLE_CALENDAR_EXPAND_RECURRING, recurring events are
+    fetched once as a master and expanded locally up to
+    recurrence.horizon_until(). Revoked grants remove the stored
+    credentials; other errors propagate to the caller. Returns events fetched.
+    """
+    from BACKEND.google_calendar import sync_calendar_events, watch_calendar, stop_watch
+    from BACKEND.gcal_client import TokenRevoked
+    from BACKEND.recurrence import horizon_until
+
+    token_col = 'sync_token' if instance_role == 'primary' else 'replica_sync_token'
+    with get_db() as conn:
+        row = conn.execute(
+            f'SELECT {token_col} AS sync_token, watch_channel_id, watch_resource_id, '
+            'watch_expiration FROM google_tokens WHERE user_id = ?', (user_id,),
+        ).fetchone()
+        session = gcal_session(conn, user_id) if row else None
+    if not session:
+        return 0
+
+    try:
+        # Renew watch channel if push enabled
+        if webhook_url and instance_role == 'primary':
+            now_ms = int(datetime.now().timestamp() * 1000)
+            watch_exp = int(row['watch_expiration'] or 0)
+            if not row['watch_channel_id'] or watch_exp - now_ms < _watch_renew_margin_ms(user_id):
+                if row['watch_channel_id'] and row['watch_resource_id']:
+                    await stop_watch(session, row['watch_channel_id'], row['watch_resource_id'])
+                result = await watch_calendar(session, webhook_url)
+                if result:
+                    metrics.inc('watch_renewals', user_id)
+                    ch_id, res_id, exp_ms = result
+                    with get_db() as conn:
+                        conn.execute(
+                            'UPDATE google_tokens SET watch_channel_id=?, watch_resource_id=?, '
+                            'watch_expiration=? WHERE user_id=?',
+                            (ch_id, res_id, str(exp_ms), user_id),
+                        )
+                        conn.commit()
+                    logger.info('Registered calendar watch for user %d (expires %s)',
+                                user_id, datetime.fromtimestamp(exp_ms / 1000).isoformat())
+
+        # Sync tokens only work in the mode that issued them
+        expand = GOOGLE_CALENDAR_EXPAND_RECURRING
+        stored = row['sync_token'] or ''
+        sync_token = stored[len(SERIES_TOKEN_PREFIX):] if expand else stored
+        if stored.startswith(SERIES_TOKEN_PREFIX) != expand:
+            sync_token = None
+        events, new_token, _ = await sync_calendar_events(session, sync_token,
+                                                          single_events=not expand)
+    except TokenRevoked:
+        revoke_gcal_credentials(user_id)
+        return 0
+
+    until = horizon_until()
+    with get_db() as conn:
+        if not sync_token and not expand:
+            conn.execute('DELETE FROM gcal_series WHERE user_id = ?', (user_id,))
+        counts = process_sync_events(conn, user_id, events)
+        counts['inserted'] += materialize_series(conn, user_id, until)
+        if new_token:
             conn.execute(
-                'INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, scheduled_end, '
-                'google_event_id, is_gcal_sourced, description, recurrence_source_id) '
-                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                (task_id, user_id, text, xp, start_iso, end_iso, event_id, '1',
-                 description, local_recurrence_source),
+                f'UPDATE google_tokens SET {token_col} = ?, last_sync_at = ? WHERE user_id = ?',
+                ((SERIES_TOKEN_PREFIX if expand else '') + new_token,
+                 datetime.now().isoformat(), user_id),
+            )
+        conn.commit()
+        unexpanded = conn.execute(
+            'SELECT google_event_id, materialized_until FROM gcal_series WHERE user_id = ? '
+            'AND rule IS NULL AND (materialized_until IS NULL OR materialized_until < ?)',
+            (user_id, until.isoformat(timespec='seconds')),
+        ).fetchall() if expand else []
+
+    for series in unexpanded:
+        try:
+            instances = await _fetch_instances(session, series, until)
+        except TokenRevoked:
+            revoke_gcal_credentials(user_id)
+            break
+        if instances is None:
+            continue
+        with get_db() as conn:
+            more = process_sync_events(conn, user_id, instances)
+            conn.execute(
+                'UPDATE gcal_series SET materialized_until = ? '
+                'WHERE user_id = ? AND google_event_id = ?',
+                (until.isoformat(timespec='seconds'), user_id, series['google_event_id']),
             )
             conn.commit()
+        for key in counts:
+            counts[key] += more[key]
 
+    metrics.inc('events_fetched', user_id, len(events))
+    metrics.inc('events_applied', user_id, counts['inserted'] + counts['updated'] + counts['deleted'])
+    if any(counts.values()):
+        logger.info('Calendar sync for user %d: %d inserted, %d updated, %d deleted',
+                    user_id, counts['inserted'], counts['updated'], counts['deleted'])
+    return len(events)
 
-async def do_calendar_sync_for_user(user_id, sync_token, calendar_id, instance_role):
-    """Incremental sync for a single user (triggered by push notification)."""
-    from BACKEND.google_calendar import (
-        get_google_credentials, get_calendar_service, sync_calendar_events,
-    )
+
+async def _fetch_instances(session, series, until):
+    """Google's expansion of a series recurrence.py cannot expand, from the
+    watermark (or today) to until. Returns None if the call failed."""
+    from BACKEND.google_calendar import list_event_instances
+    from BACKEND.gcal_client import CalendarError, TokenRevoked
+    from BACKEND.recurrence import window_start
+
+    since = window_start(series['materialized_until'])
     try:
-        with get_db() as conn:
-            creds = get_google_credentials(conn, user_id, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET)
-            if not creds:
-                return
-
-        service = await asyncio.to_thread(get_calendar_service, creds)
-        effective_token = None if instance_role != 'primary' else sync_token
-        events, new_token, _ = await asyncio.to_thread(
-            sync_calendar_events, service, calendar_id, effective_token
-        )
+        return await list_event_instances(session, series['google_event_id'],
+                                          since.isoformat(), until.isoformat())
+    except TokenRevoked:
+        raise
+    except CalendarError:
+        logger.warning('Failed to list instances of %s for user %d',
+                       series['google_event_id'], session.user_id, exc_info=True)
+        return None
 
-        if not events and not new_token:
-            return
 
-        with get_db() as conn:
-            process_sync_events(conn, user_id, events)
-            if new_token and instance_role == 'primary':
-                conn.execute(
-                    'UPDATE google_tokens SET sync_token = ?, last_sync_at = ? WHERE user_id = ?',
-                    (new_token, datetime.now().isoformat(), user_id),
-                )
-                conn.commit()
-    except Exception:
-        logger.error('Calendar push sync failed for user %d', user_id, exc_info=True)
+# ============== Push notifications ==============
+
+PUSH_DEBOUNCE = 1.5       # seconds a push waits for the rest of Google's notification burst
+PUSH_POLL_INTERVAL = 1.0  # how often the scheduler looks for pushes received by any worker
 
+_push_stats = {'notifications': 0}
 
-async def do_calendar_sync(instance_role, app_url):
-    """One round of background sync + watch channel management."""
-    from BACKEND.google_calendar import (
-        get_google_credentials, get_calendar_service, sync_calendar_events,
-        watch_calendar, stop_watch,
+
+def request_push_sync(conn, user_id):
+    """Webhook entry point: flag the user for the leader's scheduler.
+
+    Syncs only run in the leader, one per user at a time, so a push cannot
+    race a scheduled sync over the sync token, whichever worker received
+    the webhook. The earliest pending notification is kept: a burst is one
+    sync, started PUSH_DEBOUNCE after its first notification, and those
+    arriving while that sync runs get exactly one follow-up.
+    """
+    conn.execute(
+        'UPDATE google_tokens SET push_pending_at = COALESCE(push_pending_at, ?) WHERE user_id = ?',
+        (time.time(), user_id),
     )
+    conn.commit()
+    _push_stats['notifications'] += 1
+    metrics.inc('webhook_notifications', user_id)
 
-    webhook_url = (app_url.rstrip('/') + '/api/google/webhook') if app_url and instance_role == 'primary' else ''
 
-    with get_db() as conn:
-        users = conn.execute(
-            'SELECT user_id, sync_token, calendar_id, watch_channel_id, watch_resource_id, watch_expiration FROM google_tokens'
-        ).fetchall()
+# ============== Background sync scheduler ==============
 
-    now_ms = int(datetime.now().timestamp() * 1000)
+ACTIVE_WINDOW = 300               # seconds since the last /api/state hit that count as active
+ACTIVE_WRITE_THROTTLE = 60        # persist last_active_at at most this often per user
+USER_RELOAD_INTERVAL = 30         # how often the scheduler re-reads google_tokens
+WATCH_RENEW_MARGIN_MS = 3600_000
+WATCH_RENEW_JITTER_MS = 12 * 3600_000
 
-    for user_row in users:
-        user_id = user_row['user_id']
-        sync_token = user_row['sync_token']
-        calendar_id = user_row['calendar_id'] or 'primary'
+_last_active: dict[int, float] = {}
+_last_active_written: dict[int, float] = {}
+_last_edit: dict[int, float] = {}
+_scheduler = None
 
-        try:
-            with get_db() as conn:
-                creds = get_google_credentials(conn, user_id, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET)
-                if not creds:
-                    continue
-
-            service = await asyncio.to_thread(get_calendar_service, creds)
-
-            # Renew watch channel if push enabled
-            if webhook_url and instance_role == 'primary':
-                watch_exp = int(user_row['watch_expiration'] or 0)
-                if not user_row['watch_channel_id'] or watch_exp - now_ms < 3600_000:
-                    if user_row['watch_channel_id'] and user_row['watch_resource_id']:
-                        await asyncio.to_thread(
-                            stop_watch, service, user_row['watch_channel_id'], user_row['watch_resource_id']
-                        )
-                    result = await asyncio.to_thread(watch_calendar, service, calendar_id, webhook_url)
-                    if result:
-                        ch_id, res_id, exp_ms = result
-                        with get_db() as conn:
-                            conn.execute(
-                                'UPDATE google_tokens SET watch_channel_id=?, watch_resource_id=?, '
-                                'watch_expiration=? WHERE user_id=?',
-                                (ch_id, res_id, str(exp_ms), user_id),
-                            )
-                            conn.commit()
-                        logger.info('Registered calendar watch for user %d (expires %s)',
-                                    user_id, datetime.fromtimestamp(exp_ms / 1000).isoformat())
-
-            effective_token = None if instance_role != 'primary' else sync_token
-            events, new_token, _ = await asyncio.to_thread(
-                sync_calendar_events, service, calendar_id, effective_token
-            )
 
-            if not events and not new_token:
-                continue
+def _watch_renew_margin_ms(user_id):
+    """Renewal lead time with a stable per-user jitter, so channels registered
+    together do not all come up for renewal in the same round."""
+    return WATCH_RENEW_MARGIN_MS + random.Random(user_id).randrange(WATCH_RENEW_JITTER_MS)
+
+
+def mark_user_active(conn, user_id):
+    """Record a foreground hit so the scheduler syncs this user on the fast cadence.
+
+    Persisted (throttled) to google_tokens.last_active_at so the hint reaches
+    the scheduler even when it runs in another worker process.
+    """
+    now = time.time()
+    _last_active[user_id] = now
+    if _scheduler:
+        _scheduler.expedite(user_id)
+    if now - _last_active_written.get(user_id, 0) >= ACTIVE_WRITE_THROTTLE:
+        _last_active_written[user_id] = now
+        conn.execute('UPDATE google_tokens SET last_active_at = ? WHERE user_id = ?', (now, user_id))
+        conn.commit()
+
+
+def mark_local_edit(conn, user_id):
+    """Record a local task change (in the caller's transaction).
 
+    A polling scheduler resets its quiet-calendar backoff for the user, so
+    the echo of the edit and any follow-up remote changes arrive quickly.
+    """
+    now = time.time()
+    _last_edit[user_id] = now
+    conn.execute('UPDATE google_tokens SET last_edit_at = ? WHERE user_id = ?', (now, user_id))
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return  # worker thread: the scheduler picks the edit up from the DB
+    if _scheduler:
+        _scheduler.on_local_edit(user_id)
+
+
+def calendar_sync_stats():
+    """Snapshot of the scheduler, push and token-refresh counters for this process."""
+    from BACKEND.gcal_tokens import token_refresh_stats
+    return {
+        'scheduler': _scheduler.snapshot() if _scheduler else None,
+        'push': dict(_push_stats),
+        'tokens': token_refresh_stats(),
+    }
+
+
+class CalendarSyncScheduler:
+    """Per-user next-due times in a min-heap, synced with bounded concurrency.
+
+    Runs in the leader only, so it is the one place a user is ever synced.
+    Active users are re-queued after active_interval, idle ones after
+    idle_interval; a user flagged by a push notification is due
+    PUSH_DEBOUNCE after it, ahead of the rest. Without push notifications, every sync that fetches
+    nothing doubles the user's interval (up to max_interval) and a local
+    edit resets it. Heap entries whose due time no longer matches _due are
+    stale (rescheduled or disconnected) and skipped when popped.
+    """
+
+    def __init__(self, instance_role, app_url, active_interval, idle_interval, concurrency,
+                 max_interval=None):
+        self.instance_role = instance_role
+        self.webhook_url = (
+            app_url.rstrip('/') + '/api/google/webhook'
+            if app_url and instance_role == 'primary' else ''
+        )
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.concurrency = concurrency
+        self.max_interval = max(max_interval or idle_interval, idle_interval)
+        self._quiet: dict[int, int] = {}
+        self._edits_seen: dict[int, float] = {}
+        self._pushed: dict[int, float] = {}  # user_id -> push_pending_at to clear on its next sync
+        self._heap = []
+        self._due = {}
+        self._running = set()
+        self._tasks = set()  # in-flight workers, owned so run() can cancel them
+        self._loaded_at = 0.0
+        self._pushes_at = 0.0
+        self._durations = deque(maxlen=200)
+        self.stats = {'cycles': 0, 'synced': 0, 'failed': 0, 'events': 0, 'push_syncs': 0,
+                      'last_cycle': None}
+
+    def _schedule(self, user_id, due):
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+
+    def _is_active(self, user_id):
+        return time.time() - _last_active.get(user_id, 0) < ACTIVE_WINDOW
+
+    def expedite(self, user_id):
+        """Pull an idle user's next sync forward to the active cadence."""
+        due = self._due.get(user_id)
+        soon = time.time() + self.active_interval
+        if due is not None and due > soon:
+            self._schedule(user_id, soon)
+
+    def _pull_forward(self, user_id, due):
+        # A running user is re-queued when its sync ends; scheduling it now would run it twice
+        if user_id in self._running:
+            return
+        current = self._due.get(user_id)
+        if current is None or current > due:
+            self._schedule(user_id, due)
+
+    def _load_pushes(self):
+        with get_db() as conn:
+            rows = conn.execute(
+                'SELECT user_id, push_pending_at FROM google_tokens WHERE push_pending_at IS NOT NULL'
+            ).fetchall()
+        return [(r['user_id'], float(r['push_pending_at'])) for r in rows]
+
+    def _on_pushes(self, pushes):
+        for user_id, pending_at in pushes:
+            self._pushed[user_id] = pending_at
+            self._pull_forward(user_id, pending_at + PUSH_DEBOUNCE)
+
+    def _take_push(self, user_id):
+        """Clear the user's pending push (if any) before syncing; returns its time.
+
+        Only that exact flag is cleared: a notification arriving from here
+        on sets a new one, and so gets a sync of its own."""
+        pending_at = self._pushed.pop(user_id, None)
+        if pending_at is not None:
             with get_db() as conn:
-                process_sync_events(conn, user_id, events)
-                conn.execute(
-                    "DELETE FROM gcal_deleted_events WHERE deleted_at < datetime('now', '-90 days')"
-                )
+                conn.execute('UPDATE google_tokens SET push_pending_at = NULL '
+                             'WHERE user_id = ? AND push_pending_at = ?', (user_id, pending_at))
                 conn.commit()
-                if new_token and instance_role == 'primary':
-                    conn.execute(
-                        'UPDATE google_tokens SET sync_token = ?, last_sync_at = ? WHERE user_id = ?',
-                        (new_token, datetime.now().isoformat(), user_id),
-                    )
-                    conn.commit()
-
-        except Exception as e:
-            from google.auth.exceptions import RefreshError
-            if isinstance(e, RefreshError) or 'invalid_grant' in str(e):
-                logger.warning('Expired Google token for user %d, removing credentials', user_id)
-                with get_db() as conn:
-                    conn.execute('DELETE FROM google_tokens WHERE user_id = ?', (user_id,))
-                    conn.commit()
-            else:
-                logger.error('Calendar sync failed for user %d', user_id, exc_info=True)
+        return pending_at
+
+    def on_local_edit(self, user_id):
+        self._edits_seen[user_id] = max(self._edits_seen.get(user_id, 0), _last_edit.get(user_id, 0))
+        self._quiet.pop(user_id, None)
+        self.expedite(user_id)
+
+    def _next_interval(self, user_id, fetched):
+        base = self.active_interval if self._is_active(user_id) else self.idle_interval
+        if self.webhook_url or fetched is None:
+            return base
+        quiet = 0 if fetched else min(self._quiet.get(user_id, 0) + 1, 10)
+        self._quiet[user_id] = quiet
+        return min(base * 2 ** quiet, self.max_interval)
+
+    def _load_users(self):
+        with get_db() as conn:
+            rows = conn.execute(
+                'SELECT user_id, last_active_at, last_edit_at FROM google_tokens'
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM gcal_deleted_events WHERE deleted_at < datetime('now', '-90 days')"
+            )
+            conn.commit()
+        ids = set()
+        for r in rows:
+            ids.add(r['user_id'])
+            if r['last_active_at']:
+                seen = float(r['last_active_at'])
+                if seen > _last_active.get(r['user_id'], 0):
+                    _last_active[r['user_id']] = seen
+            # Edits made through another worker process
+            if r['last_edit_at'] and float(r['last_edit_at']) > self._edits_seen.get(r['user_id'], 0):
+                if r['user_id'] in self._edits_seen:
+                    self._quiet.pop(r['user_id'], None)
+                    self.expedite(r['user_id'])
+                self._edits_seen[r['user_id']] = float(r['last_edit_at'])
+        now = time.time()
+        for user_id in ids - self._due.keys() - self._running:
+            # Spread first syncs over one active interval instead of a burst
+            self._schedule(user_id, now + random.uniform(0, self.active_interval))
+        for user_id in self._due.keys() - ids:
+            del self._due[user_id]
+            self._quiet.pop(user_id, None)
+            self._pushed.pop(user_id, None)
+
+    async def _run_user(self, user_id):
+        started = time.monotonic()
+        fetched = None
+        try:
+            pushed_at = await asyncio.to_thread(self._take_push, user_id)
+            fetched = await sync_user_calendar(user_id, self.instance_role, self.webhook_url)
+            self.stats['events'] += fetched or 0
+            self.stats['synced'] += 1
+            if pushed_at is not None:
+                self.stats['push_syncs'] += 1
+                metrics.observe('webhook_to_apply_s', time.time() - pushed_at, user_id)
+        except Exception:
+            self.stats['failed'] += 1
+            logger.error('Calendar sync failed for user %d', user_id, exc_info=True)
+        finally:
+            self._durations.append(time.monotonic() - started)
+            self._running.discard(user_id)
+            self._schedule(user_id, time.time() + self._next_interval(user_id, fetched))
+
+    def _dispatch_due(self):
+        now = time.time()
+        dispatched, max_lag = 0, 0.0
+        while self._heap and self._heap[0][0] <= now and len(self._running) < self.concurrency:
+            due, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) != due:
+                continue
+            del self._due[user_id]
+            self._running.add(user_id)
+            max_lag = max(max_lag, now - due)
+            task = asyncio.create_task(self._run_user(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            dispatched += 1
+        if dispatched:
+            self.stats['cycles'] += 1
+            self.stats['last_cycle'] = {
+                'at': datetime.now().isoformat(), 'dispatched': dispatched,
+                'max_lag_s': round(max_lag, 3), 'queued': len(self._due),
+                'in_flight': len(self._running),
+            }
+
+    def snapshot(self):
+        durations = sorted(self._durations)
+        return {
+            **self.stats,
+            'users': len(self._due) + len(self._running),
+            'in_flight': len(self._running),
+            'concurrency': self.concurrency,
+            'backed_off': sum(1 for q in self._quiet.values() if q),
+            'sync_p50_s': round(durations[len(durations) // 2], 3) if durations else None,
+            'sync_max_s': round(durations[-1], 3) if durations else None,
+        }
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    if time.time() - self._loaded_at >= USER_RELOAD_INTERVAL:
+                        self._loaded_at = time.time()
+                        await asyncio.to_thread(self._load_users)
+                    if time.time() - self._pushes_at >= PUSH_POLL_INTERVAL:
+                        self._pushes_at = time.time()
+                        self._on_pushes(await asyncio.to_thread(self._load_pushes))
+                    self._dispatch_due()
+                except Exception:
+                    logger.error('Calendar sync scheduler error', exc_info=True)
+                next_due = self._heap[0][0] if self._heap else time.time() + 1
+                await asyncio.sleep(min(max(next_due - time.time(), 0.05), 1.0))
+        finally:
+            # Cancelled (leadership lost): stop our workers too, or they would
+            # keep going alongside the new leader's
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
 
 
 async def calendar_sync_loop(instance_role, app_url, poll_interval):
     """Background loop: register/renew watch channels, poll events as fallback."""
+    global _scheduler
     if not GOOGLE_CALENDAR_ENABLED:
         return
     use_push = bool(app_url and instance_role == 'primary')
     interval = 300 if use_push else poll_interval
-    logger.warning('Calendar sync: role=%s, push=%s, interval=%ds', instance_role, use_push, interval)
-    while True:
-        try:
-            await do_calendar_sync(instance_role, app_url)
-        except Exception:
-            logger.error('Calendar sync loop error', exc_info=True)
-        await asyncio.sleep(interval)
+    idle_interval = max(interval, GOOGLE_CALENDAR_IDLE_SYNC_INTERVAL)
+    logger.warning('Calendar sync: role=%s, push=%s, interval=%ds, idle=%ds, concurrency=%d',
+                   instance_role, use_push, interval, idle_interval, GOOGLE_CALENDAR_SYNC_CONCURRENCY)
+    _scheduler = CalendarSyncScheduler(
+        instance_role, app_url, interval, idle_interval, GOOGLE_CALENDAR_SYNC_CONCURRENCY,
+        max_interval=GOOGLE_CALENDAR_MAX_POLL_INTERVAL,
+    )
+    try:
+        await _scheduler.run()
+    finally:
+        # Cancelled on loss of leadership
+        _scheduler = None
@@ -0,0 +1,183 @@
+"""In-process counters and histograms for Google Calendar sync.
+
+Kept per user and in aggregate, in plain dicts: recording is a few dict
+operations, cheap enough for every API call. Numbers cover this process
+only — background sync runs in the leader worker (see leader.py), so
+that is where the interesting ones are. Read through snapshot() and
+user_snapshot() (admin metrics endpoint, /api/google/status).
+
+Histogram and Metrics are not calendar specific; media uploads keep
+theirs in a Metrics of their own (media_router.py).
+"""
+
+import time
+import bisect
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 250, 1000, 5000)
+
+HISTOGRAMS = {
+    'sync_duration_s': SECONDS_BUCKETS,
+    'sync_events_fetched': COUNT_BUCKETS,
+    'webhook_to_apply_s': SECONDS_BUCKETS,
+}
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last bucket: above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation, capped at the max seen."""
+        if not self.count:
+            return None
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg': round(self.sum / self.count, 3) if self.count else None,
+            'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+            'max': round(self.max, 3),
+            'buckets': {('+Inf' if i == len(self.bounds) else str(self.bounds[i])): n
+                        for i, n in enumerate(self.counts) if n},
+        }
+
+
+class Metrics:
+    """Counters, gauges (values that go up and down) and histograms;
+    bounds maps histogram names to their buckets."""
+
+    def __init__(self, bounds=HISTOGRAMS):
+        self.bounds = bounds
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def adjust(self, name, delta):
+        self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, name, value):
+        hist = self.histograms.get(name)
+        if hist is None:
+            hist = self.histograms[name] = Histogram(self.bounds.get(name, SECONDS_BUCKETS))
+        hist.observe(value)
+
+    def snapshot(self):
+        out = {
+            'counters': dict(self.counters),
+            'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+        }
+        if self.gauges:
+            out['gauges'] = dict(self.gauges)
+        return out
+
+
+class _UserMetrics(Metrics):
+    def __init__(self):
+        super().__init__()
+        self.last_sync_at = None      # wall time of the last sync attempt that finished
+        self.last_success_at = None
+        self.last_error = None
+
+
+class MetricsRegistry:
+    """Aggregate metrics plus one _UserMetrics per user that has recorded any."""
+
+    def __init__(self):
+        self.total = Metrics()
+        self.users = {}
+        self.started_at = time.time()
+
+    def _user(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = _UserMetrics()
+        return user
+
+    def inc(self, name, user_id=None, n=1):
+        self.total.inc(name, n)
+        if user_id is not None:
+            self._user(user_id).inc(name, n)
+
+    def observe(self, name, value, user_id=None):
+        self.total.observe(name, value)
+        if user_id is not None:
+            self._user(user_id).observe(name, value)
+
+    def record_sync(self, user_id, duration, fetched=None, error=None):
+        """One finished sync_user_calendar() run (fetched is None when it raised)."""
+        user = self._user(user_id)
+        user.last_sync_at = time.time()
+        self.inc('syncs', user_id)
+        self.observe('sync_duration_s', duration, user_id)
+        if error is None:
+            user.last_success_at = user.last_sync_at
+            user.last_error = None
+            self.observe('sync_events_fetched', fetched or 0, user_id)
+        else:
+            user.last_error = f'{type(error).__name__}: {error}'[:200]
+            self.inc('sync_failures', user_id)
+
+    def forget(self, user_id):
+        self.users.pop(user_id, None)
+
+    def user_snapshot(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            return None
+        now = time.time()
+        return {
+            **user.snapshot(),
+            'last_sync_at': user.last_sync_at,
+            'last_success_at': user.last_success_at,
+            'lag_s': round(now - user.last_success_at, 1) if user.last_success_at else None,
+            'last_error': user.last_error,
+        }
+
+    def snapshot(self, stalled_after=None, top=20):
+        """Aggregate metrics, plus the `top` users furthest behind (never
+        synced successfully first), optionally only those lagging more
+        than stalled_after seconds."""
+        now = time.time()
+        lagging = sorted(
+            ((now - (u.last_success_at or self.started_at), user_id, u)
+             for user_id, u in self.users.items()),
+            key=lambda item: (item[2].last_success_at is not None, -item[0]),
+        )
+        if stalled_after is not None:
+            lagging = [item for item in lagging if item[0] > stalled_after]
+        return {
+            **self.total.snapshot(),
+            'users': len(self.users),
+            'uptime_s': round(now - self.started_at, 1),
+            'most_behind': [
+                {'user_id': user_id, 'lag_s': round(lag, 1),
+                 'synced': u.last_success_at is not None, 'last_error': u.last_error}
+                for lag, user_id, u in lagging[:top]
+            ],
+        }
+
+
+metrics = MetricsRegistry()
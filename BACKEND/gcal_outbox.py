@@ -0,0 +1,243 @@
+"""Transactional outbox for Google Calendar writes.
+
+Routes never talk to Google directly. They call enqueue_gcal_op() inside
+the same transaction as the task change, and a background worker drains
+the gcal_outbox table: per-user in order, with exponential backoff, and
+with consecutive ops on the same task folded into as few calls as possible
+(create+update -> one create, create+delete -> nothing, update+delete ->
+one delete). Event payloads are read from the task row at drain time, so
+a coalesced write always carries the latest text and schedule. Each drain
+sends a user's deletes, creates and updates as batch requests, so a mass
+deletion costs a few round-trips instead of one per event.
+"""
+
+import asyncio
+from collections import OrderedDict
+
+from BACKEND.core import logger, get_db, GOOGLE_CALENDAR_ENABLED
+from BACKEND.gcal_helpers import gcal_session, mark_local_edit, revoke_gcal_credentials
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 5        # seconds; doubled on every failed attempt
+BACKOFF_MAX = 3600
+DRAIN_BATCH = 500
+DRAIN_CONCURRENCY = 4
+CLAIM_SECONDS = 120     # lease on claimed rows, so another worker cannot double-apply
+
+_wake = asyncio.Event()
+
+
+def enqueue_gcal_op(conn, user_id, task_id, op, google_event_id=None):
+    """Queue a Calendar write ('create' | 'update' | 'delete') in the caller's transaction.
+
+    Rows are only written for users with a connected calendar. The caller
+    commits; call notify_gcal_outbox() afterwards to skip the poll delay.
+    """
+    if not GOOGLE_CALENDAR_ENABLED:
+        return
+    cur = conn.execute(
+        'INSERT INTO gcal_outbox (user_id, task_id, op, google_event_id) '
+        'SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM google_tokens WHERE user_id = ?)',
+        (user_id, task_id, op, google_event_id, user_id),
+    )
+    if cur.rowcount:
+        mark_local_edit(conn, user_id)
+
+
+def notify_gcal_outbox():
+    """Wake the drain worker (call after the enqueuing transaction commits)."""
+    _wake.set()
+
+
+def _coalesce(rows):
+    """Fold a user's queued rows into one plan per task, preserving task order.
+
+    Returns [(task_id, {'deletes': [event_id, ...], 'write': None|'create'|'update',
+    'row_ids': [...]})].
+    """
+    plans = OrderedDict()
+    for r in rows:
+        plan = plans.setdefault(r['task_id'], {'deletes': [], 'write': None, 'row_ids': []})
+        plan['row_ids'].append(r['id'])
+        if r['op'] == 'delete':
+            # A pending create never reached Google, so there is nothing to undo
+            ev = r['google_event_id']
+            if ev and ev not in plan['deletes']:
+                plan['deletes'].append(ev)
+            plan['write'] = None
+        elif r['op'] == 'create':
+            plan['write'] = 'create'
+        elif r['op'] == 'update' and plan['write'] is None:
+            plan['write'] = 'update'
+    return list(plans.items())
+
+
+async def _apply_plans(session, user_id, plans):
+    """Execute coalesced plans with one batch call per op kind.
+
+    No DB connection is held across a Google call (the other worker's
+    writers would wait on it): each read or write-back opens its own.
+    Returns the set of task ids whose plan failed.
+    """
+    from BACKEND.google_calendar import (
+        batch_create_calendar_events, batch_update_calendar_events,
+        batch_delete_calendar_events,
+    )
+    failed = set()
+
+    deletes = {(task_id, ev): ev for task_id, plan in plans for ev in plan['deletes']}
+    if deletes:
+        for (task_id, _ev), ok in (await batch_delete_calendar_events(session, deletes)).items():
+            if not ok:
+                failed.add(task_id)
+
+    writes = {task_id: plan['write'] for task_id, plan in plans
+              if plan['write'] and task_id not in failed}
+    if not writes:
+        return failed
+    ph = ','.join('?' * len(writes))
+    with get_db() as conn:
+        tasks = {
+            t['id']: t for t in conn.execute(
+                'SELECT id, text, scheduled_start, scheduled_end, recurrence_rule, description, '
+                f'google_event_id FROM tasks WHERE id IN ({ph}) AND user_id = ? '
+                'AND completed_at IS NULL',
+                list(writes) + [user_id],
+            )
+        }
+
+    creates = {tid: t for tid, t in tasks.items() if writes[tid] == 'create'}
+    if creates:
+        created = await batch_create_calendar_events(session, creates)
+        with get_db() as conn:
+            for task_id, event_id in created.items():
+                if not event_id:
+                    failed.add(task_id)
+                    continue
+                cur = conn.execute('UPDATE tasks SET google_event_id = ? WHERE id = ? AND user_id = ?',
+                                   (event_id, task_id, user_id))
+                if not cur.rowcount:
+                    # Task was deleted while the call was in flight
+                    enqueue_gcal_op(conn, user_id, task_id, 'delete', event_id)
+            conn.commit()
+
+    updates = {tid: t for tid, t in tasks.items()
+               if writes[tid] == 'update' and t['google_event_id']}
+    if updates:
+        for task_id, ok in (await batch_update_calendar_events(session, updates)).items():
+            if not ok:
+                failed.add(task_id)
+    return failed
+
+
+async def _drain_user(user_id, rows):
+    """Apply one user's queued rows: claim them, call Google with no
+    connection open, then record the outcome."""
+    from BACKEND.gcal_client import TokenRevoked
+    row_ids = [r['id'] for r in rows]
+    ph = ','.join('?' * len(row_ids))
+    with get_db() as conn:
+        # Claim by pushing next_attempt_at forward; a concurrent drainer loses the race
+        claimed = conn.execute(
+            f"UPDATE gcal_outbox SET next_attempt_at = datetime('now', '+{CLAIM_SECONDS} seconds') "
+            f"WHERE id IN ({ph}) AND next_attempt_at <= datetime('now')", row_ids,
+        ).rowcount
+        conn.commit()
+        if claimed != len(row_ids):
+            return
+
+        session = gcal_session(conn, user_id)
+        if not session:
+            # Calendar disconnected: nothing left to push
+            conn.execute('DELETE FROM gcal_outbox WHERE user_id = ?', (user_id,))
+            conn.commit()
+            return
+
+    plans = _coalesce(rows)
+    try:
+        failed = await _apply_plans(session, user_id, plans)
+    except TokenRevoked:
+        # Grant gone, same as a disconnect
+        revoke_gcal_credentials(user_id)
+        with get_db() as conn:
+            conn.execute('DELETE FROM gcal_outbox WHERE user_id = ?', (user_id,))
+            conn.commit()
+        return
+    except Exception:
+        logger.error('GCal outbox: writes failed for user %d', user_id, exc_info=True)
+        failed = {task_id for task_id, _plan in plans}
+
+    with get_db() as conn:
+        done = [rid for task_id, plan in plans if task_id not in failed for rid in plan['row_ids']]
+        if done:
+            done_ph = ','.join('?' * len(done))
+            conn.execute(f'DELETE FROM gcal_outbox WHERE id IN ({done_ph})', done)
+            conn.commit()
+        if failed:
+            # The user's whole queue waits, so later ops never overtake a failed one
+            _backoff(conn, user_id, [rid for task_id, plan in plans if task_id in failed
+                                     for rid in plan['row_ids']])
+
+
+def _backoff(conn, user_id, row_ids):
+    ph = ','.join('?' * len(row_ids))
+    conn.execute(
+        f'UPDATE gcal_outbox SET attempts = attempts + 1 WHERE id IN ({ph})', row_ids,
+    )
+    dropped = conn.execute(
+        f'DELETE FROM gcal_outbox WHERE id IN ({ph}) AND attempts >= ?', row_ids + [MAX_ATTEMPTS],
+    ).rowcount
+    if dropped:
+        logger.error('GCal outbox: dropped %d op(s) for user %d after %d attempts',
+                     dropped, user_id, MAX_ATTEMPTS)
+    attempts = conn.execute(
+        'SELECT MAX(attempts) FROM gcal_outbox WHERE user_id = ?', (user_id,),
+    ).fetchone()[0] or 0
+    delay = min(BACKOFF_BASE * 2 ** max(attempts - 1, 0), BACKOFF_MAX)
+    conn.execute(
+        "UPDATE gcal_outbox SET next_attempt_at = datetime('now', ?) WHERE user_id = ?",
+        (f'+{delay} seconds', user_id),
+    )
+    conn.commit()
+
+
+async def drain_gcal_outbox():
+    """Drain all due rows once. Users whose queue is backing off are skipped whole."""
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT id, user_id, task_id, op, google_event_id FROM gcal_outbox "
+            "WHERE user_id NOT IN ("
+            "  SELECT user_id FROM gcal_outbox WHERE next_attempt_at > datetime('now')) "
+            "ORDER BY id LIMIT ?", (DRAIN_BATCH,),
+        ).fetchall()
+    if not rows:
+        return 0
+
+    by_user = OrderedDict()
+    for r in rows:
+        by_user.setdefault(r['user_id'], []).append(r)
+
+    sem = asyncio.Semaphore(DRAIN_CONCURRENCY)
+
+    async def run(user_id, user_rows):
+        async with sem:
+            await _drain_user(user_id, user_rows)
+
+    await asyncio.gather(*(run(u, rs) for u, rs in by_user.items()))
+    return len(rows)
+
+
+async def gcal_outbox_loop(poll_interval=2):
+    """Background loop: drain on notify, or every poll_interval seconds."""
+    if not GOOGLE_CALENDAR_ENABLED:
+        return
+    while True:
+        _wake.clear()
+        try:
+            await drain_gcal_outbox()
+        except Exception:
+            logger.error('GCal outbox loop error', exc_info=True)
+        try:
+            await asyncio.wait_for(_wake.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
@@ -5,6 +5,7 @@ background sync loop which is started from run.py.
 """
 
 import asyncio
+from datetime import datetime
 
 from fastapi import APIRouter, Request, Depends, Response
 from fastapi.responses import JSONResponse, RedirectResponse
@@ -12,9 +13,12 @@ from fastapi.responses import JSONResponse, RedirectResponse
 from BACKEND.core import (
     logger, get_db, error_response, get_authenticated_user,
     GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI,
-    GOOGLE_CALENDAR_ENABLED, INSTANCE_ROLE,
+    GOOGLE_CALENDAR_ENABLED, INSTANCE_ROLE, admin_auth_error,
 )
-from BACKEND.gcal_helpers import do_calendar_sync_for_user
+from BACKEND.gcal_helpers import (
+    request_push_sync, gcal_session, evict_gcal_session, calendar_sync_stats,
+)
+from BACKEND.gcal_metrics import metrics
 
 router = APIRouter()
 
@@ -71,7 +75,7 @@ async def google_callback(request: Request):
         redirect_uri=GOOGLE_REDIRECT_URI,
     )
     flow.code_verifier = _pkce_verifiers.pop(user_id, None)
-    flow.fetch_token(code=code)
+    await asyncio.to_thread(flow.fetch_token, code=code)
     creds = flow.credentials
 
     with get_db() as conn:
@@ -85,6 +89,7 @@ async def google_callback(request: Request):
         ''', (user_id, creds.token, creds.refresh_token,
               creds.expiry.isoformat() if creds.expiry else None))
         conn.commit()
+    evict_gcal_session(user_id)
 
     return RedirectResponse('/')
 
@@ -98,18 +103,19 @@ async def google_disconnect(user_id: int = Depends(get_authenticated_user)):
         ).fetchone()
         if row and row['watch_channel_id'] and row['watch_resource_id']:
             try:
-                from BACKEND.google_calendar import (
-                    get_google_credentials, get_calendar_service, stop_watch,
-                )
-                creds = get_google_credentials(conn, user_id, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET)
-                if creds:
-                    service = get_calendar_service(creds)
-                    stop_watch(service, row['watch_channel_id'], row['watch_resource_id'])
+                from BACKEND.google_calendar import stop_watch
+                session = gcal_session(conn, user_id)
+                if session:
+                    await stop_watch(session, row['watch_channel_id'], row['watch_resource_id'],
+                                     refresh=False)
             except Exception:
                 logger.error('Failed to stop watch on disconnect for user %d', user_id, exc_info=True)
         conn.execute('DELETE FROM google_tokens WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM gcal_series WHERE user_id = ?', (user_id,))
         conn.execute('UPDATE tasks SET google_event_id = NULL WHERE user_id = ?', (user_id,))
         conn.commit()
+    evict_gcal_session(user_id)
+    metrics.forget(user_id)
     return JSONResponse({'success': True})
 
 
@@ -118,21 +124,54 @@ async def google_status(user_id: int = Depends(get_authenticated_user)):
     if not GOOGLE_CALENDAR_ENABLED:
         return JSONResponse({'connected': False, 'available': False})
     with get_db() as conn:
-        row = conn.execute('SELECT user_id FROM google_tokens WHERE user_id = ?',
+        row = conn.execute('SELECT last_sync_at FROM google_tokens WHERE user_id = ?',
                            (user_id,)).fetchone()
         if not row:
             return JSONResponse({'connected': False, 'available': True})
-        try:
-            from BACKEND.google_calendar import get_google_credentials
-            creds = get_google_credentials(conn, user_id, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET)
-            if not creds or not creds.valid:
-                raise Exception('invalid credentials')
-        except Exception:
+        session = gcal_session(conn, user_id)
+        if not session or (session.expires_within(0) and not session.refresh_token):
             conn.execute('DELETE FROM google_tokens WHERE user_id = ?', (user_id,))
             conn.commit()
+            evict_gcal_session(user_id)
             logger.warning('Removed expired Google tokens for user %s', user_id)
             return JSONResponse({'connected': False, 'available': True})
-    return JSONResponse({'connected': True, 'available': True})
+    lag = None
+    if row['last_sync_at']:
+        lag = round((datetime.now() - datetime.fromisoformat(row['last_sync_at'])).total_seconds(), 1)
+    return JSONResponse({
+        'connected': True, 'available': True,
+        'last_sync_at': row['last_sync_at'], 'lag_s': lag,
+        # Only the worker running the sync loop has these
+        'sync': metrics.user_snapshot(user_id),
+    })
+
+
+@router.get('/api/admin/google/metrics')
+async def google_sync_metrics(request: Request):
+    """Calendar sync metrics for this process (ADMIN_TOKEN bearer auth).
+
+    ?user_id=N adds that user's metrics; ?stalled_after=S lists only users
+    whose last successful sync is more than S seconds old.
+    """
+    denied = admin_auth_error(request)
+    if denied:
+        return denied
+    try:
+        user_id = int(request.query_params['user_id']) if 'user_id' in request.query_params else None
+        stalled_after = float(request.query_params.get('stalled_after') or 0) or None
+    except ValueError:
+        return error_response('Invalid query parameters', 400)
+
+    from BACKEND.leader import lease_status
+    result = {
+        'instance_role': INSTANCE_ROLE,
+        'leader': await asyncio.to_thread(lease_status, 'background'),
+        'calendar': metrics.snapshot(stalled_after),
+        'loops': calendar_sync_stats(),
+    }
+    if user_id is not None:
+        result['user'] = metrics.user_snapshot(user_id)
+    return JSONResponse(result)
 
 
 @router.post('/api/google/webhook')
@@ -150,15 +189,12 @@ async def google_calendar_webhook(request: Request):
 
     with get_db() as conn:
         row = conn.execute(
-            'SELECT user_id, sync_token, calendar_id FROM google_tokens WHERE watch_channel_id = ?',
+            'SELECT user_id FROM google_tokens WHERE watch_channel_id = ?',
             (channel_id,),
         ).fetchone()
+        if not row:
+            return Response(status_code=404)
 
-    if not row:
-        return Response(status_code=404)
-
-    logger.info('Calendar push notification for user %d (state: %s)', row['user_id'], resource_state)
-    asyncio.create_task(do_calendar_sync_for_user(
-        row['user_id'], row['sync_token'], row['calendar_id'] or 'primary', INSTANCE_ROLE,
-    ))
+        logger.info('Calendar push notification for user %d (state: %s)', row['user_id'], resource_state)
+        request_push_sync(conn, row['user_id'])
     return Response(status_code=200)
@@ -0,0 +1,150 @@
+"""Background OAuth token refresh for Google Calendar.
+
+Access tokens are renewed GOOGLE_TOKEN_REFRESH_AHEAD seconds before
+token_expiry by a loop running under the leader lease, so nothing on a
+request path ever waits on oauth2.googleapis.com. Expiries sit in a
+min-heap; at most GOOGLE_TOKEN_REFRESH_CONCURRENCY refreshes run at once.
+Revoked grants are removed the same way the sync loop removes them.
+"""
+
+import time
+import heapq
+import asyncio
+from datetime import datetime, timezone
+
+from SETTINGS import GOOGLE_TOKEN_REFRESH_AHEAD, GOOGLE_TOKEN_REFRESH_CONCURRENCY
+from BACKEND.core import logger, get_db, GOOGLE_CALENDAR_ENABLED
+from BACKEND.gcal_helpers import gcal_session, revoke_gcal_credentials
+
+RELOAD_INTERVAL = 30    # seconds between re-reads of google_tokens (new grants, other writers)
+RETRY_DELAY = 60        # seconds before retrying a refresh that failed transiently
+
+_refresher = None
+
+
+def _expiry_ts(session):
+    return session.expiry.replace(tzinfo=timezone.utc).timestamp() if session.expiry else None
+
+
+class TokenRefresher:
+    """Min-heap of (refresh_at, user_id). Entries whose time no longer matches
+    _due are stale (rescheduled or disconnected) and skipped when popped."""
+
+    def __init__(self, ahead, concurrency):
+        self.ahead = ahead
+        self.concurrency = concurrency
+        self._heap = []
+        self._due = {}
+        self._running = set()
+        self._tasks = set()  # refreshes in flight, cancelled with run()
+        self._loaded_at = 0.0
+        self.stats = {'refreshed': 0, 'revoked': 0, 'failed': 0, 'last_refresh': None}
+
+    def _schedule(self, user_id, at):
+        self._due[user_id] = at
+        heapq.heappush(self._heap, (at, user_id))
+
+    def _read_expiries(self):
+        """{user_id: expiry timestamp} for grants that can be refreshed (runs in a thread)."""
+        with get_db() as conn:
+            rows = conn.execute(
+                'SELECT user_id, token_expiry FROM google_tokens '
+                'WHERE refresh_token IS NOT NULL AND token_expiry IS NOT NULL'
+            ).fetchall()
+        expiries = {}
+        for r in rows:
+            try:
+                expiry = datetime.fromisoformat(r['token_expiry'])
+            except ValueError:
+                continue
+            # Stored as naive UTC
+            expiries[r['user_id']] = expiry.replace(tzinfo=timezone.utc).timestamp()
+        return expiries
+
+    def _load(self, expiries):
+        for user_id, expires in expiries.items():
+            at = expires - self.ahead
+            if user_id not in self._running and self._due.get(user_id) != at:
+                self._schedule(user_id, at)
+        for user_id in self._due.keys() - expiries.keys():
+            del self._due[user_id]
+
+    async def _refresh(self, user_id):
+        from BACKEND.gcal_client import TokenRevoked
+        next_at = None
+        try:
+            with get_db() as conn:
+                session = gcal_session(conn, user_id)
+            if not session:
+                return
+            await session.refresh(session.access_token)
+            self.stats['refreshed'] += 1
+            self.stats['last_refresh'] = time.time()
+            expires = _expiry_ts(session)
+            next_at = expires - self.ahead if expires is not None else None
+        except TokenRevoked:
+            self.stats['revoked'] += 1
+            revoke_gcal_credentials(user_id)
+        except Exception:
+            self.stats['failed'] += 1
+            logger.warning('Token refresh failed for user %d', user_id, exc_info=True)
+            next_at = time.time() + RETRY_DELAY
+        finally:
+            self._running.discard(user_id)
+            if next_at is not None:
+                self._schedule(user_id, next_at)
+
+    def _dispatch_due(self):
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now and len(self._running) < self.concurrency:
+            at, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) != at:
+                continue
+            del self._due[user_id]
+            self._running.add(user_id)
+            task = asyncio.create_task(self._refresh(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def snapshot(self):
+        next_at = min(self._due.values(), default=None)
+        return {
+            **self.stats,
+            'tracked': len(self._due) + len(self._running),
+            'in_flight': len(self._running),
+            'next_refresh_in_s': round(next_at - time.time(), 1) if next_at else None,
+        }
+
+    async def run(self):
+        try:
+            while True:
+                try:
+                    if time.time() - self._loaded_at >= RELOAD_INTERVAL:
+                        self._loaded_at = time.time()
+                        self._load(await asyncio.to_thread(self._read_expiries))
+                    self._dispatch_due()
+                except Exception:
+                    logger.error('Token refresher error', exc_info=True)
+                next_at = self._heap[0][0] if self._heap else time.time() + RELOAD_INTERVAL
+                await asyncio.sleep(min(max(next_at - time.time(), 0.05), RELOAD_INTERVAL))
+        finally:
+            # Leadership lost: a refresh still in flight would race the new leader's
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def token_refresh_stats():
+    return _refresher.snapshot() if _refresher else None
+
+
+async def token_refresh_loop():
+    """Background loop (leader only): keep every stored access token fresh."""
+    global _refresher
+    if not GOOGLE_CALENDAR_ENABLED:
+        return
+    _refresher = TokenRefresher(GOOGLE_TOKEN_REFRESH_AHEAD, GOOGLE_TOKEN_REFRESH_CONCURRENCY)
+    try:
+        await _refresher.run()
+    finally:
+        _refresher = None
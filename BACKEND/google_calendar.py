@@ -1,50 +1,26 @@
-"""Google Calendar API helper functions for ToDo-Game integration."""
+"""Google Calendar API helper functions for ToDo-Game integration.
+
+API calls are coroutines on the shared client in gcal_client.py; each
+takes the user's CalendarSession (tokens + calendar id).
+"""
 
-import logging
 import uuid
+import asyncio
+import logging
+from urllib.parse import quote
 from datetime import datetime, timezone, timedelta
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from BACKEND.gcal_client import API_URL, CalendarError, TokenRevoked, request, batch
+from BACKEND.gcal_metrics import metrics
 
 logger = logging.getLogger(__name__)
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
 
-def get_google_credentials(conn, user_id, client_id, client_secret):
-    """Build Credentials from stored tokens, auto-refreshing if expired."""
-    row = conn.execute(
-        'SELECT access_token, refresh_token, token_expiry FROM google_tokens WHERE user_id = ?',
-        (user_id,)
-    ).fetchone()
-    if not row:
-        return None
-
-    creds = Credentials(
-        token=row['access_token'],
-        refresh_token=row['refresh_token'],
-        token_uri='https://oauth2.googleapis.com/token',
-        client_id=client_id,
-        client_secret=client_secret,
-        scopes=SCOPES,
-    )
-
-    if creds.expired and creds.refresh_token:
-        from google.auth.transport.requests import Request
-        creds.refresh(Request())
-        conn.execute(
-            'UPDATE google_tokens SET access_token = ?, token_expiry = ? WHERE user_id = ?',
-            (creds.token, creds.expiry.isoformat() if creds.expiry else None, user_id)
-        )
-        conn.commit()
-
-    return creds
-
-
-def get_calendar_service(creds):
-    """Build a Google Calendar API service object."""
-    return build('calendar', 'v3', credentials=creds, cache_discovery=False)
+def _events_path(calendar_id, event_id=None):
+    path = f'/calendars/{quote(calendar_id, safe="")}/events'
+    return f'{path}/{quote(event_id, safe="")}' if event_id else path
 
 
 def recurrence_rule_to_rrule(rule):
@@ -124,85 +100,201 @@ def task_to_event(text, start_iso, end_iso, recurrence_rule=None, description=No
     return event
 
 
-def create_calendar_event(service, calendar_id, text, start_iso, end_iso, recurrence_rule=None, description=None):
+async def create_calendar_event(session, text, start_iso, end_iso, recurrence_rule=None, description=None):
     """Create a new event in Google Calendar. Returns the event ID."""
     event = task_to_event(text, start_iso, end_iso, recurrence_rule, description)
     try:
-        result = service.events().insert(calendarId=calendar_id, body=event).execute()
+        result = await request(session, 'POST', API_URL + _events_path(session.calendar_id),
+                               json_body=event)
         return result.get('id')
-    except Exception:
+    except TokenRevoked:
+        raise
+    except CalendarError:
         logger.error('Failed to create calendar event', exc_info=True)
         return None
 
 
-def update_calendar_event(service, calendar_id, event_id, text, start_iso, end_iso, recurrence_rule=None, description=None):
+async def update_calendar_event(session, event_id, text, start_iso, end_iso, recurrence_rule=None, description=None):
     """Update an existing event in Google Calendar."""
     event = task_to_event(text, start_iso, end_iso, recurrence_rule, description)
     try:
-        service.events().update(calendarId=calendar_id, eventId=event_id, body=event).execute()
+        await request(session, 'PUT', API_URL + _events_path(session.calendar_id, event_id),
+                      json_body=event)
         return True
-    except Exception:
+    except TokenRevoked:
+        raise
+    except CalendarError as e:
+        if e.gone:
+            logger.info('Calendar event %s no longer exists, skipping update', event_id)
+            return True
         logger.error('Failed to update calendar event %s', event_id, exc_info=True)
         return False
 
 
-def delete_calendar_event(service, calendar_id, event_id):
+async def delete_calendar_event(session, event_id):
     """Delete an event from Google Calendar."""
     try:
-        service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
+        await request(session, 'DELETE', API_URL + _events_path(session.calendar_id, event_id))
         return True
-    except Exception as e:
-        if '410' in str(e) or '404' in str(e):
+    except TokenRevoked:
+        raise
+    except CalendarError as e:
+        if e.gone:
             logger.info('Calendar event %s already deleted, skipping', event_id)
             return True
         logger.error('Failed to delete calendar event %s', event_id, exc_info=True)
         return False
 
 
-def sync_calendar_events(service, calendar_id, sync_token=None):
+# ============== Batch requests ==============
+
+BATCH_LIMIT = 50  # Calendar API maximum sub-requests per batch call
+
+
+def _ok(status):
+    return 200 <= status < 300
+
+
+def _is_gone(status):
+    """True for 404/410 — the event no longer exists on Google's side."""
+    return status in (404, 410)
+
+
+async def _execute_batch(session, calls):
+    """Run [(key, (method, path, body)), ...] through the batch endpoint in BATCH_LIMIT chunks.
+
+    Chunks go out concurrently over the shared connection. Returns
+    {key: (status, payload)}; a chunk that fails as a whole reports status 0
+    for every key in it. TokenRevoked propagates.
+    """
+    async def run(chunk):
+        try:
+            return zip([key for key, _call in chunk],
+                       await batch(session, [call for _key, call in chunk]))
+        except TokenRevoked:
+            raise
+        except CalendarError:
+            logger.error('Calendar batch request failed', exc_info=True)
+            return [(key, (0, None)) for key, _call in chunk]
+
+    chunks = [calls[i:i + BATCH_LIMIT] for i in range(0, len(calls), BATCH_LIMIT)]
+    results = {}
+    for pairs in await asyncio.gather(*(run(c) for c in chunks)):
+        results.update(pairs)
+    return results
+
+
+async def batch_create_calendar_events(session, tasks):
+    """Create many events. tasks: {key: row with text, scheduled_start, scheduled_end,
+    recurrence_rule, description}. Returns {key: event_id or None}."""
+    path = _events_path(session.calendar_id)
+    calls = [
+        (key, ('POST', path, task_to_event(
+            t['text'], t['scheduled_start'], t['scheduled_end'],
+            t['recurrence_rule'], t['description'])))
+        for key, t in tasks.items()
+    ]
+    out = {}
+    for key, (status, payload) in (await _execute_batch(session, calls)).items():
+        if not _ok(status):
+            logger.error('Failed to create calendar event for %s: HTTP %s', key, status)
+        out[key] = (payload or {}).get('id') if _ok(status) else None
+    return out
+
+
+async def batch_update_calendar_events(session, tasks):
+    """Update many events. tasks: {key: row as for create, plus google_event_id}.
+    Returns {key: bool}; a missing event counts as success, like update_calendar_event."""
+    calls = [
+        (key, ('PUT', _events_path(session.calendar_id, t['google_event_id']), task_to_event(
+            t['text'], t['scheduled_start'], t['scheduled_end'],
+            t['recurrence_rule'], t['description'])))
+        for key, t in tasks.items()
+    ]
+    out = {}
+    for key, (status, _payload) in (await _execute_batch(session, calls)).items():
+        if not _ok(status) and not _is_gone(status):
+            logger.error('Failed to update calendar event for %s: HTTP %s', key, status)
+        out[key] = _ok(status) or _is_gone(status)
+    return out
+
+
+async def batch_delete_calendar_events(session, event_ids):
+    """Delete many events. event_ids: {key: event_id}. Returns {key: bool};
+    already-deleted events count as success, like delete_calendar_event."""
+    calls = [
+        (key, ('DELETE', _events_path(session.calendar_id, event_id), None))
+        for key, event_id in event_ids.items()
+    ]
+    out = {}
+    for key, (status, _payload) in (await _execute_batch(session, calls)).items():
+        if not _ok(status) and not _is_gone(status):
+            logger.error('Failed to delete calendar event for %s: HTTP %s', key, status)
+        out[key] = _ok(status) or _is_gone(status)
+    return out
+
+
+async def sync_calendar_events(session, sync_token=None, single_events=True):
     """Fetch changed events using incremental sync.
 
+    With single_events=False recurring series come back as one master event
+    (with 'recurrence') plus their modified/cancelled instances, instead of
+    one event per occurrence; see recurrence.py for the local expansion.
+    Sync tokens are only valid for the mode they were issued in.
     Returns (events_list, new_sync_token, is_full_sync).
     """
     events = []
     page_token = None
     new_sync_token = None
     is_full_sync = sync_token is None
+    url = API_URL + _events_path(session.calendar_id)
 
     try:
         while True:
-            kwargs = {'calendarId': calendar_id, 'singleEvents': True, 'maxResults': 100}
+            params = {'singleEvents': 'true' if single_events else 'false', 'maxResults': 250}
             if sync_token and not is_full_sync:
-                kwargs['syncToken'] = sync_token
+                params['syncToken'] = sync_token
             else:
                 # Full sync: get events from 30 days ago to 30 days ahead
-                kwargs['timeMin'] = (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
-                kwargs['timeMax'] = (datetime.now(timezone.utc) + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                params['timeMin'] = (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                params['timeMax'] = (datetime.now(timezone.utc) + timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%SZ')
             if page_token:
-                kwargs['pageToken'] = page_token
+                params['pageToken'] = page_token
 
-            result = service.events().list(**kwargs).execute()
+            result = await request(session, 'GET', url, params=params)
             events.extend(result.get('items', []))
             page_token = result.get('nextPageToken')
             if not page_token:
                 new_sync_token = result.get('nextSyncToken')
                 break
 
-    except Exception as e:
-        from google.auth.exceptions import RefreshError
-        if isinstance(e, RefreshError):
-            raise  # Let caller handle expired/revoked tokens
-        error_str = str(e)
-        if '410' in error_str or 'Gone' in error_str:
+    except TokenRevoked:
+        raise  # Let caller handle expired/revoked tokens
+    except CalendarError as e:
+        if e.status == 410 and not is_full_sync:
             # syncToken invalidated, do full sync
             logger.info('Sync token expired, performing full sync')
-            return sync_calendar_events(service, calendar_id, sync_token=None)
+            metrics.inc('full_resyncs', session.user_id)
+            return await sync_calendar_events(session, None, single_events)
         logger.error('Failed to sync calendar events', exc_info=True)
         return [], None, is_full_sync
 
     return events, new_sync_token, is_full_sync
 
 
+async def list_event_instances(session, event_id, time_min, time_max):
+    """Occurrences of a recurring event between two RFC 3339 times, as Google expands them."""
+    url = API_URL + _events_path(session.calendar_id, event_id) + '/instances'
+    params = {'timeMin': time_min, 'timeMax': time_max, 'maxResults': 250}
+    events = []
+    while True:
+        result = await request(session, 'GET', url, params=params)
+        events.extend(result.get('items', []))
+        if not result.get('nextPageToken'):
+            return events
+        params['pageToken'] = result['nextPageToken']
+
+
 def parse_event_times(event):
     """Extract start and end ISO strings from a Google Calendar event."""
     start = event.get('start', {})
@@ -217,7 +309,7 @@ def strip_prefix(summary):
     return summary or ''
 
 
-def watch_calendar(service, calendar_id, webhook_url):
+async def watch_calendar(session, webhook_url):
     """Register a push notification channel for calendar events.
 
     Returns (channel_id, resource_id, expiration_ms) or None on failure.
@@ -233,16 +325,20 @@ def watch_calendar(service, calendar_id, webhook_url):
         'expiration': expiration,
     }
     try:
-        result = service.events().watch(calendarId=calendar_id, body=body).execute()
+        result = await request(session, 'POST', API_URL + _events_path(session.calendar_id) + '/watch',
+                               json_body=body)
         return result['id'], result['resourceId'], int(result.get('expiration', expiration))
-    except Exception:
+    except TokenRevoked:
+        raise
+    except CalendarError:
         logger.error('Failed to register calendar watch', exc_info=True)
         return None
 
 
-def stop_watch(service, channel_id, resource_id):
+async def stop_watch(session, channel_id, resource_id, refresh=True):
     """Stop an existing push notification channel."""
     try:
-        service.channels().stop(body={'id': channel_id, 'resourceId': resource_id}).execute()
-    except Exception:
+        await request(session, 'POST', API_URL + '/channels/stop', refresh=refresh,
+                      json_body={'id': channel_id, 'resourceId': resource_id})
+    except CalendarError:
         logger.error('Failed to stop calendar watch channel %s', channel_id, exc_info=True)
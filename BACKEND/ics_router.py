@@ -0,0 +1,239 @@
+"""iCalendar feed: open quests as a subscribable per-user secret URL.
+
+The feed is streamed page by page (keyset pagination over the
+(user_id, scheduled_start) index), so a 10k-task calendar is never held
+in memory. Its ETag / Last-Modified come from the per-user change stamp
+that the tasks triggers in core.init_db() bump on every write, so polling
+clients get a 304 without a single task being read. Local recurring
+tasks are exported once, with their RRULE; their materialized
+occurrences are left to the subscribing calendar app, except that
+completed ones (the series' own task included) become EXDATEs.
+"""
+
+import secrets
+from datetime import datetime, date, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import APIRouter, Request, Depends, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from SETTINGS import ICS_PAST_DAYS, ICS_PAGE_SIZE
+from BACKEND.core import logger, get_db, error_response, get_authenticated_user, APP_URL
+from BACKEND.google_calendar import recurrence_rule_to_rrule
+
+router = APIRouter()
+
+FEED_VERSION = 2  # bump when the rendered output changes, to invalidate cached feeds
+CACHE_CONTROL = 'private, no-cache'
+
+_COLUMNS = 'id, text, description, scheduled_start, scheduled_end, recurrence_rule, completed_at'
+_TOP = 'parent_id IS NULL AND recurrence_source_id IS NULL'
+_OPEN = f'completed_at IS NULL AND {_TOP}'
+
+
+# ============== Feed URL ==============
+
+def _feed_url(request, token):
+    base = APP_URL or str(request.base_url)
+    return f'{base.rstrip("/")}/ics/{token}.ics'
+
+
+@router.get('/api/ics')
+async def api_ics_feed(request: Request, user_id: int = Depends(get_authenticated_user)):
+    """The user's feed URL, created on first use."""
+    with get_db() as conn:
+        conn.execute('INSERT OR IGNORE INTO ics_feeds (user_id, token) VALUES (?, ?)',
+                     (user_id, secrets.token_urlsafe(24)))
+        conn.commit()
+        token = conn.execute('SELECT token FROM ics_feeds WHERE user_id = ?', (user_id,)).fetchone()[0]
+    return JSONResponse({'url': _feed_url(request, token)})
+
+
+@router.post('/api/ics/reset')
+async def api_ics_reset(request: Request, user_id: int = Depends(get_authenticated_user)):
+    """Issue a new feed URL; the old one stops working."""
+    token = secrets.token_urlsafe(24)
+    with get_db() as conn:
+        conn.execute(
+            'INSERT INTO ics_feeds (user_id, token) VALUES (?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET token = excluded.token, created_at = CURRENT_TIMESTAMP',
+            (user_id, token),
+        )
+        conn.commit()
+    return JSONResponse({'url': _feed_url(request, token)})
+
+
+@router.delete('/api/ics')
+async def api_ics_disable(user_id: int = Depends(get_authenticated_user)):
+    with get_db() as conn:
+        conn.execute('DELETE FROM ics_feeds WHERE user_id = ?', (user_id,))
+        conn.commit()
+    return JSONResponse({'success': True})
+
+
+# ============== Rendering ==============
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n').replace('\r', '\\n'))
+
+
+def _fold(line):
+    """RFC 5545 line folding: at most 75 octets per line, continuations start with a space."""
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return line + '\r\n'
+    parts, start, limit = [], 0, 75
+    while start < len(raw):
+        end = min(start + limit, len(raw))
+        while end < len(raw) and (raw[end] & 0xC0) == 0x80:  # don't split a UTF-8 sequence
+            end -= 1
+        parts.append(raw[start:end].decode('utf-8'))
+        start, limit = end, 74
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _ical_time(value):
+    """Task time string -> date, or aware UTC datetime (naive task times are UTC)."""
+    from dateutil.parser import parse as dt_parse
+    if len(value) <= 10:
+        return date.fromisoformat(value)
+    dt = dt_parse(value)
+    return dt.astimezone(timezone.utc) if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _format_time(name, value):
+    if isinstance(value, datetime):
+        return f'{name}:{value.strftime("%Y%m%dT%H%M%SZ")}'
+    return f'{name};VALUE=DATE:{value.strftime("%Y%m%d")}'
+
+
+def _render_event(task, dtstamp, exdates=()):
+    try:
+        start = _ical_time(task['scheduled_start'])
+        end = _ical_time(task['scheduled_end']) if task['scheduled_end'] else start
+    except (TypeError, ValueError, OverflowError):
+        logger.warning('Skipping task %s in calendar feed: unreadable schedule', task['id'])
+        return ''
+    if type(end) is not type(start):
+        end = start
+    if end <= start:
+        end = start + (timedelta(minutes=15) if isinstance(start, datetime) else timedelta(days=1))
+
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{task["id"]}@todo-game',
+        f'DTSTAMP:{dtstamp}',
+        _format_time('DTSTART', start),
+        _format_time('DTEND', end),
+        f'SUMMARY:{_escape(task["text"])}',
+    ]
+    if task['description']:
+        lines.append(f'DESCRIPTION:{_escape(task["description"])}')
+    for rrule in recurrence_rule_to_rrule(task['recurrence_rule']):
+        if not isinstance(start, datetime):
+            rrule = rrule.replace('T235959Z', '')  # UNTIL takes DTSTART's value type
+        lines.append(rrule)
+    for value in exdates:
+        try:
+            exdate = _ical_time(value)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        if type(exdate) is type(start):
+            lines.append(_format_time('EXDATE', exdate))
+    lines.append('END:VEVENT')
+    return ''.join(_fold(line) for line in lines)
+
+
+def _pages(user_id, where, params):
+    """Rows of user_id's tasks matching where, ordered by (scheduled_start, id),
+    ICS_PAGE_SIZE at a time. Each page uses its own short-lived connection,
+    so the generator can be resumed from any thread."""
+    after = ('', '')
+    while True:
+        with get_db() as conn:
+            rows = conn.execute(
+                f'SELECT {_COLUMNS} FROM tasks WHERE user_id = ? AND {where} '
+                'AND (scheduled_start, id) > (?, ?) ORDER BY scheduled_start, id LIMIT ?',
+                (user_id, *params, *after, ICS_PAGE_SIZE),
+            ).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < ICS_PAGE_SIZE:
+            return
+        after = (rows[-1]['scheduled_start'], rows[-1]['id'])
+
+
+def _completed_occurrences(series):
+    """Series id -> starts of its completed occurrences (EXDATEs), the
+    series' own task included: completing it must not end the series."""
+    done = {task['id']: [task['scheduled_start']] if task['completed_at'] else [] for task in series}
+    ph = ','.join('?' * len(done))
+    with get_db() as conn:
+        for r in conn.execute(
+            f'SELECT recurrence_source_id, scheduled_start FROM tasks WHERE recurrence_source_id IN ({ph}) '
+            'AND completed_at IS NOT NULL ORDER BY scheduled_start', list(done),
+        ):
+            done[r['recurrence_source_id']].append(r['scheduled_start'])
+    return done
+
+
+def _feed(user_id, since, dtstamp):
+    yield ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//ToDo-Game//Quests//EN\r\n'
+           'CALSCALE:GREGORIAN\r\nMETHOD:PUBLISH\r\nX-WR-CALNAME:ToDo-Game\r\n').encode()
+    # Series masters whatever their start date or completion, then one-off tasks in the window
+    for rows in _pages(user_id, f'{_TOP} AND recurrence_rule IS NOT NULL', ()):
+        exdates = _completed_occurrences(rows)
+        yield ''.join(_render_event(task, dtstamp, exdates[task['id']]) for task in rows).encode('utf-8')
+    for rows in _pages(user_id, f'{_OPEN} AND recurrence_rule IS NULL AND scheduled_start >= ?', (since,)):
+        yield ''.join(_render_event(task, dtstamp) for task in rows).encode('utf-8')
+    yield b'END:VCALENDAR\r\n'
+
+
+# ============== Feed ==============
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@router.get('/ics/{token}.ics')
+async def ics_feed(request: Request, token: str):
+    with get_db() as conn:
+        row = conn.execute(
+            'SELECT f.user_id, s.stamp, s.changed_at FROM ics_feeds f '
+            'LEFT JOIN task_stamps s ON s.user_id = f.user_id WHERE f.token = ?', (token,),
+        ).fetchone()
+    if row is None:
+        return error_response('Not found', 404)
+
+    # The window start moves daily, so the day is part of the validators too
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    since = today - timedelta(days=ICS_PAST_DAYS)
+    last_modified = today
+    if row['changed_at']:
+        last_modified = max(today, datetime.strptime(row['changed_at'], '%Y-%m-%dT%H:%M:%SZ')
+                            .replace(tzinfo=timezone.utc))
+    etag = f'"{FEED_VERSION}-{row["stamp"] or 0}-{since:%Y%m%d}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': format_datetime(last_modified, usegmt=True),
+        'Cache-Control': CACHE_CONTROL,
+    }
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    return StreamingResponse(
+        _feed(row['user_id'], since.strftime('%Y-%m-%d'), last_modified.strftime('%Y%m%dT%H%M%SZ')),
+        media_type='text/calendar; charset=utf-8',
+        headers={**headers, 'Content-Disposition': 'inline; filename="todo-game.ics"'},
+    )
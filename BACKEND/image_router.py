@@ -0,0 +1,136 @@
+"""Responsive variants of FRONTEND images: /static/img/<name>?w=<px>.
+
+The task backgrounds are ~130 KB PNGs shown at 45% opacity; as AVIF or
+WebP they are a fraction of that. For each request the best format the
+Accept header allows (AVIF, WebP, else the original PNG) is served at
+the smallest of WIDTHS that covers w (physical pixels; no w, or more
+than the source has, means the source width). Variants are made with
+Pillow on first use and kept in IMAGE_FOLDER under the source's content
+hash, so they survive restarts and are remade only when the image changes.
+
+styles.css links them through its url() rewriting (static_assets.py),
+which turns img/bg_day.png into img/bg_day.<hash>.png: names with the
+current hash are cached as immutable, like every fingerprinted asset.
+"""
+
+import os
+import asyncio
+
+from fastapi import APIRouter, Request
+from fastapi.responses import FileResponse, Response
+
+from BACKEND.core import logger, error_response, IMAGE_FOLDER
+from BACKEND import static_assets
+
+try:
+    from PIL import Image, features
+    PILLOW = True
+    AVIF = features.check('avif')
+except ImportError:  # the source image is served as is
+    PILLOW = AVIF = False
+
+router = APIRouter()
+
+WIDTHS = (360, 540, 720)
+RASTER = {'.png', '.jpg', '.jpeg'}
+FORMATS = {  # format -> (media type, Pillow save options), in order of preference
+    'avif': ('image/avif', {'quality': 60, 'speed': 6}),
+    'webp': ('image/webp', {'quality': 80, 'method': 6}),
+}
+
+_widths = {}   # source name -> pixel width
+_locks = {}    # variant file name -> asyncio.Lock, so each is made once per process
+
+
+# ============== Variants ==============
+
+def _source_width(name):
+    if name not in _widths:
+        with Image.open(os.path.join(static_assets.SOURCE_FOLDER, name)) as img:
+            _widths[name] = img.width
+    return _widths[name]
+
+
+def _pick_width(requested, source_width):
+    # A preset only when it saves something over the source (not 720 of 732)
+    candidates = [w for w in WIDTHS if w < source_width * 0.9] + [source_width]
+    if requested:
+        for width in candidates:
+            if width >= requested:
+                return width
+    return source_width
+
+
+def _pick_format(accept):
+    accept = accept.lower()
+    for fmt, (media_type, _options) in FORMATS.items():
+        if media_type in accept and (fmt != 'avif' or AVIF):
+            return fmt
+    return None
+
+
+def _make_variant(name, width, fmt, dest):
+    with Image.open(os.path.join(static_assets.SOURCE_FOLDER, name)) as img:
+        if width < img.width:
+            img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+        tmp = f'{dest}.{os.getpid()}.part'
+        if fmt:
+            img.save(tmp, fmt.upper(), **FORMATS[fmt][1])
+        else:
+            img.save(tmp, 'PNG', optimize=True)
+    os.replace(tmp, dest)
+
+
+async def _variant(name, stem, width, fmt):
+    """Path of the variant, making it first if needed."""
+    variant = f'{stem}.{width}.{fmt or "png"}'
+    dest = os.path.join(IMAGE_FOLDER, variant)
+    if os.path.exists(dest):
+        return dest
+    lock = _locks.setdefault(variant, asyncio.Lock())
+    async with lock:
+        if not os.path.exists(dest):
+            os.makedirs(IMAGE_FOLDER, exist_ok=True)
+            await asyncio.to_thread(_make_variant, name, width, fmt, dest)
+            logger.info('Made image variant %s (%d bytes)', variant, os.path.getsize(dest))
+    _locks.pop(variant, None)
+    return dest
+
+
+# ============== Route ==============
+
+def _resolve(requested):
+    """(source name, fingerprinted name, whether requested is the current fingerprint)."""
+    if requested in static_assets.manifest:
+        return requested, static_assets.manifest[requested], False
+    stem, dot, ext = requested.rpartition('.')
+    source = f'{stem.rpartition(".")[0]}.{ext}' if dot else requested
+    fingerprinted = static_assets.manifest.get(source)
+    return source, fingerprinted, fingerprinted == requested
+
+
+@router.get('/static/img/{name}')
+async def image_variant(request: Request, name: str, w: int = 0):
+    source, fingerprinted, current = _resolve(name)
+    if not fingerprinted or os.path.splitext(source)[1].lower() not in RASTER:
+        return error_response('Not found', 404)
+    cache_control = static_assets.IMMUTABLE if current else static_assets.REVALIDATE
+    headers = {'Cache-Control': cache_control, 'Vary': 'Accept'}
+    if not PILLOW:
+        return FileResponse(os.path.join(static_assets.SOURCE_FOLDER, source), headers=headers)
+
+    source_width = _source_width(source)
+    width = _pick_width(max(0, min(w, 10000)), source_width)
+    fmt = _pick_format(request.headers.get('Accept', ''))
+    stem = os.path.splitext(fingerprinted)[0]  # bg_day.<source hash>
+    etag = f'"{stem}.{width}.{fmt or "png"}"'
+    headers['ETag'] = etag
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status_code=304, headers=headers)
+
+    if fmt is None and width == source_width:
+        path = os.path.join(static_assets.SOURCE_FOLDER, source)
+    else:
+        path = await _variant(source, stem, width, fmt)
+    media_type = FORMATS[fmt][0] if fmt else None
+    return FileResponse(path, media_type=media_type, headers=headers)
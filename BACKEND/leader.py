@@ -0,0 +1,89 @@
+"""Lease-based leader election over SQLite.
+
+uvicorn runs several worker processes against the same DB. Background
+loops (calendar sync, outbox drain, ...) must run in exactly one of them,
+so each worker competes for a row in leader_lease: the holder renews it
+every HEARTBEAT seconds, and anyone may take it over once it has not been
+renewed for LEASE_TTL seconds (the holder died or hung).
+"""
+
+import os
+import time
+import uuid
+import socket
+import asyncio
+
+from BACKEND.core import logger, get_db
+
+LEASE_TTL = 30
+HEARTBEAT = 10
+
+HOLDER_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+def try_acquire_lease(name, holder=HOLDER_ID, ttl=LEASE_TTL):
+    """Take or renew the lease. Returns True if `holder` owns it afterwards."""
+    now = time.time()
+    with get_db() as conn:
+        conn.execute('''
+            INSERT INTO leader_lease (name, holder, expires_at, acquired_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                expires_at = excluded.expires_at,
+                acquired_at = CASE WHEN leader_lease.holder = excluded.holder
+                                   THEN leader_lease.acquired_at ELSE excluded.acquired_at END,
+                holder = excluded.holder
+            WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+        ''', (name, holder, now + ttl, now, now))
+        conn.commit()
+        row = conn.execute('SELECT holder FROM leader_lease WHERE name = ?', (name,)).fetchone()
+    return bool(row) and row['holder'] == holder
+
+
+def release_lease(name, holder=HOLDER_ID):
+    """Give the lease up (on shutdown) so another worker takes over immediately."""
+    with get_db() as conn:
+        conn.execute('DELETE FROM leader_lease WHERE name = ? AND holder = ?', (name, holder))
+        conn.commit()
+
+
+def lease_status(name):
+    with get_db() as conn:
+        row = conn.execute('SELECT holder, expires_at, acquired_at FROM leader_lease WHERE name = ?',
+                           (name,)).fetchone()
+    return {
+        'holder': row['holder'] if row else None,
+        'is_self': bool(row) and row['holder'] == HOLDER_ID,
+        'expires_in_s': round(row['expires_at'] - time.time(), 1) if row else None,
+    }
+
+
+async def run_when_leader(name, loop_factories):
+    """Run the given background loops only while this process holds the lease.
+
+    loop_factories are zero-arg callables returning coroutines; they are
+    started on election and cancelled on loss of leadership.
+    """
+    tasks = []
+    last_renewed = 0.0
+    while True:
+        try:
+            leader = await asyncio.to_thread(try_acquire_lease, name)
+        except Exception:
+            logger.warning('Leader lease %s: heartbeat failed', name, exc_info=True)
+            # Keep running only while the last renewal still covers us
+            leader = bool(tasks) and time.time() - last_renewed < LEASE_TTL - HEARTBEAT
+        else:
+            if leader:
+                last_renewed = time.time()
+
+        if leader and not tasks:
+            logger.warning('Leader lease %s acquired by %s, starting %d background loop(s)',
+                           name, HOLDER_ID, len(loop_factories))
+            tasks = [asyncio.create_task(factory()) for factory in loop_factories]
+        elif not leader and tasks:
+            logger.warning('Leader lease %s lost by %s, stopping background loops', name, HOLDER_ID)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            tasks = []
+        await asyncio.sleep(HEARTBEAT)
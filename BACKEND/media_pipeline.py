@@ -0,0 +1,126 @@
+"""Thumbnails for task media, made in a process pool after upload.
+
+api_upload_media() calls enqueue() once the file is stored. A bounded
+asyncio queue feeds MEDIA_PIPELINE_WORKERS dispatchers, each handing one
+job at a time to a ProcessPoolExecutor, so decoding and resizing never
+run in a web worker. Images become a WebP thumbnail (Pillow); videos get
+a WebP poster frame when ffmpeg is on PATH (thumbnails.py, the only
+code the pool processes import). The result is recorded in
+task_media.thumb_filename; media without one is shown full size, as
+before. The pool, queue and metrics are per process.
+"""
+
+import os
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from SETTINGS import MEDIA_THUMB_SIZE, MEDIA_PIPELINE_WORKERS, MEDIA_PIPELINE_QUEUE
+from BACKEND.core import logger, get_db, UPLOAD_FOLDER
+from BACKEND.gcal_metrics import Metrics, SECONDS_BUCKETS
+from BACKEND.media_store import thumb_name
+from BACKEND.thumbnails import make_thumbnail, PILLOW, FFMPEG
+
+pipeline_metrics = Metrics({'job_duration_s': SECONDS_BUCKETS})
+
+_queue = None
+_pool = None
+_dispatchers = []
+
+
+# ============== Dispatch (event loop side) ==============
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn: forking a process that runs an event loop and threads is unsafe.
+        # Spawned children re-import __main__ (run.py), which keeps its startup
+        # work (migrations, asset build) in a startup hook for that reason.
+        _pool = ProcessPoolExecutor(max_workers=MEDIA_PIPELINE_WORKERS,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def enqueue(filename, media_type):
+    """Queue a thumbnail for a stored upload. Never blocks: when the queue is
+    full the job is dropped (counted) and the media stays without one."""
+    global _queue
+    if not PILLOW or (media_type == 'video' and not FFMPEG):
+        pipeline_metrics.inc('jobs_skipped')
+        return False
+    if _queue is None:
+        _queue = asyncio.Queue(MEDIA_PIPELINE_QUEUE)
+        _dispatchers.extend(asyncio.create_task(_dispatch()) for _ in range(MEDIA_PIPELINE_WORKERS))
+    try:
+        _queue.put_nowait((filename, media_type, time.monotonic()))
+    except asyncio.QueueFull:
+        pipeline_metrics.inc('jobs_dropped')
+        logger.warning('Media pipeline queue full, no thumbnail for %s', filename)
+        return False
+    pipeline_metrics.adjust('queue_depth', 1)
+    return True
+
+
+async def _dispatch():
+    loop = asyncio.get_running_loop()
+    while True:
+        filename, media_type, queued_at = await _queue.get()
+        pipeline_metrics.adjust('queue_depth', -1)
+        pipeline_metrics.observe('queue_wait_s', time.monotonic() - queued_at)
+        try:
+            await _process(loop, filename, media_type)
+        except Exception:
+            pipeline_metrics.inc('jobs_failed')
+            logger.warning('Thumbnail failed for %s', filename, exc_info=True)
+        finally:
+            _queue.task_done()
+
+
+async def _process(loop, filename, media_type):
+    thumb = thumb_name(filename)
+    dest = os.path.join(UPLOAD_FOLDER, thumb)
+    started = time.monotonic()
+    pipeline_metrics.adjust('jobs_running', 1)
+    try:
+        made = await loop.run_in_executor(
+            _get_pool(), make_thumbnail,
+            os.path.join(UPLOAD_FOLDER, filename), dest, media_type, MEDIA_THUMB_SIZE,
+        )
+    finally:
+        pipeline_metrics.adjust('jobs_running', -1)
+    pipeline_metrics.observe('job_duration_s', time.monotonic() - started)
+    if not made:
+        pipeline_metrics.inc('jobs_skipped')
+        return
+
+    with get_db() as conn:
+        updated = conn.execute('UPDATE task_media SET thumb_filename = ? WHERE filename = ?',
+                               (thumb, filename)).rowcount
+        conn.commit()
+    if updated:
+        pipeline_metrics.inc('jobs_done')
+    else:  # media released while we worked
+        await asyncio.to_thread(_unlink, dest)
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def stats():
+    return {
+        **pipeline_metrics.snapshot(),
+        'pillow': PILLOW, 'ffmpeg': bool(FFMPEG),
+        'workers': MEDIA_PIPELINE_WORKERS, 'queue_max': MEDIA_PIPELINE_QUEUE,
+    }
+
+
+def shutdown():
+    for task in _dispatchers:
+        task.cancel()
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
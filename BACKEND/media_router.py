@@ -1,88 +1,440 @@
-"""Task media upload/delete and file serving."""
+"""Task media upload/delete and file serving.
+
+Uploads are parsed from the request stream as they arrive (python-multipart's
+push parser) rather than through UploadFile: the file part goes chunk by
+chunk to a temp file in UPLOAD_FOLDER, written off the event loop, and is
+renamed into place once complete. Size limits (MEDIA_MAX_SIZE) and the
+magic-byte check apply while streaming, so an oversized or mislabelled
+upload is refused before it is stored.
+
+Stored files are never rewritten (each upload gets a new random name), so
+/UPLOADS serves them as immutable with a strong ETag and byte ranges, to
+the uploader and their friends only.
+"""
 
 import os
-import uuid
+import stat
+import time
+import asyncio
+import hashlib
+import tempfile
+import mimetypes
+from email.utils import formatdate
 
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+import anyio
 
+from fastapi import APIRouter, Request, Depends, HTTPException, Response
+from fastapi.responses import JSONResponse
+from starlette.requests import ClientDisconnect
+from multipart.multipart import MultipartParser, parse_options_header
+from multipart.exceptions import MultipartParseError
+
+from SETTINGS import MEDIA_MAX_SIZE
 from BACKEND.core import (
-    logger, get_db, error_response, get_authenticated_user,
+    logger, get_db, error_response, get_authenticated_user, admin_auth_error,
     UPLOAD_FOLDER, ALLOWED_EXTENSIONS,
 )
+from BACKEND.gcal_metrics import Metrics, SECONDS_BUCKETS
+from BACKEND import media_pipeline, media_store
 
 router = APIRouter()
 
+VIDEO_EXTENSIONS = {'mp4', 'webm', 'mov'}
+FORM_OVERHEAD = 64 * 1024  # multipart framing and small fields allowed on top of the file
+
+# Leading bytes of each format: (offset, signature) alternatives
+_ISO_BMFF = ((4, b'ftyp'),)
+MAGIC_BYTES = {
+    'png': ((0, b'\x89PNG\r\n\x1a\n'),),
+    'jpg': ((0, b'\xff\xd8\xff'),),
+    'jpeg': ((0, b'\xff\xd8\xff'),),
+    'gif': ((0, b'GIF87a'), (0, b'GIF89a')),
+    'webp': ((8, b'WEBP'),),  # after 'RIFF' + size
+    'mp4': _ISO_BMFF,
+    'mov': _ISO_BMFF + ((4, b'moov'), (4, b'mdat'), (4, b'wide'), (4, b'free')),
+    'webm': ((0, b'\x1a\x45\xdf\xa3'),),
+}
+MAGIC_LENGTH = 12
+
+upload_metrics = Metrics({
+    'upload_duration_s': SECONDS_BUCKETS,
+    'upload_mb': (0.1, 0.5, 1, 5, 10, 25, 50, 100, 200),
+    'upload_mb_per_s': (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100),
+})
+
+
+def _magic_ok(ext, head):
+    signatures = MAGIC_BYTES[ext]
+    if ext == 'webp' and not head.startswith(b'RIFF'):
+        return False
+    return any(head[offset:offset + len(sig)] == sig for offset, sig in signatures)
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class _FileUpload:
+    """Multipart parser callbacks for one request.
+
+    The 'file' part is validated as soon as its headers arrive, and its data
+    is queued in `pending` for flush() (called in a worker thread) to append
+    to the temp file; other parts are dropped. Raises UploadRejected from
+    inside parser.write(), which aborts the request.
+    """
+
+    def __init__(self):
+        self.ext = self.media_type = None
+        self.limit = 0
+        self.size = 0
+        self.head = b''
+        self.pending = []
+        self.path = None
+        self._file = None
+        self._hash = hashlib.sha256()
+        self._headers = {}
+        self._field = self._value = b''
+        self._in_file = self._file_done = False
+
+    def callbacks(self):
+        return {
+            'on_part_begin': self._part_begin,
+            'on_header_field': self._header_field,
+            'on_header_value': self._header_value,
+            'on_header_end': self._header_end,
+            'on_headers_finished': self._headers_finished,
+            'on_part_data': self._part_data,
+            'on_part_end': self._part_end,
+        }
+
+    def _part_begin(self):
+        self._headers = {}
+        self._in_file = False
+
+    def _header_field(self, data, start, end):
+        self._field += data[start:end]
+
+    def _header_value(self, data, start, end):
+        self._value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b''
+
+    def _headers_finished(self):
+        _disposition, options = parse_options_header(self._headers.get(b'content-disposition', b''))
+        if options.get(b'name') != b'file':
+            return
+        if self.ext is not None:
+            raise UploadRejected('Only one file per upload')
+        filename = options.get(b'filename', b'').decode('utf-8', 'replace')
+        if not filename:
+            raise UploadRejected('No file selected')
+        ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if ext not in ALLOWED_EXTENSIONS:
+            raise UploadRejected('Invalid format')
+        self.ext = ext
+        self.media_type = 'video' if ext in VIDEO_EXTENSIONS else 'image'
+        self.limit = MEDIA_MAX_SIZE[self.media_type]
+        self._in_file = True
+
+    def _part_data(self, data, start, end):
+        if not self._in_file:
+            return
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise UploadRejected(f'File too large (max {self.limit // (1024 * 1024)} MB)', 413)
+        if len(self.head) < MAGIC_LENGTH:
+            self.head += chunk[:MAGIC_LENGTH - len(self.head)]
+            if len(self.head) == MAGIC_LENGTH:
+                self._check_magic()
+        self.pending.append(chunk)
+
+    def _part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self._file_done = True
+            if not self.size:
+                raise UploadRejected('No file selected')
+            if len(self.head) < MAGIC_LENGTH:
+                self._check_magic()
+
+    def _check_magic(self):
+        if not _magic_ok(self.ext, self.head):
+            raise UploadRejected('File content does not match its format')
+
+    def finish(self):
+        if not self._file_done:
+            raise UploadRejected('No file selected')
+
+    # File side: runs in a worker thread
+
+    def flush(self):
+        if self._file is None:
+            fd, self.path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=UPLOAD_FOLDER)
+            self._file = os.fdopen(fd, 'wb')
+        data, self.pending = b''.join(self.pending), []
+        self._hash.update(data)
+        self._file.write(data)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def store(self, filename):
+        """Write what is left and move the temp file to filename in the media
+        store. False if those bytes were stored already (the temp file is dropped)."""
+        self.flush()
+        self._file.close()
+        self._file = None
+        placed = media_store.place_file(self.path, filename)
+        self.path = None
+        return placed
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+        if self.path:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+async def _receive_upload(request):
+    """Stream the request body through a _FileUpload. Returns it with the
+    file part complete and validated; the caller must store() or discard()."""
+    content_type, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if content_type != b'multipart/form-data' or not options.get(b'boundary'):
+        raise UploadRejected('No file selected')
+    max_body = max(MEDIA_MAX_SIZE.values()) + FORM_OVERHEAD
+    length = request.headers.get('Content-Length', '')
+    if length.isdigit() and int(length) > max_body:
+        raise UploadRejected(f'File too large (max {max(MEDIA_MAX_SIZE.values()) // (1024 * 1024)} MB)', 413)
+
+    upload = _FileUpload()
+    parser = MultipartParser(options[b'boundary'], upload.callbacks())
+    received = 0
+    upload_metrics.adjust('uploads_in_flight', 1)
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            upload_metrics.adjust('bytes_in_flight', len(chunk))
+            if received > max_body:
+                raise UploadRejected('File too large', 413)
+            parser.write(chunk)
+            if upload.pending:
+                await asyncio.to_thread(upload.flush)
+        parser.finalize()
+        upload.finish()
+    except MultipartParseError as e:
+        await asyncio.to_thread(upload.discard)
+        raise UploadRejected('Malformed upload') from e
+    except BaseException:
+        await asyncio.to_thread(upload.discard)
+        raise
+    finally:
+        upload_metrics.adjust('uploads_in_flight', -1)
+        upload_metrics.adjust('bytes_in_flight', -received)
+    return upload
+
 
 @router.post('/api/tasks/{task_id}/media')
-async def api_upload_media(task_id: str, file: UploadFile = File(...),
+async def api_upload_media(task_id: str, request: Request,
                            user_id: int = Depends(get_authenticated_user)):
     with get_db() as conn:
         task = conn.execute('SELECT id FROM tasks WHERE id = ? AND user_id = ?',
                             (task_id, user_id)).fetchone()
-        if not task:
-            return error_response('Task not found', 404)
+    if not task:
+        return error_response('Task not found', 404)
 
-        if not file.filename:
-            return error_response('No file selected')
+    started = time.monotonic()
+    try:
+        upload = await _receive_upload(request)
+    except UploadRejected as e:
+        upload_metrics.inc('uploads_rejected')
+        return error_response(e.message, e.status_code)
+    except ClientDisconnect:
+        upload_metrics.inc('uploads_aborted')
+        return Response(status_code=400)
+    except OSError:
+        logger.error('Failed to write upload for task %s', task_id, exc_info=True)
+        upload_metrics.inc('uploads_failed')
+        return error_response('Failed to save file', 500)
 
-        ext = file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else ''
-        if ext not in ALLOWED_EXTENSIONS:
-            return error_response('Invalid format')
-
-        media_type = 'video' if ext in {'mp4', 'webm', 'mov'} else 'image'
-        filename = f"{task_id}_{uuid.uuid4().hex[:8]}.{ext}"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+    try:
+        stored = await asyncio.to_thread(media_store.attach, task_id, user_id, upload.media_type, upload)
+    except OSError:
+        await asyncio.to_thread(upload.discard)
+        logger.error('Failed to store upload for task %s', task_id, exc_info=True)
+        upload_metrics.inc('uploads_failed')
+        return error_response('Failed to save file', 500)
+    if stored is None:  # deleted while the upload was streaming
+        return error_response('Task not found', 404)
+    filename, thumb, deduplicated = stored
+    if deduplicated:
+        upload_metrics.inc('uploads_deduplicated')
+    if not thumb:
+        media_pipeline.enqueue(filename, upload.media_type)
 
-        old_media = conn.execute('SELECT filename FROM task_media WHERE task_id = ?',
-                                 (task_id,)).fetchone()
-        if old_media:
-            old_path = os.path.join(UPLOAD_FOLDER, old_media['filename'])
-            if os.path.exists(old_path):
-                os.remove(old_path)
-            conn.execute('DELETE FROM task_media WHERE task_id = ?', (task_id,))
+    elapsed = max(time.monotonic() - started, 1e-6)
+    size_mb = upload.size / (1024 * 1024)
+    upload_metrics.inc('uploads')
+    upload_metrics.inc('upload_bytes', upload.size)
+    upload_metrics.observe('upload_duration_s', elapsed)
+    upload_metrics.observe('upload_mb', size_mb)
+    upload_metrics.observe('upload_mb_per_s', size_mb / elapsed)
 
-        contents = await file.read()
-        try:
-            with open(filepath, 'wb') as f:
-                f.write(contents)
-        except IOError:
-            logger.error('Failed to write uploaded file: %s', filepath, exc_info=True)
-            return error_response('Failed to save file', 500)
+    return JSONResponse({'success': True, 'media_type': upload.media_type, 'url': f'/UPLOADS/{filename}'})
 
-        conn.execute(
-            'INSERT INTO task_media (task_id, user_id, media_type, filename) VALUES (?, ?, ?, ?)',
-            (task_id, user_id, media_type, filename),
-        )
-        conn.commit()
 
-    return JSONResponse({'success': True, 'media_type': media_type, 'url': f'/UPLOADS/{filename}'})
+@router.get('/api/admin/media/metrics')
+async def media_upload_metrics(request: Request):
+    """Upload counters, sizes, throughput and in-flight bytes, the thumbnail
+    pipeline, and the deletion reaper (its counters only move in the leader
+    worker), for this process (ADMIN_TOKEN bearer auth)."""
+    denied = admin_auth_error(request)
+    if denied:
+        return denied
+    storage = await asyncio.to_thread(media_store.stats)
+    return JSONResponse({'uploads': upload_metrics.snapshot(), 'pipeline': media_pipeline.stats(),
+                         'storage': storage})
 
 
 @router.delete('/api/tasks/{task_id}/media')
 async def api_delete_media(task_id: str, user_id: int = Depends(get_authenticated_user)):
-    with get_db() as conn:
-        media = conn.execute(
-            'SELECT filename FROM task_media WHERE task_id = ? AND user_id = ?',
-            (task_id, user_id),
-        ).fetchone()
-        if not media:
-            return error_response('Media not found', 404)
-
-        filepath = os.path.join(UPLOAD_FOLDER, media['filename'])
-        if os.path.exists(filepath):
-            os.remove(filepath)
-
-        conn.execute('DELETE FROM task_media WHERE task_id = ?', (task_id,))
-        conn.commit()
+    if not await asyncio.to_thread(media_store.detach, task_id, user_id):
+        return error_response('Media not found', 404)
     return JSONResponse({'success': True})
 
 
-@router.get('/UPLOADS/{filename}')
-async def serve_upload(filename: str):
+# ============== Serving ==============
+
+MEDIA_CACHE_CONTROL = 'private, max-age=31536000, immutable'  # filenames are never reused
+
+
+def _parse_range(header, size):
+    """(start, end) inclusive for a single 'bytes=' range, None to send the
+    whole file (no, unsupported, multi-range or invalid header, which RFC
+    9110 says to ignore), or False if valid but unsatisfiable."""
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not first:  # suffix: the last N bytes
+            length = int(last)
+            if length < 0:
+                return None
+            return (max(size - length, 0), size - 1) if length > 0 and size else False
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if end < start:  # e.g. bytes=500-100: invalid, not unsatisfiable
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+
+class MediaFileResponse(Response):
+    """A whole file, or one byte range of it.
+
+    Uses the server's zero-copy ASGI extensions when it offers them
+    (http.response.zerocopysend for any range, http.response.pathsend for
+    whole files); otherwise reads CHUNK_SIZE pieces in a worker thread.
+    """
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, path, start, end, status_code=200, headers=None, media_type=None):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path, self.start, self.count = path, start, end - start + 1
+        self.headers['content-length'] = str(self.count)
+
+    async def __call__(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status_code,
+                    'headers': self.raw_headers})
+        if scope['method'] == 'HEAD' or not self.count:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        extensions = scope.get('extensions') or {}
+        if 'http.response.zerocopysend' in extensions:
+            f = await anyio.to_thread.run_sync(open, self.path, 'rb')  # open() can block on disk
+            try:
+                await send({'type': 'http.response.zerocopysend', 'file': f,
+                            'offset': self.start, 'count': self.count})
+            finally:
+                f.close()
+            return
+        if 'http.response.pathsend' in extensions and self.status_code == 200:
+            await send({'type': 'http.response.pathsend', 'path': self.path})
+            return
+        async with await anyio.open_file(self.path, 'rb') as f:
+            await f.seek(self.start)
+            remaining = self.count
+            while remaining:
+                chunk = await f.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:  # truncated underneath us
+                    break
+                remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': bool(remaining)})
+        if remaining:
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+def _can_view(conn, filename, viewer_id):
+    """The uploader and their accepted friends (who see it in the feed) may
+    view a file or its thumbnail."""
+    return conn.execute('''
+        SELECT 1 FROM task_media m WHERE (m.filename = ? OR m.thumb_filename = ?) AND (m.user_id = ? OR EXISTS (
+            SELECT 1 FROM friendships f WHERE f.status = 'accepted'
+            AND ((f.user_id = m.user_id AND f.friend_id = ?) OR (f.friend_id = m.user_id AND f.user_id = ?))))
+    ''', (filename, filename, viewer_id, viewer_id, viewer_id)).fetchone() is not None
+
+
+@router.api_route('/UPLOADS/{filename:path}', methods=['GET', 'HEAD'])
+async def serve_upload(filename: str, request: Request, user_id: int = Depends(get_authenticated_user)):
     filepath = os.path.join(UPLOAD_FOLDER, filename)
-    if not os.path.realpath(filepath).startswith(os.path.realpath(UPLOAD_FOLDER)):
+    root = os.path.realpath(UPLOAD_FOLDER)
+    if os.path.commonpath([os.path.realpath(filepath), root]) != root:
         raise HTTPException(status_code=403)
-    if not os.path.exists(filepath):
-        raise HTTPException(status_code=404)
-    return FileResponse(filepath)
+    with get_db() as conn:
+        allowed = _can_view(conn, filename, user_id)
+    try:
+        st = await asyncio.to_thread(os.stat, filepath) if allowed else None
+    except FileNotFoundError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404)  # also when not allowed: don't confirm it exists
+
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+        'Cache-Control': MEDIA_CACHE_CONTROL,
+        'Accept-Ranges': 'bytes',
+    }
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in
+                          [t.strip() for t in if_none_match.split(',')]):
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    byte_range = None
+    if 'Range' in request.headers and request.headers.get('If-Range', etag) in (etag, headers['Last-Modified']):
+        byte_range = _parse_range(request.headers['Range'], st.st_size)
+    if byte_range is False:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{st.st_size}'})
+    if byte_range:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+        return MediaFileResponse(filepath, start, end, 206, headers, media_type)
+    return MediaFileResponse(filepath, 0, st.st_size - 1, 200, headers, media_type)
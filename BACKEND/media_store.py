@@ -0,0 +1,278 @@
+"""Content-addressed storage for task media.
+
+Each distinct file is stored once, as UPLOAD_FOLDER/ab/cd/<sha256>.<ext>
+(two levels of shards keep directories small), with a media_blobs row
+whose refcount the task_media triggers in core.init_db() keep equal to
+the number of task_media rows using it. task_media.filename holds that
+relative path, so /UPLOADS/<filename> URLs work unchanged, and an image
+attached to several tasks is one file.
+
+Nothing is unlinked on the request path. A blob whose refcount drops to
+zero is queued in media_trash by a trigger, whichever code deleted the
+task or its media, and media_reaper_loop() (leader only) unlinks the
+queue in batches. The reaper re-checks every file under the write lock
+(BEGIN IMMEDIATE) before unlinking it, so an upload of the same bytes
+that revived the blob in the meantime keeps its file. A periodic
+reconcile() queues whatever else in UPLOAD_FOLDER nothing refers to.
+Apart from the loop, everything here is blocking; call it from a worker
+thread.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+
+from SETTINGS import MEDIA_REAP_INTERVAL, MEDIA_REAP_BATCH, MEDIA_RECONCILE_INTERVAL, MEDIA_ORPHAN_GRACE
+from BACKEND.core import logger, get_db, UPLOAD_FOLDER
+from BACKEND.gcal_metrics import Metrics, COUNT_BUCKETS
+
+HASH_CHUNK = 1024 * 1024
+
+store_metrics = Metrics({'reap_batch_files': COUNT_BUCKETS})
+
+
+def blob_name(sha256, ext):
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}.{ext}'
+
+
+def thumb_name(filename):
+    return filename.rsplit('.', 1)[0] + '.thumb.webp'
+
+
+def media_path(filename):
+    return os.path.join(UPLOAD_FOLDER, filename)
+
+
+def _unlink(filename):
+    """Remove filename from the store; its size in bytes, or 0 if it was not there."""
+    path = media_path(filename)
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def place_file(src, filename):
+    """Move src to filename unless that already exists (same content); True if moved."""
+    dest = media_path(filename)
+    if os.path.exists(dest):
+        os.remove(src)
+        return False
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(src, dest)
+    return True
+
+
+def _ensure_blob(conn, sha256, ext, size):
+    row = conn.execute('SELECT filename FROM media_blobs WHERE sha256 = ?', (sha256,)).fetchone()
+    if row:
+        return row['filename']
+    filename = blob_name(sha256, ext)
+    conn.execute('INSERT INTO media_blobs (sha256, filename, size) VALUES (?, ?, ?)',
+                 (sha256, filename, size))
+    return filename
+
+
+def attach(task_id, user_id, media_type, upload):
+    """Make upload (a completed media_router._FileUpload) the task's media.
+
+    Stores the file under its hash, or drops it if those bytes are already
+    stored; the media it replaces goes to the reaper once unreferenced.
+    Returns (filename, thumb_filename, deduplicated), or None if the task
+    is gone.
+    """
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if not conn.execute('SELECT 1 FROM tasks WHERE id = ? AND user_id = ?',
+                            (task_id, user_id)).fetchone():
+            conn.rollback()
+            upload.discard()
+            return None
+        filename = _ensure_blob(conn, upload.sha256, upload.ext, upload.size)
+        deduplicated = not upload.store(filename)
+
+        # Before the DELETE: re-attaching the task's own file reuses its thumb too
+        thumb = conn.execute(
+            'SELECT thumb_filename FROM task_media WHERE filename = ? AND thumb_filename IS NOT NULL',
+            (filename,),
+        ).fetchone()
+        thumb = thumb[0] if thumb else None
+        conn.execute('DELETE FROM task_media WHERE task_id = ?', (task_id,))
+        conn.execute(
+            'INSERT INTO task_media (task_id, user_id, media_type, filename, thumb_filename) '
+            'VALUES (?, ?, ?, ?, ?)', (task_id, user_id, media_type, filename, thumb),
+        )
+        conn.commit()
+    return filename, thumb, deduplicated
+
+
+def detach(task_id, user_id):
+    """Remove a task's media. Returns False if it had none."""
+    with get_db() as conn:
+        deleted = conn.execute('DELETE FROM task_media WHERE task_id = ? AND user_id = ?',
+                               (task_id, user_id)).rowcount
+        conn.commit()
+    return bool(deleted)
+
+
+# ============== Reaper ==============
+
+def _referenced(conn, filename):
+    return conn.execute(
+        'SELECT 1 FROM media_blobs WHERE filename = ? AND refcount > 0 '
+        'UNION ALL SELECT 1 FROM task_media WHERE filename = ? OR thumb_filename = ? LIMIT 1',
+        (filename, filename, filename),
+    ).fetchone() is not None
+
+
+def reap(limit=MEDIA_REAP_BATCH):
+    """Unlink up to limit queued files (and their thumbnails) that are still
+    unreferenced, in one write transaction. Returns how many queue entries
+    were handled; fewer than limit means the queue is empty."""
+    files = freed = 0
+    with get_db() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        queued = [r[0] for r in conn.execute(
+            'SELECT filename FROM media_trash ORDER BY queued_at LIMIT ?', (limit,))]
+        for filename in queued:
+            if _referenced(conn, filename):
+                store_metrics.inc('reap_skipped_referenced')
+                continue
+            conn.execute('DELETE FROM media_blobs WHERE filename = ?', (filename,))
+            size = _unlink(filename)
+            freed += size + _unlink(thumb_name(filename))
+            files += size > 0
+        conn.executemany('DELETE FROM media_trash WHERE filename = ?', [(f,) for f in queued])
+        conn.commit()
+    if queued:
+        store_metrics.inc('files_reaped', files)
+        store_metrics.inc('bytes_reaped', freed)
+        store_metrics.observe('reap_batch_files', files)
+    return len(queued)
+
+
+def _stored_files():
+    """Relative paths of every file under UPLOAD_FOLDER at least MEDIA_ORPHAN_GRACE old."""
+    cutoff = time.time() - MEDIA_ORPHAN_GRACE
+    for root, _dirs, names in os.walk(UPLOAD_FOLDER):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < cutoff:
+                yield os.path.relpath(path, UPLOAD_FOLDER).replace(os.sep, '/'), stat.st_size
+
+
+def reconcile():
+    """Queue everything the reaper should have been told about: media rows of
+    deleted tasks, unreferenced blobs, and files in UPLOAD_FOLDER that no
+    blob or task_media row accounts for (stale partial uploads included).
+    Returns (files, bytes) found on disk; reap() re-checks before unlinking."""
+    with get_db() as conn:
+        conn.execute('DELETE FROM task_media WHERE task_id NOT IN (SELECT id FROM tasks)')
+        conn.execute('INSERT OR IGNORE INTO media_trash (filename) '
+                     'SELECT filename FROM media_blobs WHERE refcount <= 0')
+        conn.commit()
+        known = set()
+        for filename, in conn.execute('SELECT filename FROM media_blobs'):
+            known.update((filename, thumb_name(filename)))
+        for filename, thumb in conn.execute('SELECT filename, thumb_filename FROM task_media'):
+            known.update((filename, thumb))
+
+    orphans = [(name, size) for name, size in _stored_files() if name not in known]
+    if orphans:
+        with get_db() as conn:
+            conn.executemany('INSERT OR IGNORE INTO media_trash (filename) VALUES (?)',
+                             [(name,) for name, _size in orphans])
+            conn.commit()
+    found = sum(size for _name, size in orphans)
+    store_metrics.inc('reconcile_runs')
+    store_metrics.inc('orphans_found', len(orphans))
+    store_metrics.inc('orphan_bytes_found', found)
+    return len(orphans), found
+
+
+async def media_reaper_loop():
+    """Background loop (leader only): empty media_trash, reconciling now and then."""
+    next_reconcile = 0
+    while True:
+        try:
+            if time.monotonic() >= next_reconcile:
+                next_reconcile = time.monotonic() + MEDIA_RECONCILE_INTERVAL
+                files, found = await asyncio.to_thread(reconcile)
+                if files:
+                    logger.info('Media reconcile: %d unreferenced file(s), %d bytes queued', files, found)
+            before = store_metrics.counters.get('bytes_reaped', 0)
+            while await asyncio.to_thread(reap) == MEDIA_REAP_BATCH:
+                await asyncio.sleep(0)  # let uploads take the write lock between batches
+            freed = store_metrics.counters.get('bytes_reaped', 0) - before
+            if freed:
+                logger.info('Media reaper: %d bytes reclaimed', freed)
+        except Exception:
+            logger.error('Media reaper failed', exc_info=True)
+        await asyncio.sleep(MEDIA_REAP_INTERVAL)
+
+
+def stats():
+    with get_db() as conn:
+        queued = conn.execute('SELECT COUNT(*) FROM media_trash').fetchone()[0]
+    return {**store_metrics.snapshot(), 'trash_queued': queued}
+
+
+# ============== Migration ==============
+
+def _hash_file(path):
+    digest, size = hashlib.sha256(), 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def migrate_flat_uploads():
+    """Move media from the old flat layout ({task_id}_{rand}.{ext}) into the
+    store, merging duplicates, and point task_media and feed entries at the
+    new paths. Idempotent and safe to run from several workers at once."""
+    with get_db() as conn:
+        legacy = [r[0] for r in conn.execute(
+            "SELECT DISTINCT filename FROM task_media WHERE filename NOT LIKE '%/%'")]
+    moved = 0
+    for old in legacy:
+        try:
+            sha256, size = _hash_file(media_path(old))  # outside the write lock
+        except FileNotFoundError:
+            continue  # gone, or another worker moved it
+        with get_db() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            thumbs = {r[0] for r in conn.execute(
+                'SELECT thumb_filename FROM task_media WHERE filename = ? AND thumb_filename IS NOT NULL',
+                (old,))}
+            if not os.path.exists(media_path(old)):
+                conn.rollback()
+                continue
+            filename = _ensure_blob(conn, sha256, old.rsplit('.', 1)[-1].lower(), size)
+            place_file(media_path(old), filename)
+            thumb = None
+            for old_thumb in thumbs:
+                if os.path.exists(media_path(old_thumb)):
+                    place_file(media_path(old_thumb), thumb_name(filename))
+                    thumb = thumb_name(filename)
+            if thumb is None and os.path.exists(media_path(thumb_name(filename))):
+                thumb = thumb_name(filename)  # the blob was already stored, with a thumbnail
+            conn.execute('UPDATE task_media SET filename = ?, thumb_filename = ? WHERE filename = ?',
+                         (filename, thumb, old))
+            conn.execute(
+                'UPDATE activity_log SET extra_data = replace(extra_data, ?, ?) WHERE extra_data LIKE ?',
+                (f'"/UPLOADS/{old}"', f'"/UPLOADS/{filename}"', f'%/UPLOADS/{old}%'),
+            )
+            conn.commit()
+        moved += 1
+    if moved:
+        logger.info('Moved %d uploads into the content-addressed store', moved)
+    return moved
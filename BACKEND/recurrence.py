@@ -0,0 +1,420 @@
+"""Recurrence rules: RRULE parsing and local occurrence expansion.
+
+Rules use the task JSON shape written by the date editor and turned into
+RRULE by google_calendar.recurrence_rule_to_rrule():
+
+    {'frequency': 'daily'|'weekly'|'monthly'|'yearly', 'interval': n,
+     'weekdays': [0..6] (Mon=0, weekly only), 'monthDay': d (monthly only),
+     'endType': 'never'|'count'|'date', 'endCount': n, 'endDate': 'YYYY-MM-DD'}
+
+occurrences() jumps straight to the requested window instead of walking
+from the series start, so expanding next week of a ten-year-old daily
+series costs the same as expanding a new one. Arithmetic is done on wall
+clock time in the series' own timezone, so DST changes keep the local
+start time, as Google does.
+
+Local series (recurring tasks that are not on Google Calendar) are
+materialized here too: each keeps a materialized_until watermark, and a
+leader-only loop rolls every series forward to RECURRENCE_HORIZON_DAYS
+ahead in batches.
+"""
+
+import json
+import asyncio
+import calendar
+from functools import lru_cache
+from datetime import datetime, date, time, timedelta, timezone
+
+from SETTINGS import RECURRENCE_HORIZON_DAYS, RECURRENCE_EXTEND_INTERVAL, RECURRENCE_BATCH_SIZE
+from BACKEND.core import logger, get_db, new_task_id, GOOGLE_CALENDAR_ENABLED
+
+FREQUENCIES = {'DAILY': 'daily', 'WEEKLY': 'weekly', 'MONTHLY': 'monthly', 'YEARLY': 'yearly'}
+DAY_NAMES = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+MAX_COUNT = 5000    # COUNT= series are capped here when computing their last occurrence
+_MAX_MISSES = 400   # consecutive periods without a valid date (e.g. day 31 every 12th February)
+
+
+def parse_rule(rule):
+    """Normalize a recurrence_rule (JSON string or dict). Returns None if unusable."""
+    if not rule:
+        return None
+    if isinstance(rule, str):
+        try:
+            rule = json.loads(rule)
+        except (json.JSONDecodeError, TypeError):
+            return None
+    if not isinstance(rule, dict) or rule.get('frequency') not in FREQUENCIES.values():
+        return None
+    try:
+        out = {'frequency': rule['frequency'], 'interval': max(int(rule.get('interval') or 1), 1)}
+        if out['frequency'] == 'weekly' and rule.get('weekdays'):
+            out['weekdays'] = sorted({int(d) for d in rule['weekdays'] if 0 <= int(d) <= 6})
+        if out['frequency'] == 'monthly' and rule.get('monthDay'):
+            month_day = int(rule['monthDay'])
+            if not 1 <= month_day <= 31:
+                return None
+            out['monthDay'] = month_day
+        end_type = rule.get('endType') or 'never'
+        if end_type == 'count' and rule.get('endCount'):
+            out.update(endType='count', endCount=int(rule['endCount']))
+        elif end_type == 'date' and rule.get('endDate'):
+            date.fromisoformat(rule['endDate'])
+            out.update(endType='date', endDate=rule['endDate'])
+        else:
+            out['endType'] = 'never'
+    except (TypeError, ValueError):
+        return None
+    return out
+
+
+# ============== RRULE -> rule ==============
+
+def _parse_ical_time(value, tzid=None):
+    """iCalendar DATE / DATE-TIME value -> date or aware datetime (naive if floating)."""
+    if len(value) == 8:
+        return datetime.strptime(value, '%Y%m%d').date()
+    utc = value.endswith('Z')
+    dt = datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+    if utc:
+        return dt.replace(tzinfo=timezone.utc)
+    if tzid:
+        from zoneinfo import ZoneInfo
+        return dt.replace(tzinfo=ZoneInfo(tzid))
+    return dt
+
+
+def rrule_to_recurrence_rule(lines):
+    """Reverse of recurrence_rule_to_rrule for a Google event's 'recurrence' list.
+
+    Returns (rule, exdates) or (None, None) when the series uses something
+    this engine does not expand (RDATE, several RRULEs, BYSETPOS, ordinal
+    BYDAY such as 2TU, ...); those series are left to Google to expand.
+    UNTIL is kept to day precision, matching what the date editor writes.
+    """
+    rrules, exdates = [], []
+    for line in lines or []:
+        name, _, value = line.partition(':')
+        key, *params = name.split(';')
+        key = key.upper()
+        if key == 'RRULE':
+            rrules.append(value)
+        elif key == 'EXDATE':
+            tzid = next((p.split('=', 1)[1] for p in params if p.upper().startswith('TZID=')), None)
+            try:
+                exdates.extend(_parse_ical_time(v, tzid) for v in value.split(',') if v)
+            except (ValueError, KeyError):
+                return None, None
+        else:
+            return None, None
+    if len(rrules) != 1:
+        return None, None
+
+    parts = dict(p.split('=', 1) for p in rrules[0].split(';') if '=' in p)
+    parts = {k.upper(): v for k, v in parts.items()}
+    freq = FREQUENCIES.get(parts.pop('FREQ', ''))
+    if not freq:
+        return None, None
+    rule = {'frequency': freq, 'interval': 1, 'endType': 'never'}
+    try:
+        rule['interval'] = int(parts.pop('INTERVAL', 1))
+        if parts.pop('WKST', 'MO') != 'MO':
+            return None, None
+        if 'BYDAY' in parts:
+            days = parts.pop('BYDAY').split(',')
+            if freq != 'weekly' or any(d not in DAY_NAMES for d in days):
+                return None, None
+            rule['weekdays'] = sorted(DAY_NAMES.index(d) for d in days)
+        if 'BYMONTHDAY' in parts:
+            month_day = int(parts.pop('BYMONTHDAY'))
+            if freq != 'monthly' or not 1 <= month_day <= 31:
+                return None, None
+            rule['monthDay'] = month_day
+        if 'COUNT' in parts:
+            rule.update(endType='count', endCount=int(parts.pop('COUNT')))
+        elif 'UNTIL' in parts:
+            until = parts.pop('UNTIL')
+            rule.update(endType='date', endDate=f'{until[:4]}-{until[4:6]}-{until[6:8]}')
+    except ValueError:
+        return None, None
+    if parts:
+        return None, None
+    return parse_rule(rule), exdates
+
+
+# ============== Expansion ==============
+
+def _iter_wall(rule, base, start):
+    """Yield naive wall-clock occurrences >= max(base, start) in order, forever."""
+    n = rule['interval']
+    start = max(start, base)
+    freq = rule['frequency']
+
+    if freq == 'daily':
+        step = timedelta(days=n)
+        k = max(-((base - start) // step), 0)  # ceil((start - base) / step)
+        while True:
+            yield base + k * step
+            k += 1
+
+    elif freq == 'weekly':
+        days = rule.get('weekdays') or [base.weekday()]
+        week0 = base - timedelta(days=base.weekday())
+        period = timedelta(weeks=n)
+        p = max((start - week0) // period, 0)
+        while True:
+            for d in days:
+                occ = week0 + p * period + timedelta(days=d)
+                if occ >= start:
+                    yield occ
+            p += 1
+
+    elif freq == 'monthly':
+        day = rule.get('monthDay') or base.day
+        m_base = base.year * 12 + base.month - 1
+        k = max((start.year * 12 + start.month - 1 - m_base) // n, 0)
+        misses = 0
+        while misses < _MAX_MISSES:
+            year, month = divmod(m_base + k * n, 12)
+            k += 1
+            if day > calendar.monthrange(year, month + 1)[1]:
+                misses += 1
+                continue
+            misses = 0
+            occ = base.replace(year=year, month=month + 1, day=day)
+            if occ >= start:
+                yield occ
+
+    else:  # yearly
+        k = max((start.year - base.year) // n, 0)
+        misses = 0
+        while misses < _MAX_MISSES:
+            year = base.year + k * n
+            k += 1
+            if base.month == 2 and base.day == 29 and not calendar.isleap(year):
+                misses += 1
+                continue
+            misses = 0
+            occ = base.replace(year=year)
+            if occ >= start:
+                yield occ
+
+
+@lru_cache(maxsize=1024)
+def _count_limit(rule_key, base):
+    """Last wall-clock occurrence of a COUNT= series (walks COUNT occurrences, once)."""
+    rule = json.loads(rule_key)
+    last = None
+    for i, occ in enumerate(_iter_wall(rule, base, base)):
+        last = occ
+        if i + 1 >= min(rule['endCount'], MAX_COUNT):
+            break
+    return last
+
+
+def _to_wall(value, tz):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None and tz is not None:
+            value = value.astimezone(tz)
+        return value.replace(tzinfo=None)
+    return datetime.combine(value, time())
+
+
+def occurrences(rule, dtstart, window_start, window_end, exdates=(), limit=None):
+    """Occurrence starts of a series in [window_start, window_end).
+
+    dtstart is a date (all-day series) or a datetime; aware datetimes are
+    expanded in their own timezone. Window bounds may be dates or datetimes.
+    exdates are occurrence starts to skip. Returns dates or datetimes of
+    the same kind as dtstart, at most `limit` of them.
+    """
+    rule = parse_rule(rule)
+    if not rule:
+        return []
+    all_day = not isinstance(dtstart, datetime)
+    tz = None if all_day else dtstart.tzinfo
+    base = _to_wall(dtstart, tz)
+    start, end = _to_wall(window_start, tz), _to_wall(window_end, tz)
+
+    last = None
+    if rule['endType'] == 'date':
+        until = datetime.combine(date.fromisoformat(rule['endDate']), time(23, 59, 59))
+        if tz is not None:
+            until = until.replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None)
+        last = until
+    elif rule['endType'] == 'count':
+        last = _count_limit(json.dumps(rule, sort_keys=True), base)
+
+    def key(value):
+        if isinstance(value, datetime):
+            return value.astimezone(timezone.utc) if value.tzinfo else value
+        return value
+
+    skip = {key(x) for x in exdates}
+    out = []
+    for wall in _iter_wall(rule, base, start):
+        if wall >= end or (last is not None and wall > last):
+            break
+        occ = wall.date() if all_day else (wall.replace(tzinfo=tz) if tz else wall)
+        if key(occ) in skip:
+            continue
+        out.append(occ)
+        if limit and len(out) >= limit:
+            break
+    return out
+
+
+def horizon_until():
+    """End of the materialization window: whole days, so a series is
+    extended at most once a day however often it is looked at."""
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today + timedelta(days=RECURRENCE_HORIZON_DAYS + 1)
+
+
+def window_start(watermark):
+    """Where expansion resumes: the watermark, but never before today (UTC)."""
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(today, datetime.fromisoformat(watermark)) if watermark else today
+
+
+# ============== Local series ==============
+
+def _task_time(value):
+    from dateutil.parser import parse as dt_parse
+    return date.fromisoformat(value) if len(value) <= 10 else dt_parse(value)
+
+
+def _instant(value):
+    return value.astimezone(timezone.utc) if isinstance(value, datetime) and value.tzinfo else value
+
+
+def _format_like(template, value):
+    """value in the ISO style of template; the frontend sends UTC '...Z' strings."""
+    if isinstance(value, datetime) and value.tzinfo and template.endswith('Z'):
+        return value.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+    return value.isoformat()
+
+
+def materialize_local_series(conn, until, limit=None, series_id=None):
+    """Create occurrence tasks for local series up to `until` (aware UTC).
+
+    A local series is a task with a recurrence_rule that is neither an
+    occurrence itself nor on Google Calendar; connected users get theirs
+    from gcal_helpers.materialize_series(). The task is the first
+    occurrence, the rest are inserted with recurrence_source_id pointing
+    at it, from today or the series' watermark on. Task times carry no
+    timezone, so series are expanded in UTC. Nothing is committed here.
+    Returns (series looked at, rows inserted).
+    """
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')  # read watermarks under the write lock
+    sql = ('SELECT id, user_id, text, description, scheduled_start, scheduled_end, '
+           'recurrence_rule, materialized_until FROM tasks WHERE recurrence_rule IS NOT NULL '
+           'AND recurrence_source_id IS NULL AND google_event_id IS NULL '
+           'AND scheduled_start IS NOT NULL '
+           'AND (materialized_until IS NULL OR materialized_until < ?)')
+    until_iso = until.isoformat(timespec='seconds')
+    params = [until_iso]
+    if GOOGLE_CALENDAR_ENABLED:
+        sql += ' AND user_id NOT IN (SELECT user_id FROM google_tokens)'
+    if series_id:
+        sql += ' AND id = ?'
+        params.append(series_id)
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    series = conn.execute(sql, params).fetchall()
+
+    inserts, watermarks = [], []
+    for s in series:
+        watermarks.append((until_iso, s['id']))
+        try:
+            start = _task_time(s['scheduled_start'])
+            duration = (_task_time(s['scheduled_end']) - start) if s['scheduled_end'] else timedelta()
+            found = occurrences(s['recurrence_rule'], start, window_start(s['materialized_until']), until)
+        except (TypeError, ValueError, OverflowError):
+            logger.warning('Cannot expand recurring task %s', s['id'])
+            continue
+        existing = set()
+        if not s['materialized_until']:
+            # First expansion, a rebuild after an edit, or a disconnected
+            # Google series: rows for some occurrences may already exist
+            for r in conn.execute('SELECT scheduled_start FROM tasks WHERE recurrence_source_id = ? '
+                                  'AND scheduled_start IS NOT NULL', (s['id'],)):
+                try:
+                    existing.add(_instant(_task_time(r[0])))
+                except (TypeError, ValueError, OverflowError):
+                    pass
+        for occ in found:
+            if occ == start or _instant(occ) in existing:
+                continue
+            new_task, xp = new_task_id()
+            inserts.append((new_task, s['user_id'], s['text'], xp,
+                            _format_like(s['scheduled_start'], occ),
+                            _format_like(s['scheduled_end'] or s['scheduled_start'], occ + duration),
+                            s['id'], s['description']))
+
+    if inserts:
+        conn.executemany(
+            'INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, scheduled_end, '
+            'recurrence_source_id, description) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', inserts,
+        )
+    conn.executemany('UPDATE tasks SET materialized_until = ? WHERE id = ?', watermarks)
+    return len(series), len(inserts)
+
+
+def reset_local_series(conn, user_id, task_id):
+    """After a series' task was edited: drop its uncompleted occurrences from
+    today on and clear the watermark, so the next expansion rebuilds them
+    from the new text, times and rule. Nothing is committed here."""
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    conn.execute(
+        'DELETE FROM tasks WHERE recurrence_source_id = ? AND user_id = ? '
+        'AND google_event_id IS NULL AND completed_at IS NULL AND scheduled_start >= ?',
+        (task_id, user_id, today),
+    )
+    conn.execute('UPDATE tasks SET materialized_until = NULL WHERE id = ? AND user_id = ? '
+                 'AND recurrence_source_id IS NULL', (task_id, user_id))
+
+
+def extend_recurrence_horizon(batch_size=RECURRENCE_BATCH_SIZE):
+    """Roll every series whose watermark is behind forward to horizon_until().
+
+    Local series go batch_size per transaction, so request handlers never
+    wait long on the write lock. Google series with a rule recurrence.py
+    understands need no API call and are extended here too. Returns rows inserted.
+    """
+    until = horizon_until()
+    inserted = 0
+    while True:
+        with get_db() as conn:
+            seen, added = materialize_local_series(conn, until, limit=batch_size)
+            conn.commit()
+        inserted += added
+        if seen < batch_size:
+            break
+
+    if GOOGLE_CALENDAR_ENABLED:
+        from BACKEND.gcal_helpers import materialize_series
+        with get_db() as conn:
+            users = [r[0] for r in conn.execute(
+                'SELECT DISTINCT user_id FROM gcal_series WHERE rule IS NOT NULL '
+                'AND (materialized_until IS NULL OR materialized_until < ?)',
+                (until.isoformat(timespec='seconds'),),
+            )]
+        for user_id in users:
+            with get_db() as conn:
+                inserted += materialize_series(conn, user_id, until)
+                conn.commit()
+    return inserted
+
+
+async def recurrence_horizon_loop():
+    """Background loop (leader only): keep recurring tasks materialized ahead."""
+    while True:
+        try:
+            inserted = await asyncio.to_thread(extend_recurrence_horizon)
+            if inserted:
+                logger.info('Recurrence horizon: %d occurrence(s) materialized', inserted)
+        except Exception:
+            logger.error('Recurrence horizon extension failed', exc_info=True)
+        await asyncio.sleep(RECURRENCE_EXTEND_INTERVAL)
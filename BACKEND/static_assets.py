@@ -0,0 +1,226 @@
+"""Bundled, minified, fingerprinted and precompressed FRONTEND assets.
+
+build() runs once at startup (or as `python -m BACKEND.static_assets`).
+Every asset is copied to STATIC_FOLDER as name.<hash>.ext, hash being
+the start of its SHA-256, and the manifest maps each source name to that
+copy. Scripts and stylesheets are minified first (rjsmin / rcssmin, when
+installed), and the scripts in BUNDLES are also joined into one file per
+bundle, in load order. Stylesheets have their url() references to other
+assets (also those through /static/img/, see image_router.py) rewritten,
+so a changed background changes the stylesheet's name too. Text assets
+get .gz and .br (when brotli is installed) siblings, so nothing is
+compressed per request. Templates link through static_url() and
+script_urls(); a deploy only changes the URLs of what changed.
+
+StaticAssets serves /static. Fingerprinted names never change content:
+they are cached for a year, in the best encoding the client accepts.
+Source names (old links, and APP_DEBUG, whose hot reload edits files in
+place and so gets the raw, unbundled files) are revalidated on every use.
+"""
+
+import os
+import re
+import gzip
+import time
+import hashlib
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+
+from SETTINGS import APP_DEBUG
+from BACKEND.core import logger, BASE_DIR, STATIC_FOLDER
+
+try:
+    from rjsmin import jsmin
+    from rcssmin import cssmin
+except ImportError:  # assets are still fingerprinted and compressed, just not minified
+    jsmin = cssmin = None
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+SOURCE_FOLDER = os.path.join(BASE_DIR, 'FRONTEND')
+SKIP_EXTENSIONS = {'.html'}  # Jinja templates, rendered rather than served
+COMPRESSIBLE = {'.js', '.css', '.svg', '.json'}
+MIN_COMPRESS_SIZE = 1024
+HASH_LENGTH = 12
+KEEP_OLD = 7 * 86400  # seconds old fingerprints stay, for pages loaded before a deploy
+
+# Bundle name -> its scripts, in load order (dependencies first)
+BUNDLES = {
+    'dashboard.js': ['app.js', 'api.js', 'achievements.js', 'drum.js', 'tasks.js',
+                     'popups.js', 'gcal.js', 'history.js', 'social.js', 'init.js'],
+}
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")\s]+)\1\s*\)''')
+_FINGERPRINTED = re.compile(rf'\.[0-9a-f]{{{HASH_LENGTH}}}\.\w+$')
+_SUFFIXES = {'br': '.br', 'gzip': '.gz'}  # in order of preference
+
+manifest = {}   # source or bundle name -> fingerprinted name
+encodings = {}  # fingerprinted name -> content codings it is stored in besides identity
+
+
+# ============== Build ==============
+
+def _fingerprint(name, content):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(content).hexdigest()[:HASH_LENGTH]}{ext}'
+
+
+def _rewrite_css(text):
+    def repl(match):
+        quote, target = match.groups()
+        path, sep, query = target.partition('?')
+        head, slash, name = path.rpartition('/')  # img/bg_day.png: the variants route
+        if name in manifest:
+            target = f'{head}{slash}{manifest[name]}{sep}{query}'
+        return f'url({quote}{target}{quote})'
+    return _CSS_URL.sub(repl, text)
+
+
+def _minify(name, content):
+    ext = os.path.splitext(name)[1]
+    if ext == '.css':
+        text = _rewrite_css(content.decode('utf-8'))
+        return (cssmin(text) if cssmin else text).encode('utf-8')
+    if ext == '.js' and jsmin:
+        return jsmin(content.decode('utf-8')).encode('utf-8')
+    return content
+
+
+def _write(name, make):
+    """Write make()'s bytes to STATIC_FOLDER/name unless already there."""
+    path = os.path.join(STATIC_FOLDER, name)
+    if os.path.exists(path):
+        os.utime(path)  # still current: keep it out of _prune()
+        return
+    tmp = f'{path}.{os.getpid()}.part'
+    with open(tmp, 'wb') as f:
+        f.write(make())
+    os.replace(tmp, path)
+
+
+def _emit(name, content):
+    """Store content as name's fingerprinted copy, plus its precompressed variants."""
+    fingerprinted = manifest[name] = _fingerprint(name, content)
+    _write(fingerprinted, lambda: content)
+    if os.path.splitext(name)[1] not in COMPRESSIBLE or len(content) < MIN_COMPRESS_SIZE:
+        return
+    stored = []
+    if brotli:
+        _write(fingerprinted + '.br', lambda: brotli.compress(content, quality=11))
+        stored.append('br')
+    _write(fingerprinted + '.gz', lambda: gzip.compress(content, 9, mtime=0))
+    stored.append('gzip')
+    encodings[fingerprinted] = tuple(stored)
+
+
+def _prune():
+    cutoff = time.time() - KEEP_OLD
+    for name in os.listdir(STATIC_FOLDER):
+        path = os.path.join(STATIC_FOLDER, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)  # current files were just touched by _write()
+        except FileNotFoundError:
+            continue  # another worker building at the same time got there first
+
+
+def build():
+    """Build every asset and bundle in FRONTEND into STATIC_FOLDER. Safe to
+    run from several workers at once: names are content hashes, writes atomic."""
+    os.makedirs(STATIC_FOLDER, exist_ok=True)
+    sources = sorted(
+        name for name in os.listdir(SOURCE_FOLDER)
+        if os.path.isfile(os.path.join(SOURCE_FOLDER, name))
+        and os.path.splitext(name)[1] not in SKIP_EXTENSIONS
+    )
+    manifest.clear()
+    encodings.clear()
+    minified = {}
+    # Stylesheets last, so the assets they reference are already fingerprinted
+    for name in sorted(sources, key=lambda n: n.endswith('.css')):
+        with open(os.path.join(SOURCE_FOLDER, name), 'rb') as f:
+            minified[name] = _minify(name, f.read())
+        _emit(name, minified[name])
+    for bundle, members in BUNDLES.items():
+        # ';' keeps a script without a trailing semicolon from running into the next
+        _emit(bundle, b';\n'.join(minified[name] for name in members))
+    _prune()
+    logger.info('Built %d static assets (minified: %s, brotli: %s)',
+                len(manifest), bool(jsmin), bool(brotli))
+    return manifest
+
+
+# ============== URLs (Jinja globals) ==============
+
+def static_url(name):
+    """URL for a FRONTEND asset or bundle."""
+    if APP_DEBUG:
+        return f'/static/{name}'
+    return f'/static/{manifest.get(name, name)}'
+
+
+def script_urls(bundle):
+    """Script URLs for a bundle: the bundle itself, or its members under APP_DEBUG."""
+    if APP_DEBUG:
+        return [static_url(name) for name in BUNDLES[bundle]]
+    return [static_url(bundle)]
+
+
+# ============== Serving ==============
+
+def _negotiate(stored, accept_encoding):
+    """The preferred coding of stored the Accept-Encoding header allows, or None."""
+    if not stored or not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.partition(';')
+        q = params.strip().removeprefix('q=')
+        if q and q.strip() in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(coding.strip())
+    for coding in _SUFFIXES:
+        if coding in stored and (coding in accepted or '*' in accepted):
+            return coding
+    return None
+
+
+class StaticAssets(StaticFiles):
+    """/static: fingerprinted copies from STATIC_FOLDER, else FRONTEND itself."""
+
+    def __init__(self):
+        super().__init__(directory=SOURCE_FOLDER)
+        self.all_directories = [STATIC_FOLDER, *self.all_directories]
+
+    async def get_response(self, path, scope):
+        if not _FINGERPRINTED.search(path):
+            response = await super().get_response(path, scope)
+            response.headers['Cache-Control'] = REVALIDATE
+            return response
+
+        stored = encodings.get(path)
+        coding = _negotiate(stored, Headers(scope=scope).get('accept-encoding'))
+        # The variant's own file: its own ETag and length, type guessed from name.js.br
+        response = await super().get_response(path + _SUFFIXES[coding] if coding else path, scope)
+        response.headers['Cache-Control'] = IMMUTABLE
+        if stored:
+            response.headers['Vary'] = 'Accept-Encoding'
+        if coding and response.status_code == 200:
+            response.headers['Content-Encoding'] = coding
+        return response
+
+
+if __name__ == '__main__':
+    for source, built in build().items():
+        size = os.path.getsize(os.path.join(STATIC_FOLDER, built))
+        variants = ', '.join(
+            f'{coding} {os.path.getsize(os.path.join(STATIC_FOLDER, built + _SUFFIXES[coding]))}'
+            for coding in encodings.get(built, ())
+        )
+        print(f'{source:20} {built:34} {size:>8}' + (f'  ({variants})' if variants else ''))
@@ -1,12 +1,11 @@
 """Task CRUD + state + history + settings + combo."""
 
-import os
 import json
 import math
 from datetime import datetime, timedelta
 
 from fastapi import APIRouter, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from SETTINGS import APP_DEBUG
 from BACKEND.core import (
@@ -14,9 +13,11 @@ from BACKEND.core import (
     get_authenticated_user, validate_task_text, validate_description,
     new_task_id, normalize_schedule,
     get_or_create_progress, apply_xp, complete_task_logic, compute_files_hash,
-    UPLOAD_FOLDER, GOOGLE_CALENDAR_ENABLED,
+    GOOGLE_CALENDAR_ENABLED,
 )
-from BACKEND.gcal_helpers import gcal_service, gcal_delete_tasks
+from BACKEND.gcal_helpers import gcal_delete_tasks, mark_user_active
+from BACKEND.recurrence import horizon_until, materialize_local_series, reset_local_series
+from BACKEND.gcal_outbox import enqueue_gcal_op, notify_gcal_outbox
 
 router = APIRouter()
 
@@ -24,46 +25,19 @@ router = APIRouter()
 @router.get('/api/state')
 async def api_get_state(user_id: int = Depends(get_authenticated_user)):
     with get_db() as conn:
-        # Auto-delete tasks completed by user, 7 days after their scheduled end
+        # Auto-delete tasks completed by user, 7 days after their scheduled end.
+        # A local series' task stays: it drives the occurrences still to come.
         cutoff = (datetime.utcnow() - timedelta(days=7)).isoformat()
         expired = conn.execute(
             'SELECT id, google_event_id FROM tasks WHERE user_id = ? '
-            'AND completed_at IS NOT NULL AND scheduled_end < ?',
+            'AND completed_at IS NOT NULL AND scheduled_end < ? '
+            'AND (recurrence_rule IS NULL OR google_event_id IS NOT NULL)',
             (user_id, cutoff),
         ).fetchall()
         if expired:
-            if GOOGLE_CALENDAR_ENABLED:
-                try:
-                    service, cal_id = gcal_service(conn, user_id)
-                    if service:
-                        from BACKEND.google_calendar import delete_calendar_event
-                        for t in expired:
-                            if t['google_event_id']:
-                                try:
-                                    delete_calendar_event(service, cal_id, t['google_event_id'])
-                                except Exception:
-                                    pass
-                                conn.execute(
-                                    'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
-                                    (user_id, t['google_event_id']),
-                                )
-                except Exception:
-                    logger.error('Failed to sync expired tasks deletion to Google Calendar', exc_info=True)
-
             expired_ids = [t['id'] for t in expired]
             ph = ','.join('?' * len(expired_ids))
 
-            # Delete media files from disk
-            for mf in conn.execute(
-                f'SELECT filename FROM task_media WHERE task_id IN ({ph})', expired_ids
-            ).fetchall():
-                fpath = os.path.join(UPLOAD_FOLDER, mf['filename'])
-                if os.path.isfile(fpath):
-                    try:
-                        os.remove(fpath)
-                    except OSError:
-                        pass
-
             # Sync cascaded subtasks/recurrence instances to gcal before delete
             cascade_subtasks = conn.execute(
                 f'SELECT id FROM tasks WHERE parent_id IN ({ph}) AND user_id = ?',
@@ -74,8 +48,7 @@ async def api_get_state(user_id: int = Depends(get_authenticated_user)):
                 expired_ids + [user_id],
             ).fetchall()
             cascade_ids = [r['id'] for r in cascade_subtasks] + [r['id'] for r in cascade_recurrence]
-            if cascade_ids:
-                gcal_delete_tasks(conn, user_id, cascade_ids)
+            gcal_delete_tasks(conn, user_id, expired_ids + cascade_ids)
 
             conn.execute(f'DELETE FROM tasks WHERE parent_id IN ({ph}) AND user_id = ?',
                          expired_ids + [user_id])
@@ -83,12 +56,20 @@ async def api_get_state(user_id: int = Depends(get_authenticated_user)):
                          expired_ids + [user_id])
             conn.execute(f'DELETE FROM tasks WHERE id IN ({ph})', expired_ids)
             conn.commit()
+            notify_gcal_outbox()
+
+        if GOOGLE_CALENDAR_ENABLED:
+            mark_user_active(conn, user_id)
 
         progress = get_or_create_progress(conn, user_id)
         media_map = {
-            m['task_id']: {'type': m['media_type'], 'url': f"/UPLOADS/{m['filename']}"}
+            m['task_id']: {
+                'type': m['media_type'], 'url': f"/UPLOADS/{m['filename']}",
+                'thumb_url': f"/UPLOADS/{m['thumb_filename']}" if m['thumb_filename'] else None,
+            }
             for m in conn.execute(
-                'SELECT task_id, media_type, filename FROM task_media WHERE user_id = ?', (user_id,)
+                'SELECT task_id, media_type, filename, thumb_filename FROM task_media WHERE user_id = ?',
+                (user_id,),
             )
         }
         tasks = [
@@ -162,7 +143,6 @@ async def api_create_task(request: Request, user_id: int = Depends(get_authentic
     if recurrence_rule and isinstance(recurrence_rule, dict):
         recurrence_rule = json.dumps(recurrence_rule)
 
-    google_event_id = None
     with get_db() as conn:
         if parent_id:
             parent = conn.execute('SELECT id FROM tasks WHERE id = ? AND user_id = ?',
@@ -181,26 +161,16 @@ async def api_create_task(request: Request, user_id: int = Depends(get_authentic
         conn.execute('UPDATE user_progress SET xp=?, level=?, xp_max=? WHERE user_id=?',
                      (new_xp, new_level, new_xp_max, user_id))
 
-        if GOOGLE_CALENDAR_ENABLED:
-            try:
-                service, cal_id = gcal_service(conn, user_id)
-                if service:
-                    from BACKEND.google_calendar import create_calendar_event
-                    google_event_id = create_calendar_event(
-                        service, cal_id, text, scheduled_start, scheduled_end,
-                        recurrence_rule, description,
-                    )
-                    if google_event_id:
-                        conn.execute('UPDATE tasks SET google_event_id = ? WHERE id = ?',
-                                     (google_event_id, task_id))
-            except Exception:
-                logger.error('Failed to sync new task to Google Calendar', exc_info=True)
+        enqueue_gcal_op(conn, user_id, task_id, 'create')
+        if recurrence_rule and not parent_id:
+            materialize_local_series(conn, horizon_until(), series_id=task_id)
 
         conn.execute(
             'INSERT INTO activity_log (user_id, activity_type, task_text, xp_earned) '
             "VALUES (?, 'task_created', ?, ?)", (user_id, text, 3),
         )
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({
         'id': task_id, 'text': text, 'xp': xp,
@@ -263,6 +233,7 @@ async def api_update_task(task_id: str, request: Request, user_id: int = Depends
                     'WHERE id = ? AND user_id = ?', (task_id, user_id),
                 )
                 conn.commit()
+                notify_gcal_outbox()
                 return JSONResponse({'success': True})
 
         updates = ['text = ?']
@@ -280,27 +251,13 @@ async def api_update_task(task_id: str, request: Request, user_id: int = Depends
             updates.append('description = ?')
             params.append(description or None)
         params.extend([task_id, user_id])
-        conn.execute(f'UPDATE tasks SET {", ".join(updates)} WHERE id = ? AND user_id = ?', params)
-
-        if GOOGLE_CALENDAR_ENABLED:
-            task = conn.execute(
-                'SELECT google_event_id, scheduled_start, scheduled_end, recurrence_rule, description '
-                'FROM tasks WHERE id = ? AND user_id = ?', (task_id, user_id),
-            ).fetchone()
-            if task and task['google_event_id']:
-                try:
-                    service, cal_id = gcal_service(conn, user_id)
-                    if service:
-                        from BACKEND.google_calendar import update_calendar_event
-                        update_calendar_event(
-                            service, cal_id, task['google_event_id'], text,
-                            task['scheduled_start'], task['scheduled_end'],
-                            task['recurrence_rule'], task['description'],
-                        )
-                except Exception:
-                    logger.error('Failed to sync task update to Google Calendar', exc_info=True)
-
+        cur = conn.execute(f'UPDATE tasks SET {", ".join(updates)} WHERE id = ? AND user_id = ?', params)
+        if cur.rowcount:
+            enqueue_gcal_op(conn, user_id, task_id, 'update')
+            reset_local_series(conn, user_id, task_id)
+            materialize_local_series(conn, horizon_until(), series_id=task_id)
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({'success': True})
 
@@ -309,23 +266,6 @@ async def api_update_task(task_id: str, request: Request, user_id: int = Depends
 async def api_delete_task(task_id: str, user_id: int = Depends(get_authenticated_user)):
     with get_db() as conn:
         if GOOGLE_CALENDAR_ENABLED:
-            task = conn.execute(
-                'SELECT google_event_id FROM tasks WHERE id = ? AND user_id = ?',
-                (task_id, user_id),
-            ).fetchone()
-            if task and task['google_event_id']:
-                try:
-                    service, cal_id = gcal_service(conn, user_id)
-                    if service:
-                        from BACKEND.google_calendar import delete_calendar_event
-                        delete_calendar_event(service, cal_id, task['google_event_id'])
-                except Exception:
-                    logger.error('Failed to sync task deletion to Google Calendar', exc_info=True)
-                conn.execute(
-                    'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
-                    (user_id, task['google_event_id']),
-                )
-
             cascade_ids = [
                 r['id'] for r in conn.execute(
                     'SELECT id FROM tasks WHERE (recurrence_source_id = ? OR parent_id = ?) '
@@ -333,16 +273,7 @@ async def api_delete_task(task_id: str, user_id: int = Depends(get_authenticated
                     (task_id, task_id, user_id),
                 ).fetchall()
             ]
-            if cascade_ids:
-                gcal_delete_tasks(conn, user_id, cascade_ids)
-                for cid in cascade_ids:
-                    row = conn.execute('SELECT google_event_id FROM tasks WHERE id = ?',
-                                       (cid,)).fetchone()
-                    if row and row['google_event_id']:
-                        conn.execute(
-                            'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
-                            (user_id, row['google_event_id']),
-                        )
+            gcal_delete_tasks(conn, user_id, [task_id] + cascade_ids)
 
         conn.execute('DELETE FROM tasks WHERE recurrence_source_id = ? AND user_id = ?',
                      (task_id, user_id))
@@ -351,59 +282,78 @@ async def api_delete_task(task_id: str, user_id: int = Depends(get_authenticated
         conn.execute('DELETE FROM tasks WHERE id = ? AND user_id = ?',
                      (task_id, user_id))
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({'success': True})
 
 
+def _insert_subtask(user_id, task, text):
+    sub_id, xp = new_task_id()
+    with get_db() as conn:
+        conn.execute(
+            'INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, scheduled_end, '
+            'parent_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (sub_id, user_id, text, xp, task['scheduled_start'], task['scheduled_end'], task['id']),
+        )
+        enqueue_gcal_op(conn, user_id, sub_id, 'create')
+        conn.commit()
+    return {
+        'id': sub_id, 'text': text, 'xp': xp,
+        'scheduled_start': task['scheduled_start'], 'scheduled_end': task['scheduled_end'],
+        'parent_id': task['id'],
+    }
+
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
 @router.post('/api/tasks/{task_id}/breakdown')
 async def api_breakdown_task(task_id: str, request: Request, user_id: int = Depends(get_authenticated_user)):
+    """Break a task into subtasks with AI. With Accept: text/event-stream each
+    subtask is saved and sent (event: subtask) as soon as the model has written
+    it, then event: done or event: error; otherwise all of them as one JSON."""
     with get_db() as conn:
         task = conn.execute('SELECT * FROM tasks WHERE id = ? AND user_id = ?',
                             (task_id, user_id)).fetchone()
         if not task:
             return error_response('Task not found', 404)
 
-    from BACKEND.ai_service import breakdown_task
+    from BACKEND import ai_service
+    reservation = ai_service.limiter.reserve(user_id)
+    if reservation is None:
+        return error_response('Too many AI breakdowns in progress, try again shortly', 429)
+    subtasks = ai_service.breakdown_stream(task['text'], user_id)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        async def events():
+            count = 0
+            try:
+                async for st in subtasks:
+                    count += 1
+                    yield _sse('subtask', _insert_subtask(user_id, task, st.get('text', '')))
+                    notify_gcal_outbox()
+            except Exception as e:
+                logger.error('AI breakdown failed: %s', e)
+                yield _sse('error', {'error': 'AI breakdown failed', 'created': count})
+                return
+            finally:
+                reservation.release()
+            yield _sse('done', {'success': True, 'created': count})
+
+        return StreamingResponse(events(), media_type='text/event-stream', headers={
+            'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',  # nginx: don't hold events back
+        })
+
     try:
-        subtasks_data = await breakdown_task(task['text'])
+        subtasks_data = [st async for st in subtasks]
     except Exception as e:
         logger.error('AI breakdown failed: %s', e)
         return error_response('AI breakdown failed', 500)
-
-    created = []
-    with get_db() as conn:
-        service, cal_id = (None, None)
-        if GOOGLE_CALENDAR_ENABLED:
-            try:
-                service, cal_id = gcal_service(conn, user_id)
-            except Exception:
-                logger.error('Failed to init GCal service for breakdown', exc_info=True)
-
-        for st in subtasks_data:
-            sub_id, xp = new_task_id()
-            text = st.get('text', '') if isinstance(st, dict) else str(st)
-            google_event_id = None
-            if service:
-                try:
-                    from BACKEND.google_calendar import create_calendar_event
-                    google_event_id = create_calendar_event(
-                        service, cal_id, text,
-                        task['scheduled_start'], task['scheduled_end'], None, None,
-                    )
-                except Exception:
-                    logger.error('Failed to sync breakdown subtask to Google Calendar', exc_info=True)
-            conn.execute(
-                'INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, scheduled_end, '
-                'parent_id, google_event_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                (sub_id, user_id, text, xp, task['scheduled_start'], task['scheduled_end'],
-                 task_id, google_event_id),
-            )
-            created.append({
-                'id': sub_id, 'text': text, 'xp': xp,
-                'scheduled_start': task['scheduled_start'], 'scheduled_end': task['scheduled_end'],
-                'parent_id': task_id,
-            })
-        conn.commit()
+    finally:
+        reservation.release()
+    created = [_insert_subtask(user_id, task, st.get('text', '')) for st in subtasks_data]
+    notify_gcal_outbox()
 
     return JSONResponse({'success': True, 'subtasks': created})
 
@@ -434,13 +384,7 @@ async def api_complete_task(task_id: str, request: Request, user_id: int = Depen
         )
 
         if GOOGLE_CALENDAR_ENABLED and task['google_event_id']:
-            try:
-                service, cal_id = gcal_service(conn, user_id)
-                if service:
-                    from BACKEND.google_calendar import delete_calendar_event
-                    delete_calendar_event(service, cal_id, task['google_event_id'])
-            except Exception:
-                logger.error('Failed to delete calendar event on task completion', exc_info=True)
+            enqueue_gcal_op(conn, user_id, task_id, 'delete', task['google_event_id'])
             conn.execute(
                 'INSERT OR IGNORE INTO gcal_deleted_events (user_id, google_event_id) VALUES (?,?)',
                 (user_id, task['google_event_id']),
@@ -449,6 +393,7 @@ async def api_complete_task(task_id: str, request: Request, user_id: int = Depen
         completed_at = datetime.utcnow().isoformat()
         conn.execute('UPDATE tasks SET completed_at = ? WHERE id = ?', (completed_at, task_id))
         conn.commit()
+    notify_gcal_outbox()
 
     return JSONResponse({
         'success': True, 'xpEarned': r['xp_earned'], 'level': r['level'],
@@ -501,28 +446,16 @@ async def api_uncomplete_task(task_id: str, request: Request, user_id: int = Dep
         conn.execute('UPDATE tasks SET completed_at = NULL WHERE id = ?', (task_id,))
 
         if GOOGLE_CALENDAR_ENABLED and task['scheduled_start'] and task['scheduled_end']:
-            try:
-                service, cal_id = gcal_service(conn, user_id)
-                if service:
-                    from BACKEND.google_calendar import create_calendar_event
-                    new_event_id = create_calendar_event(
-                        service, cal_id, task['text'],
-                        task['scheduled_start'], task['scheduled_end'],
-                        task['recurrence_rule'],
-                    )
-                    if new_event_id:
-                        conn.execute('UPDATE tasks SET google_event_id = ? WHERE id = ?',
-                                     (new_event_id, task_id))
-                    if task['google_event_id']:
-                        conn.execute(
-                            'DELETE FROM gcal_deleted_events WHERE user_id = ? AND google_event_id = ?',
-                            (user_id, task['google_event_id']),
-                        )
-            except Exception:
-                logger.error('Failed to recreate calendar event on task uncomplete', exc_info=True)
+            enqueue_gcal_op(conn, user_id, task_id, 'create')
+            if task['google_event_id']:
+                conn.execute(
+                    'DELETE FROM gcal_deleted_events WHERE user_id = ? AND google_event_id = ?',
+                    (user_id, task['google_event_id']),
+                )
 
         conn.commit()
         progress = get_or_create_progress(conn, user_id)
+    notify_gcal_outbox()
 
     return JSONResponse({
         'success': True, 'completed': progress['completed_tasks'],
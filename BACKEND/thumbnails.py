@@ -0,0 +1,65 @@
+"""Thumbnail rendering, run in media_pipeline's process pool.
+
+Pool processes are spawned, and import this module to unpickle the job,
+so it only depends on the standard library and Pillow: no database,
+settings or app state is loaded in them.
+"""
+
+import os
+import shutil
+import subprocess
+
+try:
+    import PIL  # noqa: F401 — thumbnails need Pillow; without it media is shown full size
+    PILLOW = True
+except ImportError:
+    PILLOW = False
+
+FFMPEG = shutil.which('ffmpeg')
+POSTER_AT = 1.0          # seconds into the video for the poster frame
+FFMPEG_TIMEOUT = 60
+
+
+def _video_frame(src):
+    """PNG bytes of one frame near POSTER_AT (the first, for shorter videos)."""
+    for seek in (POSTER_AT, 0):
+        out = subprocess.run(
+            [FFMPEG, '-v', 'error', '-ss', str(seek), '-i', src, '-frames:v', '1',
+             '-f', 'image2pipe', '-vcodec', 'png', '-'],
+            capture_output=True, timeout=FFMPEG_TIMEOUT, check=False,
+        ).stdout
+        if out:
+            return out
+    return None
+
+
+def make_thumbnail(src, dest, media_type, size):
+    """Write a WebP of at most size x size for src to dest. Returns False when
+    there is no decoder for it (no Pillow, a video without ffmpeg, or a
+    corrupt file)."""
+    if not PILLOW:
+        return False
+    from io import BytesIO
+    from PIL import Image, ImageOps
+
+    if media_type == 'video':
+        frame = _video_frame(src) if FFMPEG else None
+        if not frame:
+            return False
+        source = BytesIO(frame)
+    else:
+        source = src
+    try:
+        img = Image.open(source)
+        img.load()
+    except (OSError, Image.DecompressionBombError):
+        return False  # passed the magic-byte check but does not decode
+    with img:
+        img = ImageOps.exif_transpose(img)  # phone photos: rotate by EXIF first
+        img.thumbnail((size, size))
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+        tmp = dest + '.part'
+        img.save(tmp, 'WEBP', quality=80, method=4)
+    os.replace(tmp, dest)
+    return True
@@ -25,6 +25,44 @@ async function api(url, options = {}) {
   return response.json();
 }
 
+// POST expecting server-sent events; onEvent(name, data) is called as each arrives.
+// Returns the JSON body instead when the server answered with an error or plain JSON.
+async function apiEvents(url, onEvent, options = {}) {
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: { 'Accept': 'text/event-stream', ...options.headers },
+    ...options
+  });
+
+  if (response.status === 401) {
+    window.location.href = '/';
+    return null;
+  }
+  if (!(response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+    return response.json();
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += value;
+    let end;
+    while ((end = buffer.indexOf('\n\n')) >= 0) {
+      const block = buffer.slice(0, end);
+      buffer = buffer.slice(end + 2);
+      let name = 'message', data = '';
+      for (const line of block.split('\n')) {
+        if (line.startsWith('event:')) name = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+      }
+      onEvent(name, data ? JSON.parse(data) : null);
+    }
+  }
+  return null;
+}
+
 async function loadState() {
   const data = await api('/api/state');
   if (data) {
@@ -59,6 +59,9 @@ async function uploadMedia(file) {
     }
     updateTaskMediaIcon(currentMediaTaskId);
     closeMediaPopup();
+  } else {
+    const data = await response.json().catch(() => ({}));
+    alert(data.error || 'Upload failed');
   }
 }
 
@@ -233,9 +233,10 @@ function renderFriendsFeed(feed, append = false) {
     let mediaHtml = '';
     if (item.media_url) {
       if (item.media_type === 'image') {
-        mediaHtml = `<img class="social-media" src="${item.media_url}" alt="">`;
+        mediaHtml = `<img class="social-media" src="${item.thumb_url || item.media_url}" data-full="${item.media_url}" alt="" loading="lazy">`;
       } else if (item.media_type === 'video') {
-        mediaHtml = `<div class="video-wrapper"><video class="social-media" src="${item.media_url}" muted playsinline preload="metadata"></video><div class="video-play-overlay"><span class="play-icon">\u25B6</span></div></div>`;
+        const poster = item.thumb_url ? ` poster="${item.thumb_url}" preload="none"` : ' preload="metadata"';
+        mediaHtml = `<div class="video-wrapper"><video class="social-media" src="${item.media_url}" muted playsinline${poster}></video><div class="video-play-overlay"><span class="play-icon">\u25B6</span></div></div>`;
       }
     }
 
@@ -431,7 +432,7 @@ $('friends-feed')?.addEventListener('click', e => {
     if (media.tagName === 'VIDEO') {
       openVideoFullscreen(media.src);
     } else {
-      openSocialLightbox(media.src);
+      openSocialLightbox(media.dataset.full || media.src);
     }
   }
 });
@@ -57,9 +57,18 @@ function createMediaSpan(task) {
   mediaSpan.className = 'task-media' + (task.media ? ' has-image' : '');
   if (task.media) {
     const mediaEl = task.media.type === 'image' ? document.createElement('img') : document.createElement('video');
-    mediaEl.src = task.media.url;
-    if (task.media.type === 'image') mediaEl.alt = '';
-    else mediaEl.muted = true;
+    if (task.media.type === 'image') {
+      mediaEl.src = task.media.thumb_url || task.media.url;
+      mediaEl.alt = '';
+      mediaEl.loading = 'lazy';
+    } else {
+      mediaEl.muted = true;
+      if (task.media.thumb_url) {
+        mediaEl.poster = task.media.thumb_url;
+        mediaEl.preload = 'none';
+      }
+      mediaEl.src = task.media.url;
+    }
     mediaSpan.appendChild(mediaEl);
   } else {
     mediaSpan.textContent = '\uD83D\uDDBC\uFE0F';
@@ -381,21 +390,25 @@ async function breakdownTask(taskId, btn) {
   const orig = btn.textContent;
   btn.textContent = '\u231B';
   btn.disabled = true;
+  // Each subtask is shown as soon as the server has it, before the AI has finished
+  const addSubtask = (st) => {
+    state.tasks.push({
+      id: st.id, text: st.text, xp: st.xp,
+      scheduled_start: st.scheduled_start, scheduled_end: st.scheduled_end,
+      completed_at: null, parent_id: st.parent_id,
+      recurrence_rule: null
+    });
+    renderTasks();
+    updateUI();
+    playSound('add');
+  };
   try {
-    const result = await api(`/api/tasks/${taskId}/breakdown`, { method: 'POST' });
-    if (result && result.subtasks) {
-      for (const st of result.subtasks) {
-        state.tasks.push({
-          id: st.id, text: st.text, xp: st.xp,
-          scheduled_start: st.scheduled_start, scheduled_end: st.scheduled_end,
-          completed_at: null, parent_id: st.parent_id,
-          recurrence_rule: null
-        });
-      }
-      renderTasks();
-      updateUI();
-      playSound('add');
-    }
+    const result = await apiEvents(`/api/tasks/${taskId}/breakdown`, (event, data) => {
+      if (event === 'subtask') addSubtask(data);
+      else if (event === 'error') console.error('Breakdown failed:', data.error);
+    });
+    if (result && result.subtasks) result.subtasks.forEach(addSubtask);
+    else if (result && result.error) console.error('Breakdown failed:', result.error);
   } catch (e) {
     console.error('Breakdown failed:', e);
   } finally {
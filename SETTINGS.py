@@ -1,12 +1,24 @@
 import os
 
 API_URL = "http://localhost:5000"
-APP_DEBUG = True
+APP_DEBUG = os.environ.get("APP_DEBUG", "false").lower() in ("1", "true", "yes")  # hot reload, raw static files
 PORT = 5000
 REPO_URL = "https://github.com/israice/ToDo-Game.git"
 BRANCH = "master"
-GOOGLE_CALENDAR_SYNC_INTERVAL = 5
-INSTANCE_ROLE = "primary"  # "primary" = prod (push + incremental), "replica" = dev (polling + full sync)
+GOOGLE_CALENDAR_SYNC_INTERVAL = 5          # seconds between syncs for active users (polling mode)
+GOOGLE_CALENDAR_IDLE_SYNC_INTERVAL = 60    # seconds between syncs for users not seen recently
+GOOGLE_CALENDAR_SYNC_CONCURRENCY = 8       # users synced in parallel
+GOOGLE_CALENDAR_MAX_POLL_INTERVAL = 300    # polling backs off up to this on quiet calendars
+GOOGLE_SESSION_CACHE_TTL = 1800  # seconds a loaded Calendar session (tokens) is reused per user
+GOOGLE_TOKEN_REFRESH_AHEAD = 300           # refresh access tokens this many seconds before expiry
+GOOGLE_TOKEN_REFRESH_CONCURRENCY = 4       # token refreshes in flight at once
+GOOGLE_CALENDAR_EXPAND_RECURRING = True    # fetch recurring masters and expand locally (False = one event per instance)
+RECURRENCE_HORIZON_DAYS = 14               # recurring instances are materialized this far ahead
+RECURRENCE_EXTEND_INTERVAL = 3600          # seconds between passes that roll the horizon forward
+RECURRENCE_BATCH_SIZE = 200                # series expanded per transaction in that pass
+ICS_PAST_DAYS = 30                         # calendar feed includes open quests scheduled this far back
+ICS_PAGE_SIZE = 500                        # tasks read per query while streaming a feed
+INSTANCE_ROLE = "primary"  # "primary" = prod (push + incremental), "replica" = dev (adaptive polling + own sync tokens)
 
 # Theme colors
 ACCENT_PRIMARY = "#6c5ce7"  # purple — editing border, focus, links
@@ -15,6 +27,16 @@ ACCENT_FIRE = "#ff6b6b"     # red — active task border, danger, combo
 # Task description (matches Google Calendar event description limit)
 MAX_DESCRIPTION_LENGTH = 8192
 
+# Task media uploads
+MEDIA_MAX_SIZE = {'image': 20 * 1024 * 1024, 'video': 200 * 1024 * 1024}  # bytes, per media type
+MEDIA_THUMB_SIZE = 320        # px, longest side of thumbnails and video posters
+MEDIA_PIPELINE_WORKERS = 2    # thumbnail processes per web worker
+MEDIA_PIPELINE_QUEUE = 100    # thumbnail jobs waiting before new ones are dropped
+MEDIA_REAP_INTERVAL = 30      # seconds between runs of the deleted-media reaper
+MEDIA_REAP_BATCH = 200        # files unlinked per write transaction
+MEDIA_RECONCILE_INTERVAL = 6 * 3600  # seconds between scans of UPLOADS for unreferenced files
+MEDIA_ORPHAN_GRACE = 3600     # seconds a file must be old before a scan may remove it
+
 # Drum (3D carousel) settings
 DRUM_ROW_HEIGHT = 50        # row height in px (packing density on the drum)
 DRUM_MAX_TOP_ANGLE = 30     # max angle for outermost row (degrees) — higher = more curvature
@@ -24,3 +46,9 @@ DRUM_HIGHLIGHT_OFFSET = 1   # rows above center for highlighted task on large sc
 # Groq AI settings
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "")
 GROQ_MODEL = os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")
+GROQ_URL = os.environ.get("GROQ_URL", "https://api.groq.com/openai/v1/chat/completions")
+AI_CACHE_SIZE = 1000          # task breakdowns kept in memory per worker (LRU)
+AI_CACHE_TTL = 7 * 86400      # seconds a cached breakdown is reused
+AI_CACHE_DB = True            # also keep breakdowns in SQLite, shared by workers and restarts
+AI_MAX_CONCURRENT = 4         # Groq calls in flight per worker; the rest queue, round-robin by user
+AI_MAX_PER_USER = 3           # breakdowns one user may have queued or running before getting a 429
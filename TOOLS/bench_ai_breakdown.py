@@ -0,0 +1,121 @@
+"""Benchmark: AI task breakdown against the fake Groq server.
+
+Run from the repo root:
+    python TOOLS/bench_ai_breakdown.py [--requests N] [--distinct D]
+                                       [--latency S] [--concurrency C]
+
+Sends N breakdowns drawn from D distinct task texts (with case and
+punctuation variants) through BACKEND/ai_service.py to TOOLS/fake_groq.py
+served on localhost, with a throwaway SQLite DB. Reports throughput,
+latency (to the first streamed subtask, and to the whole breakdown), Groq
+calls made and TCP connections opened for: one client per
+call (the old behaviour), the pooled client with the cache off, the
+pooled client with a cold cache, and a warm restart (memory cleared,
+SQLite tier kept).
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import statistics
+
+import httpx
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ['GROQ_API_KEY'] = 'bench-key'
+
+from BACKEND import core, ai_service
+from fake_groq import FakeGroq
+
+USERS = 20  # requests are spread over this many users (fair queue)
+VARIANTS = (str, str.upper, str.capitalize, lambda t: t + '!', lambda t: f'  {t}.  ')
+
+
+def workload(requests, distinct, seed=0):
+    rnd = random.Random(seed)
+    texts = [f'clean the kitchen {n}' for n in range(distinct)]
+    return [rnd.choice(VARIANTS)(rnd.choice(texts)) for _ in range(requests)]
+
+
+async def run(name, fake, texts, concurrency, fresh_client=False):
+    ai_service.ai_metrics.__init__(ai_service.ai_metrics.bounds)
+    before = dict(fake.calls)
+    semaphore = asyncio.Semaphore(concurrency)
+    durations, firsts = [], []
+    pooled, opened = ai_service.http_client, []
+    if fresh_client:  # a new client, so a new connection, per call
+        ai_service.http_client = lambda: opened.append(httpx.AsyncClient(timeout=30.0)) or opened[-1]
+
+    async def one(n, text):
+        async with semaphore:
+            started, first = time.perf_counter(), None
+            async for _subtask in ai_service.breakdown_stream(text, user_id=n % USERS):
+                first = first or time.perf_counter() - started
+            durations.append(time.perf_counter() - started)
+            firsts.append(first)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(n, text) for n, text in enumerate(texts)))
+    finally:
+        ai_service.http_client = pooled
+        for client in opened:
+            await client.aclose()
+    elapsed = time.perf_counter() - started
+    calls = fake.calls['completions'] - before.get('completions', 0)
+    connections = fake.calls['connections'] - before.get('connections', 0)
+    durations.sort()
+    firsts.sort()
+    counters = ai_service.ai_metrics.counters
+    reused = sum(v for k, v in counters.items() if k.startswith('cache_hits'))  # incl. in flight
+    print(f'{name:<20} {elapsed:7.2f}s {len(texts) / elapsed:8.1f} req/s '
+          f'first p50 {statistics.median(firsts) * 1000:6.1f}ms '
+          f'p50 {statistics.median(durations) * 1000:6.1f}ms '
+          f'p95 {durations[int(len(durations) * 0.95) - 1] * 1000:6.1f}ms '
+          f'{calls:5} groq calls {connections:5} connections '
+          f'{reused / len(texts):6.1%} answered without a call')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--distinct', type=int, default=40, help='distinct task texts')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake completion')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    core.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='bench_ai_'), 'users.db')
+    core.init_db()
+    fake = FakeGroq(latency=args.latency)
+    server = fake.serve()
+    ai_service.GROQ_URL = server.url
+    texts = workload(args.requests, args.distinct)
+    print(f'{args.requests} breakdowns of {args.distinct} distinct texts, '
+          f'{args.latency * 1000:.0f}ms per completion, concurrency {args.concurrency}')
+
+    ai_service.AI_CACHE_SIZE = 0
+    ai_service.AI_CACHE_DB = False
+    await run('client per call', fake, texts, args.concurrency, fresh_client=True)
+    await run('pooled, no cache', fake, texts, args.concurrency)
+
+    ai_service.AI_CACHE_SIZE = 1000
+    ai_service.AI_CACHE_DB = True
+    ai_service.clear_cache()
+    await run('pooled, cold cache', fake, texts, args.concurrency)
+    ai_service._memory.clear()
+    await run('restart, SQLite tier', fake, texts, args.concurrency)
+
+    await ai_service.close_ai_client()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,152 @@
+"""Benchmark: calendar sync and outbox drain against the fake Calendar server.
+
+Run from the repo root:
+    python TOOLS/bench_calendar_sync.py [--users N] [--events M] [--latency S]
+                                        [--concurrency C] [--fail-rate R]
+                                        [--recurring K] [--single-events]
+
+Everything runs in-process against TOOLS/fake_gcal.py and a throwaway
+SQLite DB, so no Google account or network access is needed. Reports
+events/sec, API calls per user sync and per-user sync latency for a full
+sync, a no-change incremental, an incremental after remote edits, a forced
+410 resync, and an outbox drain of locally created tasks. --recurring adds
+open-ended series per user; --single-events has Google expand them
+(singleEvents=true) instead of recurrence.py, to compare the two.
+"""
+
+import os
+import sys
+import time
+import uuid
+import asyncio
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('SECRET_KEY', 'bench')
+os.environ.setdefault('GOOGLE_CLIENT_ID', 'bench-client')
+os.environ.setdefault('GOOGLE_CLIENT_SECRET', 'bench-secret')
+
+from BACKEND import core, gcal_helpers
+from BACKEND.gcal_client import set_gcal_transport, close_http_client
+from BACKEND.gcal_helpers import sync_user_calendar, evict_gcal_session
+from BACKEND.gcal_outbox import enqueue_gcal_op, drain_gcal_outbox
+from fake_gcal import FakeCalendar, refresh_token_for
+
+
+def setup_db(tokens):
+    core.DB_PATH = os.path.join(tempfile.mkdtemp(prefix='bench_gcal_'), 'users.db')
+    core.init_db()
+    expiry = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    with core.get_db() as conn:
+        for user_id, token in enumerate(tokens, start=1):
+            conn.execute('INSERT INTO users (id, username, password) VALUES (?, ?, ?)',
+                         (user_id, f'bench{user_id}', 'x'))
+            conn.execute('INSERT INTO google_tokens (user_id, access_token, refresh_token, '
+                         'token_expiry) VALUES (?, ?, ?, ?)',
+                         (user_id, token, refresh_token_for(token), expiry))
+        conn.commit()
+    return list(range(1, len(tokens) + 1))
+
+
+async def sync_all(user_ids, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    durations, failures = [], 0
+
+    async def one(user_id):
+        nonlocal failures
+        async with sem:
+            started = time.perf_counter()
+            try:
+                fetched = await sync_user_calendar(user_id, 'primary')
+            except Exception:
+                failures += 1
+                fetched = 0
+            durations.append(time.perf_counter() - started)
+            return fetched or 0
+
+    started = time.perf_counter()
+    fetched = sum(await asyncio.gather(*(one(u) for u in user_ids)))
+    return fetched, time.perf_counter() - started, sorted(durations), failures
+
+
+def report(name, fake, user_ids, fetched, elapsed, durations, failures):
+    calls = sum(v for k, v in fake.calls.items() if not k.startswith('failed_'))
+    p = lambda q: durations[min(int(len(durations) * q), len(durations) - 1)] * 1000
+    print(f'{name:<22} {elapsed:7.2f}s {fetched / elapsed:9.0f} ev/s '
+          f'{calls / len(user_ids):6.1f} calls/user  p50 {p(0.5):7.1f}ms  p95 {p(0.95):7.1f}ms'
+          + (f'  failed {failures}' if failures else ''))
+    fake.calls.clear()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per fake API call')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--edits', type=int, default=5, help='remote edits per user')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of calls that 503')
+    parser.add_argument('--recurring', type=int, default=0, help='recurring series per user')
+    parser.add_argument('--single-events', action='store_true',
+                        help='let Google expand recurring series (singleEvents=true)')
+    parser.add_argument('--verbose', action='store_true', help='show sync/outbox logging')
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    fake = FakeCalendar(latency=args.latency)
+    tokens = fake.generate(args.users, args.events, recurring=args.recurring)
+    gcal_helpers.GOOGLE_CALENDAR_EXPAND_RECURRING = not args.single_events
+    set_gcal_transport(fake.transport())
+    user_ids = setup_db(tokens)
+    if args.fail_rate:
+        fake.fail_rate = {503: args.fail_rate}
+    print(f'{args.users} users x {args.events} events + {args.recurring} series '
+          f'({"singleEvents" if args.single_events else "local expansion"}), '
+          f'{args.latency * 1000:.0f}ms latency, concurrency {args.concurrency}, DB {core.DB_PATH}\n')
+
+    report('full sync', fake, user_ids, *await sync_all(user_ids, args.concurrency))
+    with core.get_db() as conn:
+        rows = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+    print(f'{"":<22} {rows} task rows')
+    report('incremental (idle)', fake, user_ids, *await sync_all(user_ids, args.concurrency))
+
+    for token in tokens:
+        fake.mutate(token, args.edits)
+    report('incremental (edits)', fake, user_ids, *await sync_all(user_ids, args.concurrency))
+
+    fake.expire_sync_tokens()
+    report('410 full resync', fake, user_ids, *await sync_all(user_ids, args.concurrency))
+
+    per_user = max(args.events // 10, 1)
+    start = (datetime.now() + timedelta(days=1)).replace(second=0, microsecond=0)
+    with core.get_db() as conn:
+        for user_id in user_ids:
+            for n in range(per_user):
+                task_id = uuid.uuid4().hex
+                conn.execute('INSERT INTO tasks (id, user_id, text, xp_reward, scheduled_start, '
+                             'scheduled_end) VALUES (?, ?, ?, 10, ?, ?)',
+                             (task_id, user_id, f'Local {n}', start.isoformat(),
+                              (start + timedelta(minutes=30)).isoformat()))
+                enqueue_gcal_op(conn, user_id, task_id, 'create')
+        conn.commit()
+    started = time.perf_counter()
+    while await drain_gcal_outbox():
+        if fake.fail_rate:
+            break  # failed rows back off for minutes; don't wait them out
+    elapsed = time.perf_counter() - started
+    calls = sum(v for k, v in fake.calls.items() if not k.startswith('failed_'))
+    print(f'{"outbox drain":<22} {elapsed:7.2f}s {per_user * len(user_ids) / elapsed:9.0f} ev/s '
+          f'{calls / len(user_ids):6.1f} calls/user  ({dict(fake.calls)})')
+
+    for user_id in user_ids:
+        evict_gcal_session(user_id)
+    await close_http_client()
+    set_gcal_transport(None)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,368 @@
+"""In-process fake of the Google Calendar v3 endpoints the app uses.
+
+Covers events list (sync tokens + paging, singleEvents on or off), event
+instances, insert, update, delete, watch, channels stop, the batch endpoint
+and the OAuth token endpoint. Recurring events are stored as one master;
+singleEvents=true and /instances expand it with BACKEND/recurrence.py, up to
+EXPAND_DAYS ahead (modified occurrences are not modelled). Users are
+told apart by their bearer token (refreshed tokens map back to the same
+account), so N users can share one fake.
+
+    fake = FakeCalendar(latency=0.02)
+    tokens = fake.generate(users=50, events=200)
+    set_gcal_transport(fake.transport())   # BACKEND.gcal_client
+
+Failure injection: fake.fail_next(status, n) makes the next n API calls
+return `status`; fake.fail_rate = {429: 0.05, 503: 0.01} fails randomly;
+fake.expire_sync_tokens() makes every outstanding sync token return 410.
+"""
+
+import json
+import uuid
+import asyncio
+import random
+import base64
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email.parser import Parser
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import httpx
+
+API_PREFIX = '/calendar/v3'
+BATCH_PATH = '/batch/calendar/v3'
+TOKEN_HOST = 'oauth2.googleapis.com'
+EXPAND_DAYS = 365    # how far singleEvents=true expands open-ended series
+
+_REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized',
+            404: 'Not Found', 410: 'Gone', 429: 'Too Many Requests',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def refresh_token_for(token):
+    """The refresh token generate() registers for an account's access token."""
+    return f'{token}-refresh'
+
+
+def _iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _encode(obj):
+    return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode()
+
+
+def _decode(token):
+    return json.loads(base64.urlsafe_b64decode(token.encode()))
+
+
+class _Calendar:
+    def __init__(self):
+        self.events = {}      # id -> event dict (cancelled ones kept for sync)
+        self.seq = 0
+        self.token_floor = 0  # sync tokens below this are expired (410)
+
+    def touch(self, event):
+        self.seq += 1
+        event['_seq'] = self.seq
+        event['etag'] = f'"{self.seq}"'
+        event['updated'] = _iso(datetime.now(timezone.utc))
+
+
+class FakeCalendar:
+    def __init__(self, latency=0.0, page_size_cap=250):
+        self.latency = latency
+        self.page_size_cap = page_size_cap
+        self.fail_rate = {}
+        self.calls = Counter()
+        self._calendars = {}      # (account, calendar_id) -> _Calendar
+        self._accounts = {}       # access or refresh token -> account
+        self.revoked = set()      # refresh tokens answered with invalid_grant
+        self._fail_queue = []
+        self._lock = threading.Lock()
+
+    # ---------- setup ----------
+
+    def calendar(self, token, calendar_id='primary'):
+        return self._calendars.setdefault((token, calendar_id), _Calendar())
+
+    def add_event(self, token, summary, start, end=None, calendar_id='primary', **extra):
+        cal = self.calendar(token, calendar_id)
+        end = end or start + timedelta(minutes=30)
+        event = {'kind': 'calendar#event', 'id': uuid.uuid4().hex, 'status': 'confirmed',
+                 'summary': summary, 'start': {'dateTime': _iso(start)},
+                 'end': {'dateTime': _iso(end)}, **extra}
+        cal.events[event['id']] = event
+        cal.touch(event)
+        return event
+
+    def add_recurring(self, token, summary, start, rrule, end=None, calendar_id='primary'):
+        """Add a recurring master, e.g. rrule='RRULE:FREQ=WEEKLY;BYDAY=MO,WE'."""
+        return self.add_event(token, summary, start, end, calendar_id, recurrence=[rrule])
+
+    def generate(self, users, events, seed=0, recurring=0):
+        """Create `users` calendars with `events` events each, spread over +-30 days,
+        plus `recurring` open-ended daily/weekly series each started in the last 90 days.
+        Returns the list of access tokens (one per user); see refresh_token_for()."""
+        rnd = random.Random(seed)
+        now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        tokens = []
+        for u in range(users):
+            token = f'fake-token-{u}'
+            self._accounts[refresh_token_for(token)] = token
+            tokens.append(token)
+            for n in range(events):
+                start = now + timedelta(hours=rnd.randint(-29 * 24, 29 * 24))
+                self.add_event(token, f'Event {u}-{n}', start,
+                               start + timedelta(minutes=rnd.choice([15, 30, 60])))
+            for n in range(recurring):
+                start = now - timedelta(hours=rnd.randint(0, 90 * 24))
+                self.add_recurring(token, f'Series {u}-{n}', start, rnd.choice([
+                    'RRULE:FREQ=DAILY', 'RRULE:FREQ=WEEKLY;BYDAY=MO,WE,FR',
+                    'RRULE:FREQ=WEEKLY;INTERVAL=2', 'RRULE:FREQ=DAILY;INTERVAL=3',
+                ]))
+        return tokens
+
+    def mutate(self, token, n, calendar_id='primary', seed=None):
+        """Rename n random live events (simulates remote edits)."""
+        cal = self.calendar(token, calendar_id)
+        live = [e for e in cal.events.values() if e['status'] != 'cancelled']
+        for event in random.Random(seed).sample(live, min(n, len(live))):
+            event['summary'] += ' (edited)'
+            cal.touch(event)
+
+    def fail_next(self, status, n=1):
+        self._fail_queue.extend([status] * n)
+
+    def expire_sync_tokens(self):
+        for cal in self._calendars.values():
+            cal.token_floor = cal.seq + 1
+
+    # ---------- transports ----------
+
+    def transport(self):
+        """httpx transport serving this fake (see gcal_client.set_gcal_transport)."""
+        return FakeTransport(self)
+
+    # ---------- request handling ----------
+
+    def handle(self, method, url, headers, body):
+        """Handle one HTTP request. Returns (status, headers, body_bytes)."""
+        return self._dispatch(method, url, {k.lower(): v for k, v in (headers or {}).items()}, body)
+
+    def _dispatch(self, method, url, headers, body):
+        parts = urlsplit(url)
+        if parts.netloc == TOKEN_HOST:
+            self.calls['token'] += 1
+            form = parse_qs(body.decode() if isinstance(body, bytes) else body or '')
+            refresh = form.get('refresh_token', [''])[0]
+            if refresh in self.revoked or refresh not in self._accounts:
+                return self._json(400, {'error': 'invalid_grant',
+                                        'error_description': 'Token has been expired or revoked.'})
+            access = f'{self._accounts[refresh]}~{uuid.uuid4().hex[:8]}'
+            self._accounts[access] = self._accounts[refresh]
+            return self._json(200, {'access_token': access, 'expires_in': 3600,
+                                    'token_type': 'Bearer'})
+        if parts.path == BATCH_PATH:
+            self.calls['batch'] += 1
+            return self._batch(headers, body)
+        return self._api(method, parts.path, parse_qs(parts.query), headers, body)
+
+    def _json(self, status, obj=None):
+        if obj is None:
+            return status, {}, b''
+        return status, {'content-type': 'application/json; charset=UTF-8'}, json.dumps(obj).encode()
+
+    def _error(self, status):
+        return self._json(status, {'error': {'code': status, 'message': _REASONS.get(status, '')}})
+
+    def _injected_failure(self):
+        with self._lock:
+            if self._fail_queue:
+                return self._fail_queue.pop(0)
+        for status, rate in self.fail_rate.items():
+            if random.random() < rate:
+                return status
+        return None
+
+    def _api(self, method, path, query, headers, body):
+        if not path.startswith(API_PREFIX):
+            return self._error(404)
+        route = [unquote(p) for p in path[len(API_PREFIX):].strip('/').split('/')]
+        token = headers.get('authorization', '').replace('Bearer ', '')
+        if not token:
+            return self._error(401)
+        token = self._accounts.get(token, token)
+        status = self._injected_failure()
+        if status:
+            self.calls[f'failed_{status}'] += 1
+            return self._error(status)
+        data = json.loads(body) if body else {}
+        q = {k: v[-1] for k, v in query.items()}
+
+        with self._lock:
+            if route[:1] == ['channels'] and route[1:] == ['stop']:
+                self.calls['channels.stop'] += 1
+                return self._json(204)
+            if route[:1] != ['calendars'] or len(route) < 3 or route[2] != 'events':
+                return self._error(404)
+            cal = self.calendar(token, route[1])
+            rest = route[3:]
+            if not rest and method == 'GET':
+                self.calls['events.list'] += 1
+                return self._list(cal, q)
+            if not rest and method == 'POST':
+                self.calls['events.insert'] += 1
+                event = {'kind': 'calendar#event', 'id': uuid.uuid4().hex,
+                         'status': 'confirmed', **data}
+                cal.events[event['id']] = event
+                cal.touch(event)
+                return self._json(200, self._public(event))
+            if len(rest) == 2 and rest[1] == 'instances' and method == 'GET':
+                self.calls['events.instances'] += 1
+                master = cal.events.get(rest[0])
+                if not master or master['status'] == 'cancelled':
+                    return self._error(404 if not master else 410)
+                return self._json(200, {'kind': 'calendar#events', 'items': [
+                    self._public(e) for e in self._expand(master, q.get('timeMin'), q.get('timeMax'))
+                ]})
+            if rest == ['watch'] and method == 'POST':
+                self.calls['events.watch'] += 1
+                return self._json(200, {'kind': 'api#channel', 'id': data.get('id'),
+                                        'resourceId': uuid.uuid4().hex,
+                                        'expiration': str(data.get('expiration', 0))})
+            event = cal.events.get(rest[0]) if len(rest) == 1 else None
+            if method == 'PUT':
+                self.calls['events.update'] += 1
+                if not event:
+                    return self._error(404)
+                if event['status'] == 'cancelled':
+                    return self._error(410)
+                event.update(data)
+                cal.touch(event)
+                return self._json(200, self._public(event))
+            if method == 'DELETE':
+                self.calls['events.delete'] += 1
+                if not event:
+                    return self._error(404)
+                if event['status'] == 'cancelled':
+                    return self._error(410)
+                event['status'] = 'cancelled'
+                cal.touch(event)
+                return self._json(204)
+        return self._error(400)
+
+    @staticmethod
+    def _public(event):
+        return {k: v for k, v in event.items() if not k.startswith('_')}
+
+    def _list(self, cal, q):
+        page_size = min(int(q.get('maxResults', 250)), self.page_size_cap)
+        if 'pageToken' in q:
+            state = _decode(q['pageToken'])
+        elif 'syncToken' in q:
+            since = int(q['syncToken'].split(':', 1)[1])
+            if since < cal.token_floor:
+                return self._error(410)
+            state = {'since': since, 'snapshot': cal.seq, 'offset': 0}
+        else:
+            state = {'since': None, 'snapshot': cal.seq, 'offset': 0,
+                     'min': q.get('timeMin'), 'max': q.get('timeMax')}
+
+        if state['since'] is not None:
+            items = [e for e in cal.events.values() if state['since'] < e['_seq'] <= state['snapshot']]
+        else:
+            items = [e for e in cal.events.values()
+                     if e['status'] != 'cancelled' and e['_seq'] <= state['snapshot']
+                     # A series overlaps the window unless it starts after it
+                     and (e.get('recurrence') or not state.get('min') or self._start(e) >= state['min'])
+                     and (not state.get('max') or self._start(e) < state['max'])]
+        if q.get('singleEvents') == 'true' or state.get('single'):
+            state['single'] = True
+            items = [i for e in items for i in
+                     (self._expand(e, state.get('min'), state.get('max'))
+                      if e.get('recurrence') and e['status'] != 'cancelled' else [e])]
+        items.sort(key=lambda e: e['_seq'])
+        page = items[state['offset']:state['offset'] + page_size]
+        result = {'kind': 'calendar#events', 'items': [self._public(e) for e in page]}
+        if state['offset'] + page_size < len(items):
+            result['nextPageToken'] = _encode({**state, 'offset': state['offset'] + page_size})
+        else:
+            result['nextSyncToken'] = f"seq:{state['snapshot']}"
+        return self._json(200, result)
+
+    @staticmethod
+    def _expand(master, time_min=None, time_max=None):
+        """Occurrences of a recurring master as Google's singleEvents would list them."""
+        from BACKEND.recurrence import rrule_to_recurrence_rule, occurrences
+        rule, exdates = rrule_to_recurrence_rule(master['recurrence'])
+        start = datetime.fromisoformat(master['start']['dateTime'])
+        duration = datetime.fromisoformat(master['end']['dateTime']) - start
+        window_start = datetime.fromisoformat(time_min) if time_min else start
+        window_end = (datetime.fromisoformat(time_max) if time_max
+                      else datetime.now(timezone.utc) + timedelta(days=EXPAND_DAYS))
+        out = []
+        for occ in occurrences(rule, start, window_start, window_end, exdates or ()):
+            out.append({
+                **{k: v for k, v in master.items() if k != 'recurrence'},
+                'id': f"{master['id']}_{occ:%Y%m%dT%H%M%SZ}",
+                'etag': f"{master['etag']}-{occ:%Y%m%d%H%M}",
+                'recurringEventId': master['id'],
+                'originalStartTime': {'dateTime': _iso(occ)},
+                'start': {'dateTime': _iso(occ)}, 'end': {'dateTime': _iso(occ + duration)},
+            })
+        return out
+
+    @staticmethod
+    def _start(event):
+        start = event.get('start', {})
+        return start.get('dateTime') or start.get('date') or ''
+
+    def _batch(self, headers, body):
+        if isinstance(body, bytes):
+            body = body.decode()
+        boundary = headers['content-type'].split('boundary=', 1)[1].strip('"')
+        outer_auth = headers.get('authorization', '')
+        out_boundary = f'batch_{uuid.uuid4().hex}'
+        chunks = []
+        for raw in body.split(f'--{boundary}')[1:]:
+            if raw.startswith('--'):
+                break
+            part_headers, inner = raw.lstrip('\r\n').split('\r\n\r\n', 1) if '\r\n\r\n' in raw \
+                else raw.lstrip('\n').split('\n\n', 1)
+            content_id = Parser().parsestr(part_headers)['Content-ID'] or '<x+0>'
+            request_line, inner_rest = inner.split('\n', 1)
+            req_method, req_path, _proto = request_line.strip().split(' ', 2)
+            msg = Parser().parsestr(inner_rest)
+            req_headers = {k.lower(): v for k, v in msg.items()}
+            req_headers.setdefault('authorization', outer_auth)
+            req_body = msg.get_payload().strip() or None
+            status, resp_headers, resp_body = self._dispatch(
+                req_method, 'https://www.googleapis.com' + req_path, req_headers, req_body,
+            )
+            head = f'HTTP/1.1 {status} {_REASONS.get(status, "")}\r\n'
+            head += ''.join(f'{k}: {v}\r\n' for k, v in resp_headers.items())
+            chunks.append(
+                f'--{out_boundary}\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id.strip("<>")}>\r\n\r\n'
+                f'{head}\r\n{resp_body.decode()}\r\n'
+            )
+        payload = ''.join(chunks) + f'--{out_boundary}--\r\n'
+        return 200, {'content-type': f'multipart/mixed; boundary={out_boundary}'}, payload.encode()
+
+
+class FakeTransport(httpx.AsyncBaseTransport):
+    """httpx transport that answers from a FakeCalendar after `latency` seconds."""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def handle_async_request(self, request):
+        if self.fake.latency:
+            await asyncio.sleep(self.fake.latency)
+        body = await request.aread()
+        status, headers, content = self.fake.handle(
+            request.method, str(request.url), dict(request.headers), body or None,
+        )
+        return httpx.Response(status, headers=headers, content=content, request=request)
@@ -0,0 +1,204 @@
+"""Stand-in for the Groq chat completions endpoint the app uses.
+
+Answers every completion with a JSON breakdown of the task text (three
+numbered steps), after `latency` seconds. With "stream": true the answer
+comes as server-sent events instead, a few characters per chunk, spread
+over those `latency` seconds like a model writing. Use it in-process, or as a
+real HTTP server on localhost, which also shows how many connections the
+client opened (keep-alive at work):
+
+    fake = FakeGroq(latency=0.2)
+    set_groq_transport(fake.transport())      # BACKEND.ai_service
+
+    server = fake.serve()                      # background thread
+    ai_service.GROQ_URL = server.url
+
+    python TOOLS/fake_groq.py --port 8765      # standalone; then
+    GROQ_URL=http://127.0.0.1:8765/openai/v1/chat/completions
+
+Failure injection: fake.fail_next(status, n) makes the next n calls
+return `status`; fake.fail_rate = {429: 0.05, 503: 0.01} fails randomly.
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import httpx
+
+COMPLETIONS_PATH = '/openai/v1/chat/completions'
+CHUNK_CHARS = 8  # content characters per streamed chunk
+
+
+class FakeGroq:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.fail_rate = {}
+        self.calls = Counter()      # 'completions', 'failed', 'connections'
+        self.prompts = Counter()    # user message -> times asked
+        self._fail_queue = []
+        self._lock = threading.Lock()
+
+    def fail_next(self, status, n=1):
+        with self._lock:
+            self._fail_queue.extend([status] * n)
+
+    @staticmethod
+    def steps(text):
+        return [{'text': f'Step {i}: {text}'} for i in (1, 2, 3)]
+
+    # ---------- request handling ----------
+
+    def handle(self, method, path, headers, body):
+        """Handle one HTTP request. Returns (status, headers, body), body being
+        bytes, or a list of chunks to send `latency` apart in total (streaming)."""
+        if method != 'POST' or path.split('?')[0] != COMPLETIONS_PATH:
+            return self._json(404, {'error': {'message': 'Unknown endpoint'}})
+        if not headers.get('authorization', '').startswith('Bearer '):
+            return self._json(401, {'error': {'message': 'Invalid API Key'}})
+        failure = self._injected_failure()
+        if failure:
+            with self._lock:
+                self.calls['failed'] += 1
+            return self._json(failure, {'error': {'message': 'Injected failure'}},
+                              {'retry-after': '1'} if failure == 429 else None)
+
+        request = json.loads(body or b'{}')
+        stream = request.get('stream')
+        user = next((m['content'] for m in request.get('messages', []) if m.get('role') == 'user'), '')
+        with self._lock:
+            self.calls['completions'] += 1
+            self.prompts[user] += 1
+        completion_id = f'chatcmpl-{self.calls["completions"]}'
+        content = json.dumps({'subtasks': self.steps(user)})
+        if stream:
+            return 200, {'content-type': 'text/event-stream'}, self._chunks(completion_id, request, content)
+        return self._json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'model': request.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {
+                'role': 'assistant', 'content': content,
+            }}],
+        })
+
+    @staticmethod
+    def _chunks(completion_id, request, content, size=CHUNK_CHARS):
+        """The completion as a list of SSE events, `size` characters of content each."""
+        def event(delta, finish_reason=None):
+            return b'data: ' + json.dumps({
+                'id': completion_id, 'object': 'chat.completion.chunk', 'model': request.get('model'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+            }).encode() + b'\n\n'
+        return ([event({'role': 'assistant', 'content': ''})]
+                + [event({'content': content[i:i + size]}) for i in range(0, len(content), size)]
+                + [event({}, 'stop'), b'data: [DONE]\n\n'])
+
+    def _json(self, status, obj, headers=None):
+        return status, {'content-type': 'application/json', **(headers or {})}, json.dumps(obj).encode()
+
+    def _injected_failure(self):
+        with self._lock:
+            if self._fail_queue:
+                return self._fail_queue.pop(0)
+        for status, rate in self.fail_rate.items():
+            if random.random() < rate:
+                return status
+        return None
+
+    # ---------- transports ----------
+
+    def transport(self):
+        """httpx transport serving this fake (see ai_service.set_groq_transport)."""
+        return FakeTransport(self)
+
+    def serve(self, port=0):
+        """Serve on 127.0.0.1 from a background thread; .url is the completions URL."""
+        server = ThreadingHTTPServer(('127.0.0.1', port), _handler_for(self))
+        server.daemon_threads = True
+        server.url = f'http://127.0.0.1:{server.server_address[1]}{COMPLETIONS_PATH}'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class FakeTransport(httpx.AsyncBaseTransport):
+    """httpx transport that answers from a FakeGroq after `latency` seconds."""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    async def handle_async_request(self, request):
+        body = await request.aread()
+        status, headers, content = self.fake.handle(
+            request.method, request.url.raw_path.decode(), dict(request.headers), body,
+        )
+        if isinstance(content, list):
+            return httpx.Response(status, headers=headers, stream=_Chunks(content, self.fake.latency),
+                                  request=request)
+        if self.fake.latency:
+            await asyncio.sleep(self.fake.latency)
+        return httpx.Response(status, headers=headers, content=content, request=request)
+
+
+class _Chunks(httpx.AsyncByteStream):
+    def __init__(self, chunks, latency):
+        self.chunks = chunks
+        self.delay = latency / len(chunks)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield chunk
+
+
+def _handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def setup(self):
+            super().setup()
+            with fake._lock:
+                fake.calls['connections'] += 1
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            status, headers, content = fake.handle(
+                'POST', self.path, {k.lower(): v for k, v in self.headers.items()}, body,
+            )
+            if not isinstance(content, list) and fake.latency:
+                time.sleep(fake.latency)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if not isinstance(content, list):
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in content:
+                time.sleep(fake.latency / len(content))
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Groq chat completions server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.3)
+    args = parser.parse_args()
+    server = FakeGroq(latency=args.latency).serve(args.port)
+    print(f'Fake Groq at {server.url}')
+    threading.Event().wait()
@@ -1,7 +1,7 @@
 """FastAPI entrypoint.
 
 This file is intentionally thin: it wires up middleware, templates,
-static files, the background calendar sync loop, and includes all
+static files, the leader-elected background loops, and includes all
 routers from BACKEND/. All business logic lives in BACKEND/*.
 """
 
@@ -11,9 +11,8 @@ import logging
 import warnings
 
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import MutableHeaders
 from dotenv import load_dotenv
 import uvicorn
 
@@ -38,12 +37,23 @@ from BACKEND.core import (
     APP_URL, GOOGLE_CLIENT_ID, GOOGLE_CALENDAR_ENABLED, INSTANCE_ROLE,
 )
 from BACKEND.gcal_helpers import calendar_sync_loop
+from BACKEND.gcal_outbox import gcal_outbox_loop
+from BACKEND.gcal_tokens import token_refresh_loop
+from BACKEND.gcal_client import close_http_client
+from BACKEND.ai_service import close_ai_client
+from BACKEND import media_pipeline
+from BACKEND.media_store import media_reaper_loop
+from BACKEND import static_assets
+from BACKEND.recurrence import recurrence_horizon_loop
+from BACKEND.leader import run_when_leader, release_lease
 from BACKEND.auth_router import router as auth_router
 from BACKEND.tasks_router import router as tasks_router
 from BACKEND.bot_router import router as bot_router
 from BACKEND.media_router import router as media_router
 from BACKEND.friends_router import router as friends_router
 from BACKEND.gcal_router import router as gcal_router
+from BACKEND.ics_router import router as ics_router
+from BACKEND.image_router import router as image_router
 from BACKEND.system_router import router as system_router
 
 
@@ -64,11 +74,25 @@ app = FastAPI()
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 
 
-class NoCacheMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers['Cache-Control'] = 'no-store'
-        return response
+class NoCacheMiddleware:
+    """Cache-Control: no-store for dynamic routes, unless the route set its
+    own (calendar feed, uploads); /static sets its own (static_assets.py).
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed and zero-copy
+    file responses pass through untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith('/static/'):
+            return await self.app(scope, receive, send)
+
+        async def send_with_cache_control(message):
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message).setdefault('Cache-Control', 'no-store')
+            await send(message)
+
+        await self.app(scope, receive, send_with_cache_control)
 
 
 app.add_middleware(NoCacheMiddleware)
@@ -83,18 +107,46 @@ app.include_router(bot_router)
 app.include_router(media_router)
 app.include_router(friends_router)
 app.include_router(gcal_router)
+app.include_router(ics_router)
+app.include_router(image_router)
 
 
 # ============== Startup ==============
 
-init_db()
+BACKGROUND_LEASE = 'background'
+
+
+@app.on_event('startup')
+def prepare_data():
+    """Migrations and the static asset build, once per worker. Not at import:
+    the thumbnail pool's spawned processes re-import this module."""
+    init_db()
+    static_assets.build()
 
 
 @app.on_event('startup')
-async def start_calendar_sync():
+async def start_background_loops():
     logger.warning('Calendar startup: enabled=%s, role=%s, APP_URL=%s, CLIENT_ID=%s',
                    GOOGLE_CALENDAR_ENABLED, INSTANCE_ROLE, APP_URL, bool(GOOGLE_CLIENT_ID))
-    asyncio.create_task(calendar_sync_loop(INSTANCE_ROLE, APP_URL, GOOGLE_CALENDAR_SYNC_INTERVAL))
+    # Every worker competes for the lease; only the holder runs these
+    asyncio.create_task(run_when_leader(BACKGROUND_LEASE, [
+        lambda: calendar_sync_loop(INSTANCE_ROLE, APP_URL, GOOGLE_CALENDAR_SYNC_INTERVAL),
+        gcal_outbox_loop,
+        token_refresh_loop,
+        recurrence_horizon_loop,
+        media_reaper_loop,
+    ]))
+
+
+@app.on_event('shutdown')
+async def release_background_lease():
+    try:
+        release_lease(BACKGROUND_LEASE)
+    except Exception:
+        logger.warning('Failed to release background lease', exc_info=True)
+    await close_http_client()
+    await close_ai_client()
+    media_pipeline.shutdown()
 
 
 # Template globals (available in all Jinja templates)
@@ -105,12 +157,12 @@ templates.env.globals['drum_perspective_k'] = DRUM_PERSPECTIVE_K
 templates.env.globals['drum_highlight_offset'] = DRUM_HIGHLIGHT_OFFSET
 templates.env.globals['accent_primary'] = ACCENT_PRIMARY
 templates.env.globals['accent_fire'] = ACCENT_FIRE
-import time as _time
-templates.env.globals['cache_bust'] = str(int(_time.time()))
+templates.env.globals['static_url'] = static_assets.static_url
+templates.env.globals['script_urls'] = static_assets.script_urls
 
 
-# Static files (mount last so they don't shadow routes)
-app.mount('/static', StaticFiles(directory='FRONTEND'), name='static')
+# Static files (mount last so they don't shadow routes; built in prepare_data)
+app.mount('/static', static_assets.StaticAssets(), name='static')
 
 
 if __name__ == '__main__':
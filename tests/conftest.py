@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SECRET_KEY', 'test')
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from BACKEND import core
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh database for the test."""
+    monkeypatch.setattr(core, 'DB_PATH', str(tmp_path / 'users.db'))
+    core.init_db()
+    with core.get_db() as conn:
+        conn.execute("INSERT INTO users (id, username, password) VALUES (1, 'hero', 'x')")
+        conn.execute('INSERT INTO user_progress (user_id) VALUES (1)')  # as registration does
+        conn.commit()
+    return core.get_db
+
+
+@pytest.fixture
+def client(db):
+    """TestClient for the API routers, logged in as user 1."""
+    from BACKEND.tasks_router import router as tasks_router
+    from BACKEND.ics_router import router as ics_router
+    app = FastAPI()
+    app.include_router(tasks_router)
+    app.include_router(ics_router)
+    app.dependency_overrides[core.get_authenticated_user] = lambda: 1
+    return TestClient(app)
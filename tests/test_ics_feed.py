@@ -0,0 +1,44 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+DAILY = json.dumps({'frequency': 'daily', 'interval': 1, 'endType': 'never'})
+
+
+def _add_task(db, task_id, start, **columns):
+    end = start + timedelta(hours=1)
+    values = {'id': task_id, 'user_id': 1, 'text': f'Quest {task_id}', 'xp_reward': 10,
+              'scheduled_start': start.isoformat(), 'scheduled_end': end.isoformat(), **columns}
+    with db() as conn:
+        conn.execute(f'INSERT INTO tasks ({", ".join(values)}) VALUES ({", ".join("?" * len(values))})',
+                     list(values.values()))
+        conn.commit()
+
+
+def _events(client):
+    url = client.get('/api/ics').json()['url']
+    body = client.get(url[url.index('/ics/'):]).text
+    return [e.split('END:VEVENT')[0] for e in body.split('BEGIN:VEVENT')[1:]]
+
+
+def test_completing_series_master_keeps_series(client, db):
+    start = datetime.now(timezone.utc).replace(hour=9, minute=0, second=0, microsecond=0)
+    _add_task(db, 'series', start, recurrence_rule=DAILY)
+    _add_task(db, 'next', start + timedelta(days=1), recurrence_source_id='series',
+              completed_at=datetime.utcnow().isoformat())
+
+    assert client.post('/api/tasks/series/complete', json={}).json().get('success')
+
+    [event] = _events(client)
+    assert 'UID:series@todo-game' in event
+    assert 'RRULE:FREQ=DAILY' in event
+    assert f'EXDATE:{start:%Y%m%dT%H%M%SZ}' in event
+    assert f'EXDATE:{start + timedelta(days=1):%Y%m%dT%H%M%SZ}' in event
+
+
+def test_completed_one_off_task_leaves_feed(client, db):
+    start = datetime.now(timezone.utc) + timedelta(days=1)
+    _add_task(db, 'once', start)
+    assert len(_events(client)) == 1
+
+    assert client.post('/api/tasks/once/complete', json={}).json().get('success')
+    assert _events(client) == []
@@ -0,0 +1,57 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.middleware.sessions import SessionMiddleware
+
+from BACKEND import static_assets
+from BACKEND.core import templates, generate_csrf_token
+
+
+@pytest.fixture
+def site(db, tmp_path, monkeypatch):
+    """Login and dashboard pages with assets built as in production (APP_DEBUG off)."""
+    from BACKEND.auth_router import router as auth_router
+    monkeypatch.setattr(static_assets, 'APP_DEBUG', False)
+    monkeypatch.setattr(static_assets, 'STATIC_FOLDER', str(tmp_path / 'static'))
+    static_assets.build()
+    monkeypatch.setitem(templates.env.globals, 'static_url', static_assets.static_url)
+    monkeypatch.setitem(templates.env.globals, 'script_urls', static_assets.script_urls)
+
+    app = FastAPI()
+    app.add_middleware(SessionMiddleware, secret_key='test')
+    app.include_router(auth_router)
+    app.mount('/static', static_assets.StaticAssets(), name='static')
+    return TestClient(app)
+
+
+def _dashboard(site):
+    response = site.post('/register', data={
+        'username': 'player', 'password': 'secret', 'csrf_token': generate_csrf_token(),
+    })
+    assert 'id="skeleton-loader"' in response.text  # redirected to the dashboard
+    return response.text
+
+
+def test_dashboard_links_fingerprinted_stylesheet(site):
+    page = _dashboard(site)
+    url = f'/static/{static_assets.manifest["styles.css"]}'
+    assert f'href="{url}"' in page
+    assert 'href="/static/styles.css"' not in page
+
+    response = site.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == static_assets.IMMUTABLE
+
+
+def test_dashboard_loads_one_fingerprinted_bundle(site):
+    page = _dashboard(site)
+    bundle = f'/static/{static_assets.manifest["dashboard.js"]}'
+    assert page.count('<script src="/static/') == 1
+    assert f'<script src="{bundle}"' in page
+    for member in static_assets.BUNDLES['dashboard.js']:
+        assert f'/static/{member}"' not in page
+
+    response = site.get(bundle, headers={'Accept-Encoding': 'br, gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] in ('br', 'gzip')
+    assert response.headers['Cache-Control'] == static_assets.IMMUTABLE